@@ -91,6 +91,14 @@ jcc_args=(
 	"--include lib/commons-math3-3.5.jar"
 	"--include lib/Jama-mipav.jar"
 
+	# Java buffers used by nighres for bulk array transfers
+	"java.nio.ByteBuffer"
+	"java.nio.ByteOrder"
+	"java.nio.FloatBuffer"
+	"java.nio.IntBuffer"
+	# Runtime, to report the heap usage after each module
+	"java.lang.Runtime"
+
 	# Name the python module
 	"--python cbstools"
 
@@ -97,6 +97,12 @@ public class SimpleShapeAtlas2 {
 	private static final	float	PI2 = (float)(Math.PI/2.0);
 	private static final	float	ISQRT2 =  (float)(1.0/Math.sqrt(2.0f));
 	
+	// shape priors and topology templates already read in this virtual machine,
+	// keyed by file, size and modification date: each atlas gets its own copy,
+	// as the shape priors are deformed in place when registered to an image
+	private static final Map<String,float[]>	loadedShapes = new HashMap<String,float[]>();
+	private static final Map<String,byte[]>		loadedTemplates = new HashMap<String,byte[]>();
+	
 	// for debug and display
 	private static final boolean		debug=false;
 	private static final boolean		verbose=true;
@@ -596,6 +602,51 @@ public class SimpleShapeAtlas2 {
 		
 		return output;	
 	}
+	private static final String fileKey(String fileobjName, int Nx, int Ny, int Nz) {
+		File f = new File(fileobjName);
+		return f.getAbsolutePath()+":"+f.length()+":"+f.lastModified()+":"+Nx+"x"+Ny+"x"+Nz;
+	}
+	
+	/**
+	 *	copy of the template image, only read from its file the first time
+	 */
+	private final byte[] cachedTemplateImage(String fileobjName, int Nx, int Ny, int Nz) {
+		String key = fileKey(fileobjName, Nx, Ny, Nz);
+		byte[] img;
+		synchronized (loadedTemplates) {
+			img = loadedTemplates.get(key);
+		}
+		if (img==null) {
+			img = loadTemplateImage(fileobjName, Nx, Ny, Nz);
+			// never keep a failed read for the next atlases
+			if (img==null) throw new RuntimeException("could not read the topology template "+fileobjName);
+			synchronized (loadedTemplates) {
+				loadedTemplates.put(key, img);
+			}
+		}
+		return img.clone();
+	}
+	
+	/**
+	 *	copy of the shape image, only read from its file the first time
+	 */
+	private final float[] cachedShapeImage(String fileobjName, int Nx, int Ny, int Nz) {
+		String key = fileKey(fileobjName, Nx, Ny, Nz);
+		float[] img;
+		synchronized (loadedShapes) {
+			img = loadedShapes.get(key);
+		}
+		if (img==null) {
+			img = loadShapeImage(fileobjName, Nx, Ny, Nz);
+			// never keep a failed read for the next atlases
+			if (img==null) throw new RuntimeException("could not read the shape prior "+fileobjName);
+			synchronized (loadedShapes) {
+				loadedShapes.put(key, img);
+			}
+		}
+		return img.clone();
+	}
+	
 	/**
 	 *	read template image (the image must be in bytes)
 	 */
@@ -609,10 +660,12 @@ public class SimpleShapeAtlas2 {
           FileInputStream fis = new FileInputStream( f );
             
 		   buffer = new byte[Nx*Ny*Nz];
-		   fis.read(buffer);
+		   new DataInputStream(fis).readFully(buffer);
            fis.close();
 		} catch (IOException io) {
            System.out.println("i/o pb: "+io.getMessage());
+           // missing or truncated file
+           buffer = null;
 		}
 		return buffer;
 	}
@@ -628,10 +681,12 @@ public class SimpleShapeAtlas2 {
            FileInputStream fis = new FileInputStream( f );
             
 		   buffer = new byte[4*Nx*Ny*Nz];
-		   fis.read(buffer);
+		   new DataInputStream(fis).readFully(buffer);
            fis.close();
 		} catch (IOException io) {
            System.out.println("i/o pb: "+io.getMessage());
+           // missing or truncated file
+           return null;
 		}
 		// convert to the image format
 		float [] img  = new float[Nx*Ny*Nz];
@@ -774,7 +829,7 @@ public class SimpleShapeAtlas2 {
 					rty = BasicInfo.getFloat(st);
 					rtz = BasicInfo.getFloat(st);
 					if (debug) System.out.print("res: "+rtx+"x"+rty+"x"+rtz+"\n");
-					template = loadTemplateImage(imageFile, ntx, nty, ntz);
+					template = cachedTemplateImage(imageFile, ntx, nty, ntz);
 					templateFile = imageFile;
 				} else
 				if (line.startsWith("Shape Atlas")) {
@@ -825,7 +880,7 @@ public class SimpleShapeAtlas2 {
 							minx[id] = 0; miny[id] = 0; minz[id] = 0;
 							maxx[id] = nax; maxy[id] = nay; maxz[id] = naz;
 			
-							shape[id] = loadShapeImage(imageFile, nax, nay, naz);
+							shape[id] = cachedShapeImage(imageFile, nax, nay, naz);
 							shapeFile[id] = imageFile;
 						}
 						line = br.readLine();
@@ -1,6 +1,8 @@
 package de.mpg.cbs.structures;
 
 import java.io.*;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
 import java.util.*;
 import java.util.zip.*;
 import java.lang.*;
@@ -55,6 +57,9 @@ public class CriticalPointLUT {
 	
 	private static final boolean	debug = true;
 	
+	// LUTs already loaded in this virtual machine, shared by all instances
+	private static final Map<String,BitSet> loaded = new HashMap<String,BitSet>();
+	
 	public CriticalPointLUT(String filename_, int size) {
 		isRegular = new BitSet(size);
 		filename = filename_;
@@ -367,6 +372,56 @@ public class CriticalPointLUT {
 	 }
 	 
 	 public final boolean loadCompressedPattern() {
+		 String key = (filepath==null) ? filename : filepath+filename;
+		 synchronized (loaded) {
+			 if (loaded.containsKey(key)) {
+				 isRegular = loaded.get(key);
+				 return true;
+			 }
+		 }
+		 if (loadUncompressedCopy() || loadCompressedFile()) {
+			 synchronized (loaded) {
+				 loaded.put(key, isRegular);
+			 }
+			 return true;
+		 }
+		 return false;
+	 }
+	 
+	 /**
+	  *	maps in memory an uncompressed copy of the LUT, if one is found
+	  *	next to the compressed file (same name without .gz)
+	  */
+	 private final boolean loadUncompressedCopy() {
+		 if (filepath==null || !filename.endsWith(".gz")) return false;
+		 File raw = new File(filepath+filename.substring(0, filename.length()-3));
+		 if (!raw.isFile() || raw.length()!=B26) return false;
+		 try {
+			 RandomAccessFile file = new RandomAccessFile(raw, "r");
+			 FileChannel channel = file.getChannel();
+			 System.out.println("Mapping LUT: "+raw.getPath());
+			 System.out.flush();
+			 MappedByteBuffer list = channel.map(FileChannel.MapMode.READ_ONLY, 0, B26);
+			 int N = 0;
+			 for (int n=0;n<B26;n++) {
+				 boolean regular = (list.get(n)==1);
+				 isRegular.set( n, regular );
+				 if (regular) N++;
+			 }
+			 if (debug) System.out.println("Simple points: "+N);
+			 channel.close();
+			 file.close();
+			 return true;
+		 } catch (IOException e ) {
+			 // use the compressed file instead
+			 System.out.println("i/o exception:");
+			 System.out.println(e.getMessage());
+			 isRegular.clear();
+			 return false;
+		 }
+	 }
+	 
+	 private final boolean loadCompressedFile() {
 		 /*
 		 URL res = null;
 		 try {
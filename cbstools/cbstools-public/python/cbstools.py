@@ -474,6 +474,29 @@ def compare_atlas_segs_priors(seg_file_orig,seg_file_new,atlas_file_orig=None,at
     #TODO: based on overlap comparison, adjust intensity priors
     return lut1
 
+def _seg_boundaries(seg_d, structure):
+    """
+    Boolean np.array of the voxels of a segmentation that have a neighbour (in the given binary structure) with a
+    different index, or that are on the border of the volume
+    """
+    import numpy as np
+
+    boundary = np.zeros(seg_d.shape, dtype=bool)
+    for side in range(seg_d.ndim):  # erosion treats the outside of the volume as another index
+        boundary[(slice(None),) * side + (0,)] = True
+        boundary[(slice(None),) * side + (-1,)] = True
+    centre = tuple(np.array(structure.shape) // 2)
+    for offset in np.argwhere(structure) - centre:
+        if tuple(offset) <= (0,) * seg_d.ndim:  # each pair of opposite neighbours is compared once
+            continue
+        first = tuple(slice(0, n - o) if o >= 0 else slice(-o, n) for n, o in zip(seg_d.shape, offset))
+        second = tuple(slice(o, n) if o >= 0 else slice(0, n + o) for n, o in zip(seg_d.shape, offset))
+        different = seg_d[first] != seg_d[second]
+        boundary[first] |= different
+        boundary[second] |= different
+    return boundary
+
+
 def seg_erode(seg_d, iterations=1, background_idx=1,
                   structure=None, min_vox_count=5, seg_null_value=0,
                   VERBOSE=False):
@@ -489,32 +512,73 @@ def seg_erode(seg_d, iterations=1, background_idx=1,
     :param seg_null_value:  value to set as null for binary erosion step (i.e., a value NOT in your segmentation index)
     :param VERBOSE:         spit out loads of text to stdout, because you can.
     :return: seg_shrunk_d   eroded (or dilated) version of segmentation
+
+    Erosions with the default structure (6-connected) or the full 3x3x3 structure are computed for all the indices at
+    once, from the city block or chessboard distance of each voxel to the boundaries between indices: a voxel is kept
+    after n erosions if it is at least n voxels away from them. Dilations and other structures erode each index in turn.
     """
 
     import scipy.ndimage as ndi
     import numpy as np
 
-    if iterations >= 0:
-        pos_iter = True
-    else:
-        iterations = iterations*-1
-        pos_iter = False
-
     if structure is None:
         structure = ndi.morphology.generate_binary_structure(3, 1)
-    if seg_null_value == 0:
-        seg_shrunk_d = np.zeros_like(seg_d)
-        temp_d = np.zeros_like(seg_d)
-    else:
-        seg_shrunk_d = np.ones_like(seg_d) * seg_null_value
-        temp_d = np.ones_like(seg_d) * seg_null_value
+    structure = np.asarray(structure, dtype=bool)
 
-    seg_idxs = np.unique(seg_d)
+    seg_idxs, seg_inv = np.unique(seg_d, return_inverse=True)
 
     if seg_null_value in seg_idxs:
         print("Shit, your null value is also an index. This will not work.")
         print("Set it to a suitably strange value that is not already an index. {0,999}")
         return None
+
+    metrics = {ndi.morphology.generate_binary_structure(seg_d.ndim, 1).tostring(): 'taxicab',
+               ndi.morphology.generate_binary_structure(seg_d.ndim, seg_d.ndim).tostring(): 'chessboard'}
+    if iterations < 0 or structure.shape != (3,) * seg_d.ndim or structure.tostring() not in metrics:
+        return _seg_erode_by_index(seg_d, seg_idxs, iterations, background_idx, structure, min_vox_count,
+                                   seg_null_value, VERBOSE)
+
+    # number of erosions each voxel survives
+    depth = ndi.distance_transform_cdt(~_seg_boundaries(seg_d, structure), metric=metrics[structure.tostring()])
+    np.minimum(depth, iterations, out=depth)
+
+    # erode each index as many times as it keeps min_vox_count voxels
+    seg_inv = seg_inv.reshape(seg_d.shape)
+    counts = np.bincount((seg_inv * (iterations + 1) + depth).ravel(),
+                         minlength=len(seg_idxs) * (iterations + 1)).reshape(len(seg_idxs), iterations + 1)
+    remaining = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]  # voxels left after 0, 1, ... erosions
+    erosions = np.sum(remaining[:, 1:] >= min_vox_count, axis=1)
+    if background_idx is not None:
+        erosions[seg_idxs == background_idx] = 0  # just keep the bckgrnd value, and be done with it
+    if VERBOSE:
+        print("Indices (erosions):")
+        print(" ".join("{0} ({1})".format(seg_idx, n) for seg_idx, n in zip(seg_idxs, erosions)))
+
+    seg_shrunk_d = np.empty_like(seg_d)
+    seg_shrunk_d.fill(seg_null_value)
+    kept = depth >= erosions[seg_inv]
+    seg_shrunk_d[kept] = seg_d[kept]
+    return seg_shrunk_d
+
+
+def _seg_erode_by_index(seg_d, seg_idxs, iterations, background_idx, structure, min_vox_count, seg_null_value,
+                        VERBOSE):
+    """
+    Erosion (or dilation) of a segmentation one index at a time, see seg_erode
+    """
+
+    import scipy.ndimage as ndi
+    import numpy as np
+
+    if iterations >= 0:
+        pos_iter = True
+    else:
+        iterations = iterations*-1
+        pos_iter = False
+
+    seg_shrunk_d = np.empty_like(seg_d)
+    seg_shrunk_d.fill(seg_null_value)
+
     if VERBOSE:
         print("Indices:")
     for seg_idx in seg_idxs:
@@ -525,7 +589,7 @@ def seg_erode(seg_d, iterations=1, background_idx=1,
             if VERBOSE:
                 print("[bckg]"),
         else:
-            temp_d[seg_d == seg_idx] = 1
+            temp_d = seg_d == seg_idx
             for idx in range(0, iterations):  # messy, does not exit the loop when already gone too far. but it still works
                 if pos_iter:
                     temp_temp_d = ndi.binary_erosion(temp_d, iterations=1, structure=structure)
@@ -538,8 +602,7 @@ def seg_erode(seg_d, iterations=1, background_idx=1,
                 else:
                     if VERBOSE:
                         print("[no]"),
-            seg_shrunk_d[temp_d == 1] = seg_idx
-            temp_d[:, :, :] = seg_null_value
+            seg_shrunk_d[temp_d] = seg_idx
             if VERBOSE:
                 print(seg_idx)
         if VERBOSE:
@@ -547,6 +610,10 @@ def seg_erode(seg_d, iterations=1, background_idx=1,
     return seg_shrunk_d
 
 
+# number of indices above which extract_metrics_from_seg sorts the values by index once, rather than masking the
+# values of each index (both take about as long for 30 indices)
+_MAX_MASKED_INDICES = 32
+
 def extract_metrics_from_seg(seg_d, metric_d, seg_idxs=None,norm_data=True,
                              background_idx=1, seg_null_value=0,
                              percentile_top_bot=[75, 25],
@@ -564,33 +631,110 @@ def extract_metrics_from_seg(seg_d, metric_d, seg_idxs=None,norm_data=True,
     :param return_normed_metric_d:  return the normalised metric as an np matrix, must also set norm_data=True
     :return: seg_idxs, res          segmentation indices and results matrix of median, 75, 25 percentliles
              (metric_d)             optional metric_d scaled between 0 and 1
+
+    The voxels are coded by index once, and the three percentiles of each index are interpolated as np.percentile
+    does from a single partition of its values. The values of each index are selected with a mask of the codes, or
+    from a single sort of the values by index when there are more than _MAX_MASKED_INDICES indices. Indices without voxels, or with NaN values, get NaN.
     """
     import numpy as np
     if seg_idxs is None:
         seg_idxs = np.unique(seg_d)
     if (seg_null_value is not None) and (seg_null_value in seg_idxs): #remove the null value from the idxs so we don't look
         np.delete(seg_idxs,np.where(seg_idxs==seg_null_value))
-    res = np.zeros((len(seg_idxs), 3))
 
     if norm_data:  # rescale the data to 0
         if background_idx is not None:  # we need to exclude the background data from the norming
-            metric_d[seg_d != background_idx] = (metric_d[seg_d != background_idx] - np.min(
-                metric_d[seg_d != background_idx])) / (np.max(metric_d[seg_d != background_idx]) - np.min(
-                metric_d[seg_d != background_idx]))
+            foreground = seg_d != background_idx
+            values = metric_d[foreground]
+            metric_d[foreground] = (values - np.min(values)) / (np.max(values) - np.min(values))
         else:
             metric_d = (metric_d - np.min(metric_d)) / (np.max(metric_d) - np.min(metric_d))
 
-    for idx, seg_idx in enumerate(seg_idxs):
-        d_1d = np.ndarray.flatten(metric_d[seg_d == seg_idx])
-        res[idx, :] = [np.median(d_1d),
-                       np.percentile(d_1d, np.max(percentile_top_bot)),
-                       np.percentile(d_1d, np.min(percentile_top_bot))]
+    # code the voxels by index (len(idxs) outside of the indices), with a look-up table for integer indices
+    idxs, idxs_inv = np.unique(np.asarray(seg_idxs), return_inverse=True)
+    labels = np.ravel(seg_d)
+    code_type = np.min_scalar_type(len(idxs))
+    if len(idxs) > 0 and np.issubdtype(labels.dtype, np.integer) and idxs.dtype.kind in 'iu' and \
+            idxs.min() >= 0 and labels.min() >= 0 and max(labels.max(), idxs.max()) < (1 << 24):
+        lut = np.empty(max(labels.max(), idxs.max()) + 1, dtype=code_type)
+        lut.fill(len(idxs))
+        lut[idxs] = np.arange(len(idxs))
+        codes = lut[labels]
+    else:
+        codes = np.searchsorted(idxs, labels)
+        codes[codes == len(idxs)] = 0
+        codes = np.where(idxs[codes] == labels, codes, len(idxs)).astype(code_type)
+
+    values = np.ravel(metric_d)
+    counts = np.bincount(codes, minlength=len(idxs) + 1)
+    if np.isnan(values).any():
+        nans = np.bincount(codes, weights=np.isnan(values), minlength=len(idxs) + 1)
+    else:
+        nans = np.zeros(len(idxs) + 1)
+    if len(idxs) > _MAX_MASKED_INDICES:
+        # sort the values by index once, each index having a run of values
+        starts = np.cumsum(counts) - counts
+        sorted_values = values[np.argsort(codes, kind='quicksort')]
+
+    res = np.empty((len(idxs), 3))
+    res.fill(np.nan)
+    percentiles = np.array([50, np.max(percentile_top_bot), np.min(percentile_top_bot)])
+    for idx in range(len(idxs)):
+        if counts[idx] == 0 or nans[idx] > 0:
+            continue
+        if len(idxs) > _MAX_MASKED_INDICES:
+            d_1d = sorted_values[starts[idx]:starts[idx] + counts[idx]]
+        else:
+            d_1d = values[codes == idx]
+        # linear interpolation between the closest ranks, as np.percentile, with a single partition of the values
+        rank = (counts[idx] - 1) * (percentiles / 100.0)
+        below = np.floor(rank).astype(np.intp)
+        above = np.minimum(below + 1, counts[idx] - 1)
+        d_1d = np.partition(d_1d, np.union1d(below, above))
+        weight = rank - below
+        res[idx, :] = d_1d[below] * (1 - weight) + d_1d[above] * weight
+    res = res[idxs_inv]
+
     if return_normed_metric_d:
         return seg_idxs, res, metric_d
     else:
         return seg_idxs, res
 
 
+# atlas files already read, keyed by path and modification time
+_atlases = {}
+
+def _read_atlas(atlas_file):
+    """
+    Reads an MGDM segmentation priors atlas file once, and returns the line index and rows of its lut, and the line
+    index and rows of each intensity prior (in the order of the file). The file is only read again if it is modified.
+
+    :param atlas_file:      full path to atlas file
+    :return: atlas          dict with lut_idx, lut (list of [name, index, type]) and priors (list of
+                            [contrast_name, con_idx, rows of [name, median, spread, weight]])
+    """
+    import os
+
+    atlas_file = os.path.abspath(atlas_file)
+    key = (atlas_file, os.path.getmtime(atlas_file))
+    if key not in _atlases:
+        fp = open(atlas_file)
+        lines = [line.split() for line in fp]
+        fp.close()
+        atlas = {'lut_idx': None, 'lut': [], 'priors': []}
+        for i, line in enumerate(lines):
+            if len(line) > 1 and line[0] == "Structures:":  # this is the beginning of the LUT
+                atlas['lut_idx'] = i
+                atlas['lut'] = [[row[0], int(row[1]), row[2]] for row in lines[i + 1:i + 1 + int(line[1])]]
+            elif len(line) > 2 and line[0] == "Intensity" and line[1] == "Prior:":
+                rows = [[row[0]] + map(float, row[1:4]) for row in lines[i + 1:i + 1 + len(atlas['lut'])]]
+                atlas['priors'].append([line[-1], i, rows])
+        for old in [old for old in _atlases if old[0] == atlas_file]:
+            del _atlases[old]
+        _atlases[key] = atlas
+    return _atlases[key]
+
+
 def extract_lut_priors_from_atlas(atlas_file,contrast_name):
     """
     Given an MGDM segmentation priors atlas file, extract the lut and identify the start index (in the file) of the
@@ -603,27 +747,21 @@ def extract_lut_priors_from_atlas(atlas_file,contrast_name):
     """
     import pandas as pd
 
-    fp = open(atlas_file)
-    for i, line in enumerate(fp):
-        if "Structures:" in line:  # this is the beginning of the LUT
-            lut_idx = i
-            lut_rows = map(int, [line.split()[1]])[0] + 1 #+1 to ensure that the last line is included
-        if "Intensity Prior:" in line:
-            if contrast_name in line:
-                con_idx = i
-    fp.close()
+    atlas = _read_atlas(atlas_file)
+    lut_rows = len(atlas['lut']) + 1 #+1 to ensure that the last line is included
+    for name, idx, rows in atlas['priors']:
+        if contrast_name in name:
+            con_idx = idx
+            prior_rows = rows
 
     # dump lut and priors values into pandas dataframes
-    lut = pd.read_csv(atlas_file, sep="\t+",
-                      skiprows=lut_idx + 1, nrows=lut_rows, engine='python',
-                      names=["Index", "Type"])
+    lut = pd.DataFrame([row[1:] for row in atlas['lut']], index=[row[0] for row in atlas['lut']],
+                       columns=["Index", "Type"])
 
-    priors = pd.read_csv(atlas_file, sep="\t+",
-                         skiprows=con_idx + 1, nrows=lut_rows, engine='python',
-                         names=["Median", "Spread", "Weight"])
+    priors = pd.DataFrame([row[1:] for row in prior_rows], index=[row[0] for row in prior_rows],
+                          columns=["Median", "Spread", "Weight"])
     return lut,con_idx,lut_rows,priors
 
-
 def write_priors_to_atlas(prior_medians,prior_quart_diffs,atlas_file,new_atlas_file,metric_contrast_name):
     """
     Write modified priors of given metric contrast to new_atlas
@@ -758,16 +896,7 @@ def get_MGDM_seg_contrast_names(atlas_file):
     :param atlas_file:              atlas file
     :return: seg_contrast_names     list of names of contrasts that have intensity priors available
     """
-    seg_contrast_names = []
-    fp = open(atlas_file)
-    for i, line in enumerate(fp):
-        if "Structures:" in line:  # this is the beginning of the LUT
-            lut_idx = i
-            lut_rows = map(int, [line.split()[1]])[0]
-        if "Intensity Prior:" in line:
-            seg_contrast_names.append(line.split()[-1])
-    fp.close()
-    return seg_contrast_names
+    return [name for name, idx, rows in _read_atlas(atlas_file)['priors']]
 
 
 def generate_group_intensity_priors(orig_seg_files,metric_files,metric_contrast_name,
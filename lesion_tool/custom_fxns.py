@@ -49,9 +49,9 @@ def convertLabels(src_label_img, conversion_csv, src_val_colname, trg_val_colnam
     import numpy as np
     import nibabel as nib
     from six import string_types
+    from nighres.segmentation import remap_labels
 
     src_img = nib.load(src_label_img) if isinstance(src_label_img, string_types) else src_label_img
-    src_im_dat = np.int16(np.asanyarray(src_img.dataobj))
     
     conversion_df = pd.read_csv(conversion_csv)
     try:
@@ -60,12 +60,10 @@ def convertLabels(src_label_img, conversion_csv, src_val_colname, trg_val_colnam
     except Exception as exc:
         print("Failed to generate conversion dict from the provided csv and specified column names")
         print(exc)
+        raise
         
-    trg_im_dat = np.zeros_like(src_im_dat)
-    for src_val, trg_val in src_to_targ_dict.items():
-        ijk = np.nonzero(src_im_dat == np.int16(src_val))
-        if ijk:
-            trg_im_dat[ijk] = np.int16(trg_val)
+    trg_img = remap_labels(src_img, src_to_targ_dict, default=0, dtype=np.int16)
+    trg_im_dat = trg_img.get_data()
     
     header = src_img.header.copy()
     header['cal_min'], header['cal_max'] = trg_im_dat.min(), trg_im_dat.max()     
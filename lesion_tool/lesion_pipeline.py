@@ -6,15 +6,11 @@ The first basic pipeline for extraction of the WMH from T1/T2 FLAIR.
 import os
 import cbstools
 from nipype.pipeline.engine import Workflow, Node
-from nipype.interfaces.base import traits, File
 from nipype.interfaces.utility import IdentityInterface, Function
 from nipype.interfaces.io import DataGrabber, FreeSurferSource
 from nipype.interfaces.ants.segmentation import N4BiasFieldCorrection
 from nipype.interfaces.fsl.preprocess import BET, FLIRT
-from nipype.interfaces.fsl.maths import ApplyMask, Threshold, UnaryMaths
-from nipype.interfaces.fsl.utils import ImageMaths, Reorient2Std, Split
-from nipype.interfaces.fsl.base import FSLCommandInputSpec
-from nipype.interfaces.fsl import ImageStats
+from nipype.interfaces.fsl.utils import Reorient2Std
 from nipype.interfaces.freesurfer.preprocess import MRIConvert, FreeSurferSource
 from nipype.interfaces.utility import Function
 
@@ -22,26 +18,10 @@ from .custom_fxns import convertLabels
 
 #import nighres
 from nighres.nighres.wrappers import MGDMSegmentation, EnhanceRegionContrast, ProbabilityToLevelset, DefineMultiRegionPriors, \
-                                     RecursiveRidgeDiffusion, LesionExtraction, DistanceBasedProbability
+                                     RecursiveRidgeDiffusion, LesionExtraction, DistanceBasedProbability, \
+                                     VoxelExpression
+from nighres.nighres.utils import _compression
 
-class AbcImageMathsInputSpec(FSLCommandInputSpec):
-    in_file = File(exists=True, argstr="%s", mandatory=True, position=1)
-    #in_file2 = File(exists=True, argstr="%s", position=3)
-    out_file = File(argstr="%s", position=4, genfile=True, hash_files=False)
-    op_string = traits.Str(argstr="%s", position=2,
-                           desc="string defining the operation, i. e. -add")
-    op_value = traits.Float(argstr="%.4f",position=3,des="value to perform operation with")
-    suffix = traits.Str(desc="out_file suffix")
-    out_data_type = traits.Enum('char', 'short', 'int', 'float', 'double',
-                               'input', argstr="-odt %s", position=5,
-                               desc=("output datatype, one of (char, short, "
-                                     "int, float, double, input)"))
-
-class AbcImageMaths(ImageMaths):
-    
-    input_spec = AbcImageMathsInputSpec
-    #output_spec = ImageMathsOutputSpec
-    
 def getElementFromList(inlist,idx,slc=None):
     '''
     For selecting a particular element or slice from a list 
@@ -86,6 +66,12 @@ def Lesion_extractor(name='Lesion_Extractor',
     wf = Workflow(wf_name)
     wf.base_dir = base_dir
     
+    # intermediate images are compressed as the outputs of the nighres modules
+    # (NIGHRES_COMPRESSION, see nighres.io.configure_compression), the final
+    # masks always are
+    compress = _compression() == 'gzip'
+    ext = '.nii.gz' if compress else '.nii'
+    
     if len(subjects) > 1:
         single = False
     else:
@@ -134,13 +120,13 @@ def Lesion_extractor(name='Lesion_Extractor',
     # Reorient Volume
     T1Conv = Node(Reorient2Std(), name="ReorientVolume")
     T1Conv.inputs.ignore_exception = False
-    T1Conv.inputs.out_file = "T1_reoriented.nii.gz"
+    T1Conv.inputs.out_file = "T1_reoriented" + ext
     wf.connect(scanList, "T1", T1Conv, "in_file")
     
     # Reorient Volume (2)
     T2flairConv = Node(Reorient2Std(), name="ReorientVolume2")
     T2flairConv.inputs.ignore_exception = False
-    T2flairConv.inputs.out_file = "FLAIR_reoriented.nii.gz"
+    T2flairConv.inputs.out_file = "FLAIR_reoriented" + ext
     wf.connect(scanList, "FLAIR", T2flairConv, "in_file")
     
     # N3 Correction
@@ -169,24 +155,16 @@ def Lesion_extractor(name='Lesion_Extractor',
     '''
     
     # Intensity Range Normalization
-    getMaxT1NUC = Node(ImageStats(op_string= '-r'), name="getMaxT1NUC")
-    wf.connect(T1NUC,'output_image',getMaxT1NUC,'in_file')
-    
-    T1NUCirn = Node(AbcImageMaths(),name="IntensityNormalization")
-    T1NUCirn.inputs.op_string = "-div"
-    T1NUCirn.inputs.out_file = "normT1.nii.gz"
-    wf.connect(T1NUC,'output_image',T1NUCirn,'in_file')
-    wf.connect(getMaxT1NUC,('out_stat',getElementFromList,1),T1NUCirn,"op_value")
+    T1NUCirn = Node(VoxelExpression(image_names=['t1']), name="IntensityNormalization")
+    T1NUCirn.inputs.expression = "t1 / percentile(t1, 98)"
+    T1NUCirn.inputs.out_file = "normT1" + ext
+    wf.connect(T1NUC,'output_image',T1NUCirn,'t1')
     
     # Intensity Range Normalization (2)
-    getMaxT2NUC = Node(ImageStats(op_string= '-r'), name="getMaxT2NUC")
-    wf.connect(T2flairNUC,'output_image',getMaxT2NUC,'in_file')
-    
-    T2NUCirn = Node(AbcImageMaths(),name="IntensityNormalization2")
-    T2NUCirn.inputs.op_string = "-div"
-    T2NUCirn.inputs.out_file = "normT2.nii.gz"
-    wf.connect(T2flairNUC,'output_image',T2NUCirn,'in_file')
-    wf.connect(getMaxT2NUC,('out_stat',getElementFromList,1),T2NUCirn,"op_value")
+    T2NUCirn = Node(VoxelExpression(image_names=['t2']), name="IntensityNormalization2")
+    T2NUCirn.inputs.expression = "t2 / percentile(t2, 98)"
+    T2NUCirn.inputs.out_file = "normT2" + ext
+    wf.connect(T2flairNUC,'output_image',T2NUCirn,'t2')
     
     '''
     ########################
@@ -196,7 +174,7 @@ def Lesion_extractor(name='Lesion_Extractor',
     
     # Optimized Automated Registration
     T2flairCoreg = Node(FLIRT(), name="OptimizedAutomatedRegistration")
-    T2flairCoreg.inputs.output_type = 'NIFTI_GZ'
+    T2flairCoreg.inputs.output_type = 'NIFTI_GZ' if compress else 'NIFTI'
     wf.connect(T2NUCirn, "out_file", T2flairCoreg, "in_file")
     wf.connect(T1NUCirn, "out_file", T2flairCoreg, "reference")
 
@@ -209,7 +187,7 @@ def Lesion_extractor(name='Lesion_Extractor',
     fsAseg = Node(MRIConvert(), name="fsAseg")
     fsAseg.inputs.ignore_exception = False
     fsAseg.inputs.out_datatype = 'float'
-    fsAseg.inputs.out_type = 'niigz'
+    fsAseg.inputs.out_type = 'niigz' if compress else 'nii'
     fsAseg.inputs.resample_type = 'nearest'
     fsAseg.inputs.subjects_dir = fs_subjects_dir
     wf.connect(fsSource, "aseg", fsAseg, "in_file")
@@ -218,7 +196,7 @@ def Lesion_extractor(name='Lesion_Extractor',
     fsBrainmask = Node(MRIConvert(), name="fsBrainmask")
     fsBrainmask.inputs.ignore_exception = False
     fsBrainmask.inputs.out_datatype = 'float'
-    fsBrainmask.inputs.out_type = 'niigz'
+    fsBrainmask.inputs.out_type = 'niigz' if compress else 'nii'
     fsBrainmask.inputs.resample_type = 'nearest'
     fsBrainmask.inputs.subjects_dir = fs_subjects_dir
     wf.connect(fsSource, "brainmask", fsBrainmask, "in_file")
@@ -239,23 +217,20 @@ def Lesion_extractor(name='Lesion_Extractor',
 #    T1ss.inputs.robust = True
 #    wf.connect(T1NUCirn, "out_file", T1ss, "in_file")
     
-    # Since fsBrainmask is actually not a mask but a skull-stripped brain, make
-    # mask by binarizing (note that in MRiSHARE pipe we also erode and dialate this...)
-    binFsMask = Node(UnaryMaths(), name="binFsMask")
-    binFsMask.inputs.operation = 'bin'
-    binFsMask.inputs.output_type = 'NIFTI_GZ'
-    binFsMask.inputs.nan2zeros = True
-    wf.connect(fsBrainmask, "out_file", binFsMask, "in_file")
-    
-    T1ss = Node(ApplyMask(), name="T1ss")
-    wf.connect(binFsMask, "out_file", T1ss, "mask_file")
-    wf.connect(T1NUCirn, "out_file", T1ss, "in_file")
+    # Since fsBrainmask is actually not a mask but a skull-stripped brain, mask
+    # with its positive voxels (note that in MRiSHARE pipe we also erode and dialate this...)
+    T1ss = Node(VoxelExpression(image_names=['t1', 'brain']), name="T1ss")
+    T1ss.inputs.expression = "where(brain > 0, t1, 0)"
+    T1ss.inputs.out_file = "T1ss" + ext
+    wf.connect(fsBrainmask, "out_file", T1ss, "brain")
+    wf.connect(T1NUCirn, "out_file", T1ss, "t1")
     
     # Image Calculator
-    T2ss = Node(ApplyMask(), name="T2ss")
-#    wf.connect(T1ss, "mask_file", T2ss, "mask_file")
-    wf.connect(binFsMask, "out_file", T2ss, "mask_file")
-    wf.connect(T2flairCoreg, "out_file", T2ss, "in_file")
+    T2ss = Node(VoxelExpression(image_names=['t2', 'brain']), name="T2ss")
+    T2ss.inputs.expression = "where(brain > 0, t2, 0)"
+    T2ss.inputs.out_file = "T2ss" + ext
+    wf.connect(fsBrainmask, "out_file", T2ss, "brain")
+    wf.connect(T2flairCoreg, "out_file", T2ss, "t2")
     
     '''
     ####################################
@@ -292,24 +267,16 @@ def Lesion_extractor(name='Lesion_Extractor',
     '''
     
     # Intensity Range Normalization
-    getMaxT1ssNUC = Node(ImageStats(op_string= '-r'), name="getMaxT1ssNUC")
-    wf.connect(T1ssNUC,'output_image',getMaxT1ssNUC,'in_file')
-    
-    T1ssNUCirn = Node(AbcImageMaths(),name="IntensityNormalization3")
-    T1ssNUCirn.inputs.op_string = "-div"
-    T1ssNUCirn.inputs.out_file = "normT1ss.nii.gz"
-    wf.connect(T1ssNUC,'output_image',T1ssNUCirn,'in_file')
-    wf.connect(getMaxT1ssNUC,('out_stat',getElementFromList,1),T1ssNUCirn,"op_value")
+    T1ssNUCirn = Node(VoxelExpression(image_names=['t1']), name="IntensityNormalization3")
+    T1ssNUCirn.inputs.expression = "t1 / percentile(t1, 98)"
+    T1ssNUCirn.inputs.out_file = "normT1ss" + ext
+    wf.connect(T1ssNUC,'output_image',T1ssNUCirn,'t1')
     
     # Intensity Range Normalization (2)
-    getMaxT2ssNUC = Node(ImageStats(op_string= '-r'), name="getMaxT2ssNUC")
-    wf.connect(T2ssNUC,'output_image',getMaxT2ssNUC,'in_file')
-    
-    T2ssNUCirn = Node(AbcImageMaths(),name="IntensityNormalization4")
-    T2ssNUCirn.inputs.op_string = "-div"
-    T2ssNUCirn.inputs.out_file = "normT2ss.nii.gz"
-    wf.connect(T2ssNUC,'output_image',T2ssNUCirn,'in_file')
-    wf.connect(getMaxT2ssNUC,('out_stat',getElementFromList,1),T2ssNUCirn,"op_value")
+    T2ssNUCirn = Node(VoxelExpression(image_names=['t2']), name="IntensityNormalization4")
+    T2ssNUCirn.inputs.expression = "t2 / percentile(t2, 98)"
+    T2ssNUCirn.inputs.out_file = "normT2ss" + ext
+    wf.connect(T2ssNUC,'output_image',T2ssNUCirn,'t2')
     
     '''
     ####################################
@@ -432,67 +399,28 @@ def Lesion_extractor(name='Lesion_Extractor',
 #     PostLabel.inputs.dimension = "t"
 #     wf.connect(FSlabels2MGDM,'new_label_img', PostLabel,'in_file')
 
-    # Posterior proba
-    PostProba = Node(Split(),name='PosteriorProba')
-    PostProba.inputs.dimension = "t"
-    wf.connect(BoundMap,'prob_image', PostProba,'in_file')
-    
-    # Threshold binary mask : ventricle label part 1
-    VentLabel1 = Node(Threshold(), name="VentricleLabel1")
-    VentLabel1.inputs.thresh = 10.5
-    VentLabel1.inputs.direction = "below"
-    wf.connect(FSlabels2MGDM,'new_label_img', VentLabel1, "in_file")
-    
-    # Threshold binary mask : ventricle label part 2
-    VentLabel2 = Node(Threshold(), name="VentricleLabel2")
-    VentLabel2.inputs.thresh = 13.5
-    VentLabel2.inputs.direction = "above"
-    wf.connect(VentLabel1,"out_file", VentLabel2, "in_file")
-    
-    # Image calculator : ventricle proba
-    VentProba = Node(ImageMaths(), name="VentricleProba")
-    VentProba.inputs.op_string = "-mul"
-    VentProba.inputs.out_file = "ventproba.nii.gz"
-    wf.connect(PostProba,("out_files",getFirstElement),VentProba,"in_file")
-    wf.connect(VentLabel2,"out_file", VentProba, "in_file2")
-    
-    # Image calculator : remove inter ventricles
-    RmInterVent = Node(ImageMaths(), name="RemoveInterVent")
-    RmInterVent.inputs.op_string = "-sub"
-    RmInterVent.inputs.out_file = "rmintervent.nii.gz"
-    wf.connect(ERC,"region_pv",RmInterVent,"in_file")
-    wf.connect(DMRP, "inter_ventricular_pv", RmInterVent, "in_file2")
-    
-    # Image calculator : add horns
-    AddHorns = Node(ImageMaths(), name="AddHorns")
-    AddHorns.inputs.op_string = "-add"
-    AddHorns.inputs.out_file = "rmvent.nii.gz"
-    wf.connect(RmInterVent,"out_file",AddHorns,"in_file")
-    wf.connect(DMRP, "ventricular_horns_pv", AddHorns, "in_file2")  
-    
-    # Image calculator : remove ventricles
-    RmVent = Node(ImageMaths(), name="RemoveVentricles")
-    RmVent.inputs.op_string = "-sub"
-    RmVent.inputs.out_file = "rmvent.nii.gz"
-    wf.connect(AddHorns,"out_file",RmVent,"in_file")
-    wf.connect(VentProba, "out_file", RmVent, "in_file2")  
-    
-    # Image calculator : remove internal capsule
-    RmIC = Node(ImageMaths(), name="RemoveInternalCap")
-    RmIC.inputs.op_string = "-sub"
-    RmIC.inputs.out_file = "rmic.nii.gz"
-    wf.connect(RmVent,"out_file",RmIC,"in_file")
-    wf.connect(DMRP, "internal_capsule_pv", RmIC, "in_file2")
-    
-    # Intensity Range Normalization (3)
-    getMaxRmIC = Node(ImageStats(op_string= '-r'), name="getMaxRmIC")
-    wf.connect(RmIC,'out_file',getMaxRmIC,'in_file')
-     
-    RmICirn = Node(AbcImageMaths(),name="IntensityNormalization5")
-    RmICirn.inputs.op_string = "-div"
-    RmICirn.inputs.out_file = "normRmIC.nii.gz"
-    wf.connect(RmIC,'out_file',RmICirn,'in_file')
-    wf.connect(getMaxRmIC,('out_stat',getElementFromList,1),RmICirn,"op_value")
+    # Image calculator : ventricle proba, from the first posterior proba and
+    # the ventricle labels (thresholded between 10.5 and 13.5)
+    VentProba = Node(VoxelExpression(image_names=['proba', 'labels']), name="VentricleProba")
+    VentProba.inputs.expression = "proba[0] * where((labels >= 10.5) & (labels <= 13.5), labels, 0)"
+    VentProba.inputs.out_file = "ventproba" + ext
+    wf.connect(BoundMap,'prob_image',VentProba,"proba")
+    wf.connect(FSlabels2MGDM,'new_label_img',VentProba,"labels")
+    
+    # Image calculator : remove inter ventricles, add horns, remove ventricles
+    # and internal capsule, then Intensity Range Normalization (3) by the 98th
+    # percentile of the voxels inside the prior (most of the image is 0)
+    RmICirn = Node(VoxelExpression(image_names=['region', 'intervent', 'horns', 'vent', 'ic']),
+                   name="IntensityNormalization5")
+    RmICirn.inputs.expression = ("(region - intervent + horns - vent - ic)"
+                                 " / percentile(where(region - intervent + horns - vent - ic > 0,"
+                                 " region - intervent + horns - vent - ic, nan), 98)")
+    RmICirn.inputs.out_file = "normRmIC" + ext
+    wf.connect(ERC,"region_pv",RmICirn,"region")
+    wf.connect(DMRP, "inter_ventricular_pv", RmICirn, "intervent")
+    wf.connect(DMRP, "ventricular_horns_pv", RmICirn, "horns")
+    wf.connect(VentProba, "out_file", RmICirn, "vent")
+    wf.connect(DMRP, "internal_capsule_pv", RmICirn, "ic")
     
     # Probability To Levelset : WM orientation
     WM_Orient = Node(ProbabilityToLevelset(),name='WM_Orientation')
@@ -543,29 +471,17 @@ def Lesion_extractor(name='Lesion_Extractor',
     2nd branch
     '''
     
-    # Image calculator : internal capsule witout ventricules
-    ICwoVent = Node(ImageMaths(), name="ICWithoutVentricules")
-    ICwoVent.inputs.op_string = "-sub"
-    ICwoVent.inputs.out_file = "icwovent.nii.gz"
-    wf.connect(DMRP,"internal_capsule_pv",ICwoVent,"in_file")
-    wf.connect(DMRP,"inter_ventricular_pv", ICwoVent, "in_file2")
-    
-    # Image calculator : remove ventricles IC
-    RmVentIC = Node(ImageMaths(), name="RmVentIC")
-    RmVentIC.inputs.op_string = "-sub"
-    RmVentIC.inputs.out_file = "RmVentIC.nii.gz"
-    wf.connect(ICwoVent,"out_file",RmVentIC,"in_file")
-    wf.connect(VentProba, "out_file", RmVentIC, "in_file2")
-
-    # Intensity Range Normalization (4)
-    getMaxRmVentIC = Node(ImageStats(op_string= '-r'), name="getMaxRmVentIC")
-    wf.connect(RmVentIC,'out_file',getMaxRmVentIC,'in_file')
-     
-    RmVentICirn = Node(AbcImageMaths(),name="IntensityNormalization6")
-    RmVentICirn.inputs.op_string = "-div"
-    RmVentICirn.inputs.out_file = "normRmVentIC.nii.gz"
-    wf.connect(RmVentIC,'out_file',RmVentICirn,'in_file')
-    wf.connect(getMaxRmVentIC,('out_stat',getElementFromList,1),RmVentICirn,"op_value")
+    # Image calculator : internal capsule witout ventricules, then
+    # Intensity Range Normalization (4) over the voxels inside the prior
+    RmVentICirn = Node(VoxelExpression(image_names=['ic', 'intervent', 'vent']),
+                       name="IntensityNormalization6")
+    RmVentICirn.inputs.expression = ("(ic - intervent - vent)"
+                                     " / percentile(where(ic - intervent - vent > 0,"
+                                     " ic - intervent - vent, nan), 98)")
+    RmVentICirn.inputs.out_file = "normRmVentIC" + ext
+    wf.connect(DMRP,"internal_capsule_pv",RmVentICirn,"ic")
+    wf.connect(DMRP,"inter_ventricular_pv", RmVentICirn, "intervent")
+    wf.connect(VentProba, "out_file", RmVentICirn, "vent")
     
     # Probability To Levelset : IC orientation
     IC_Orient = Node(ProbabilityToLevelset(),name='IC_Orientation')
@@ -616,29 +532,17 @@ def Lesion_extractor(name='Lesion_Extractor',
     3rd branch
     '''
     
-    # Image calculator :
-    RmInter = Node(ImageMaths(), name="RemoveInterVentricules")
-    RmInter.inputs.op_string = "-sub"
-    RmInter.inputs.out_file = "rminter.nii.gz"
-    wf.connect(ERC2,'region_pv',RmInter,"in_file")
-    wf.connect(DMRP,"inter_ventricular_pv", RmInter, "in_file2")
-    
-    # Image calculator :
-    AddVentHorns = Node(ImageMaths(), name="AddVentHorns")
-    AddVentHorns.inputs.op_string = "-add"
-    AddVentHorns.inputs.out_file = "rminter.nii.gz"
-    wf.connect(RmInter,'out_file',AddVentHorns,"in_file")
-    wf.connect(DMRP,"ventricular_horns_pv", AddVentHorns, "in_file2")
-    
-    # Intensity Range Normalization (5)
-    getMaxAddVentHorns = Node(ImageStats(op_string= '-r'), name="getMaxAddVentHorns")
-    wf.connect(AddVentHorns,'out_file',getMaxAddVentHorns,'in_file')
-     
-    AddVentHornsirn = Node(AbcImageMaths(),name="IntensityNormalization7")
-    AddVentHornsirn.inputs.op_string = "-div"
-    AddVentHornsirn.inputs.out_file = "normAddVentHorns.nii.gz"
-    wf.connect(AddVentHorns,'out_file',AddVentHornsirn,'in_file')
-    wf.connect(getMaxAddVentHorns,('out_stat',getElementFromList,1),AddVentHornsirn,"op_value")
+    # Image calculator : remove inter ventricles, add horns, then
+    # Intensity Range Normalization (5) over the voxels inside the prior
+    AddVentHornsirn = Node(VoxelExpression(image_names=['region', 'intervent', 'horns']),
+                           name="IntensityNormalization7")
+    AddVentHornsirn.inputs.expression = ("(region - intervent + horns)"
+                                         " / percentile(where(region - intervent + horns > 0,"
+                                         " region - intervent + horns, nan), 98)")
+    AddVentHornsirn.inputs.out_file = "normAddVentHorns" + ext
+    wf.connect(ERC2,'region_pv',AddVentHornsirn,"region")
+    wf.connect(DMRP,"inter_ventricular_pv", AddVentHornsirn, "intervent")
+    wf.connect(DMRP,"ventricular_horns_pv", AddVentHornsirn, "horns")
     
     
     # Extract Lesions : extract White Matter Hyperintensities
@@ -748,19 +652,7 @@ def Lesion_extractor(name='Lesion_Extractor',
     PVS from white matter and internal capsule
     '''
 
-    # Image calculator : WM + IC DVRS
-    DVRS = Node(ImageMaths(), name="DVRS")
-    DVRS.inputs.op_string = "-max"
-    DVRS.inputs.out_file = "DVRS_map.nii.gz"
-    wf.connect(extract_WM_pvs,'lesion_score',DVRS,"in_file")
-    wf.connect(extract_IC_pvs,"lesion_score", DVRS, "in_file2")
-    
-    # Image calculator : WMH + round
-    WMH = Node(ImageMaths(), name="WMH")
-    WMH.inputs.op_string = "-max"
-    WMH.inputs.out_file = "WMH_map.nii.gz"
-    wf.connect(extract_WMH,'lesion_score',WMH,"in_file")
-    wf.connect(extract_round_WMH,"lesion_score", WMH, "in_file2")
+    # WM + IC DVRS are combined (maximum) when thresholding them below
     
     #===========================================================================
     # WMH2 = Node(ImageMaths(), name="WMH2")
@@ -776,12 +668,13 @@ def Lesion_extractor(name='Lesion_Extractor',
     # wf.connect(extract_round_WMH3,"lesion_score", WMH3, "in_file2")
     #===========================================================================
     
-    # Image calculator : multiply by boundnary partial volume
-    WMH_mul = Node(ImageMaths(), name="WMH_mul")
-    WMH_mul.inputs.op_string = "-mul"
-    WMH_mul.inputs.out_file = "final_mask.nii.gz"
-    wf.connect(WMH,"out_file", WMH_mul,"in_file")
-    wf.connect(BoundMap,"mgdm_image", WMH_mul, "in_file2")
+    # Image calculator : WMH + round, multiply by boundnary partial volume
+    WMH_mul = Node(VoxelExpression(image_names=['wmh', 'round', 'boundary']), name="WMH_mul")
+    WMH_mul.inputs.expression = "maximum(wmh, round) * boundary"
+    WMH_mul.inputs.out_file = "final_mask" + ext
+    wf.connect(extract_WMH,'lesion_score',WMH_mul,"wmh")
+    wf.connect(extract_round_WMH,"lesion_score", WMH_mul, "round")
+    wf.connect(BoundMap,"mgdm_image", WMH_mul, "boundary")
     
     #===========================================================================
     # WMH2_mul = Node(ImageMaths(), name="WMH2_mul")
@@ -807,16 +700,17 @@ def Lesion_extractor(name='Lesion_Extractor',
     '''
     
     # Threshold binary mask : 
-    DVRS_mask = Node(Threshold(), name="DVRS_mask")
-    DVRS_mask.inputs.thresh = 0.25
-    DVRS_mask.inputs.direction = "below"
-    wf.connect(DVRS,"out_file", DVRS_mask, "in_file")
+    DVRS_mask = Node(VoxelExpression(image_names=['wm', 'ic']), name="DVRS_mask")
+    DVRS_mask.inputs.expression = "where(maximum(wm, ic) >= 0.25, maximum(wm, ic), 0)"
+    DVRS_mask.inputs.out_file = "DVRS_map_thresh.nii.gz"
+    wf.connect(extract_WM_pvs,'lesion_score',DVRS_mask,"wm")
+    wf.connect(extract_IC_pvs,"lesion_score", DVRS_mask, "ic")
     
     # Threshold binary mask : 025
-    WMH1_025 = Node(Threshold(), name="WMH1_025")
-    WMH1_025.inputs.thresh = 0.25
-    WMH1_025.inputs.direction = "below"
-    wf.connect(WMH_mul,"out_file", WMH1_025, "in_file")
+    WMH1_025 = Node(VoxelExpression(image_names=['score']), name="WMH1_025")
+    WMH1_025.inputs.expression = "where(score >= 0.25, score, 0)"
+    WMH1_025.inputs.out_file = "final_mask_thresh.nii.gz"
+    wf.connect(WMH_mul,"out_file", WMH1_025, "score")
     
     #===========================================================================
     # WMH2_025 = Node(Threshold(), name="WMH2_025")
@@ -831,10 +725,10 @@ def Lesion_extractor(name='Lesion_Extractor',
     #===========================================================================
     
     # Threshold binary mask : 050
-    WMH1_050 = Node(Threshold(), name="WMH1_050")
-    WMH1_050.inputs.thresh = 0.50
-    WMH1_050.inputs.direction = "below"
-    wf.connect(WMH_mul,"out_file", WMH1_050, "in_file")
+    WMH1_050 = Node(VoxelExpression(image_names=['score']), name="WMH1_050")
+    WMH1_050.inputs.expression = "where(score >= 0.50, score, 0)"
+    WMH1_050.inputs.out_file = "final_mask_thresh.nii.gz"
+    wf.connect(WMH_mul,"out_file", WMH1_050, "score")
     
     #===========================================================================
     # WMH2_050 = Node(Threshold(), name="WMH2_050")
@@ -849,10 +743,10 @@ def Lesion_extractor(name='Lesion_Extractor',
     #===========================================================================
     
     # Threshold binary mask : 075
-    WMH1_075 = Node(Threshold(), name="WMH1_075")
-    WMH1_075.inputs.thresh = 0.75
-    WMH1_075.inputs.direction = "below"
-    wf.connect(WMH_mul,"out_file", WMH1_075, "in_file")
+    WMH1_075 = Node(VoxelExpression(image_names=['score']), name="WMH1_075")
+    WMH1_075.inputs.expression = "where(score >= 0.75, score, 0)"
+    WMH1_075.inputs.out_file = "final_mask_thresh.nii.gz"
+    wf.connect(WMH_mul,"out_file", WMH1_075, "score")
     
     #===========================================================================
     # WMH2_075 = Node(Threshold(), name="WMH2_075")
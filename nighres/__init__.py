@@ -1,3 +1,5 @@
+__version__ = '1.0.0b9'
+
 import io
 import brain
 import cortex
@@ -6,6 +8,10 @@ import laminar
 import surface
 import segmentation
 import filtering
+import jvm
+import parallel
+import cache
+import pipeline
 from global_settings import ATLAS_DIR, TOPOLOGY_LUT_DIR, DEFAULT_ATLAS
 
-__all__ = ['io', 'brain', 'laminar', 'surface', 'data', 'cortex', 'segmentation', 'filtering', '__version__']
+__all__ = ['io', 'brain', 'laminar', 'surface', 'data', 'cortex', 'segmentation', 'filtering', 'jvm', 'parallel', 'cache', 'pipeline', '__version__']
@@ -0,0 +1,159 @@
+import numpy as np
+import cbstools
+
+# numpy types matching the primitive Java arrays used by the cbstools modules
+_NATIVE_TYPES = {'float': np.float32, 'int': np.int32, 'byte': np.int8}
+
+# JCC only accepts Python floats and ints when it fills a Java array
+# element by element, so this is what the fallback path has to provide
+_PYTHON_TYPES = {'float': np.float64, 'int': np.int_}
+
+# number of elements transferred at once through the java.nio buffers, which
+# bounds the temporary copies and keeps the byte buffers well below the
+# 2^31 bytes limit of Java arrays
+_CHUNK_SIZE = 1 << 22
+
+
+def _has_nio():
+    # the java.nio buffers are only available if cbstools was wrapped with
+    # them (see build.sh), older builds fall back to element-wise copies
+    return all(hasattr(cbstools, name) for name in
+               ['ByteBuffer', 'ByteOrder', 'FloatBuffer', 'IntBuffer'])
+
+
+def _fortran_chunks(data, size):
+    # yields consecutive pieces of the Fortran-ordered flattening of the data,
+    # of at most size elements, by slicing along the slowest (last) axes so
+    # that only one piece at a time is ever copied
+    if data.size == 0:
+        return
+    if data.ndim <= 1:
+        flat = data.ravel()
+        for start in range(0, flat.size, size):
+            yield flat[start:start + size]
+        return
+    step = data.size // data.shape[-1]
+    if step > size:
+        for index in range(data.shape[-1]):
+            for chunk in _fortran_chunks(data[..., index], size):
+                yield chunk
+    else:
+        count = size // step
+        for start in range(0, data.shape[-1], count):
+            yield data[..., start:start + count].ravel(order='F')
+
+
+def _jarray_type(jarray):
+    # element type of a Java array returned by a module
+    for jtype in _NATIVE_TYPES:
+        if isinstance(jarray, cbstools.JArray(jtype)):
+            return jtype
+    raise ValueError("Only float, int and byte Java arrays can be converted")
+
+
+def to_jarray(data, jtype='float'):
+    '''
+    Converts image data into a flat Java primitive array, in the
+    Fortran (x fastest) order expected by the cbstools modules
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Image data of any shape and data type
+    jtype: {'float', 'int'}
+        Primitive type of the Java array expected by the module
+        (default is 'float')
+
+    Returns
+    ----------
+    JArray
+        Java array holding the flattened data
+
+    Notes
+    ----------
+    If cbstools provides java.nio buffers, the Java array is filled in bulk,
+    in chunks of a few million values that are cast, reordered and copied
+    one at a time, so that the temporary copies stay small whatever the size
+    of the image. Otherwise JCC fills the array element by element.
+    '''
+    if jtype not in _PYTHON_TYPES:
+        raise ValueError("jtype must be one of {0}".format(
+                         ", ".join(sorted(_PYTHON_TYPES.keys()))))
+
+    if _has_nio():
+        data = np.asanyarray(data)
+        native = _NATIVE_TYPES[jtype]
+        jarray = cbstools.JArray(jtype)(data.size)
+        offset = 0
+        for chunk in _fortran_chunks(data, _CHUNK_SIZE):
+            # wrap the raw bytes and read them back with the machine byte
+            # order, straight into their place in the Java array
+            buffer = cbstools.ByteBuffer.wrap(cbstools.JArray('byte')(
+                        np.asarray(chunk, dtype=native).tostring()))
+            buffer.order(cbstools.ByteOrder.nativeOrder())
+            if jtype == 'float':
+                buffer.asFloatBuffer().get(jarray, offset, chunk.size)
+            else:
+                buffer.asIntBuffer().get(jarray, offset, chunk.size)
+            offset += chunk.size
+        return jarray
+    else:
+        flat = np.asarray(data, dtype=_PYTHON_TYPES[jtype],
+                          order='F').ravel(order='F')
+        return cbstools.JArray(jtype)(flat)
+
+
+def from_jarray(jarray, shape, dtype=np.float32):
+    '''
+    Converts a flat Java primitive array returned by a cbstools module into
+    a NumPy array of the given shape, in Fortran (x fastest) order
+
+    Parameters
+    ----------
+    jarray: JArray
+        Java float, int or byte array returned by one of the module's
+        get*Image() methods
+    shape: tuple of int
+        Dimensions of the output array
+    dtype: np.dtype
+        Data type of the output array (default is np.float32)
+
+    Returns
+    ----------
+    np.ndarray
+        Fortran-ordered array holding the data of the Java array
+
+    Notes
+    ----------
+    The values are written into a preallocated array of the output type.
+    Byte arrays are read from their raw content, float and int arrays are
+    copied in chunks through java.nio byte buffers if cbstools provides them,
+    and read element by element otherwise. The result is a Fortran-ordered
+    view on that array, with no further reshaping copy.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'fiu':
+        raise ValueError("dtype must be a float or integer type")
+    jtype = _jarray_type(jarray)
+    native = np.dtype(_NATIVE_TYPES[jtype])
+
+    size = len(jarray)
+    flat = np.empty(size, dtype=dtype)
+    if jtype == 'byte':
+        # byte arrays (labels and masks) expose their raw content directly
+        flat[:] = np.frombuffer(jarray.string_, dtype=native)
+    elif _has_nio():
+        for offset in range(0, size, _CHUNK_SIZE):
+            count = min(_CHUNK_SIZE, size - offset)
+            buffer = cbstools.ByteBuffer.allocate(count * native.itemsize)
+            buffer.order(cbstools.ByteOrder.nativeOrder())
+            if jtype == 'float':
+                buffer.asFloatBuffer().put(jarray, offset, count)
+            else:
+                buffer.asIntBuffer().put(jarray, offset, count)
+            flat[offset:offset + count] = np.frombuffer(
+                                    buffer.array().string_, dtype=native)
+    else:
+        flat[:] = np.fromiter(jarray, dtype=native, count=size)
+
+    return flat.reshape(shape, order='F')
@@ -1,5 +1,5 @@
 from extract_brain_region import extract_brain_region
-from mgdm_segmentation import mgdm_segmentation
+from mgdm_segmentation import mgdm_segmentation, mgdm_segmentation_batch
 from mp2rage_skullstripping import mp2rage_skullstripping
 from enhance_region_contrast import enhance_region_contrast
 from define_multi_region_priors import define_multi_region_priors
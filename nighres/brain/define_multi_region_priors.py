@@ -5,12 +5,17 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_atlas_file, \
+                    _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 from colorama.ansi import Back
 
+@cached
 def define_multi_region_priors(segmentation_image,levelset_boundary_image,
                                atlas_file, #defined_region, definition_method,
-                               distance_offset,
+                               distance_offset, outputs=None,
                                save_data=False, output_dir=None,
                                file_name=None):
     
@@ -28,17 +33,23 @@ def define_multi_region_priors(segmentation_image,levelset_boundary_image,
     levelset_boundary_image: niimg
          MGDM boundary distance image (_mgdm_dist) giving the absolute distance to the closest boundary
          
-    atlas_file: str, optional
-        Path to brain atlas file to define segmentation labels (default is stored in DEFAULT_ATLAS)
+    atlas_file: str or Atlas, optional
+        Path to brain atlas file to define segmentation labels (default is stored in DEFAULT_ATLAS),
+        or a parsed :class:`nighres.io.Atlas`
         
     partial_voluming_distance: float
         Distance used to compute partial voluming at the boundary of structures (default is 0)
 
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
+
     Returns
     ----------
     dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
         * inter_ventricular_pv (niimg): Partial volume estimate of the inter-ventricular 
           region(_mrp_intv)
@@ -58,8 +69,13 @@ def define_multi_region_priors(segmentation_image,levelset_boundary_image,
 
     print('\n Define Multi-Region Priors')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['inter_ventricular_pv',
+                                       'ventricular_horns_pv',
+                                       'internal_capsule_pv'])
+
     # check atlas_file and set default if not given
-    #atlas_file = _check_atlas_file(atlas_file)
+    atlas_file = _check_atlas_file(atlas_file)
 
     # make sure that saving related parameters are correct
     if save_data:
@@ -78,10 +94,7 @@ def define_multi_region_priors(segmentation_image,levelset_boundary_image,
                                   suffix='mrp_icap')    
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(segmentation_image)
     # create DefineMultiRegionPriors instance
 
     dmrp = cbstools.BrainDefineMultiRegionPriors()
@@ -104,11 +117,11 @@ def define_multi_region_priors(segmentation_image,levelset_boundary_image,
     dmrp.setResolutions(resolution[0], resolution[1], resolution[2])
     
     # input segmentation_image
-    dmrp.setSegmentationImage(cbstools.JArray('int')((data.flatten('F')).astype(int)))
+    dmrp.setSegmentationImage(to_jarray(data, 'int'))
 
     # input levelset_boundary_image
     data = load_volume(levelset_boundary_image).get_data()
-    dmrp.setLevelsetBoundaryImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    dmrp.setLevelsetBoundaryImage(to_jarray(data, 'float'))
 
     # execute DMRP
     try:
@@ -120,35 +133,40 @@ def define_multi_region_priors(segmentation_image,levelset_boundary_image,
         print sys.exc_info()[0]
         raise
         return
-   
-    
-    # reshape output to what nibabel likes
-    intervent_data = np.reshape(np.array(dmrp.getInterVentricularPV(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    horns_data = np.reshape(np.array(dmrp.getVentricularHornsPV(),
-                                   dtype=np.float32), dimensions, 'F')
-    
-    intercap_data = np.reshape(np.array(dmrp.getInternalCapsulePV(),
-                                   dtype=np.float32), dimensions, 'F')
-
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_max'] = np.nanmax(intervent_data)
-    intervent = nb.Nifti1Image(intervent_data, affine, header)
-
-    header['cal_max'] = np.nanmax(horns_data)
-    horns = nb.Nifti1Image(horns_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(intercap_data)
-    intercap = nb.Nifti1Image(intercap_data, affine, header)
 
+    report_heap_usage('define_multi_region_priors')
    
-    if save_data:
-        save_volume(os.path.join(output_dir, intervent_file), intervent)
-        save_volume(os.path.join(output_dir, horns_file), horns)
-        save_volume(os.path.join(output_dir, intercap_file), intercap)
-
-
-    return {'inter_ventricular_pv': intervent, 'ventricular_horns_pv': horns, 'internal_capsule_pv': intercap}
+    
+    # reshape the selected outputs to what nibabel likes, adapt header max
+    # for each image so that correct max is displayed and create nifti
+    # objects
+    results = {}
+
+    if 'inter_ventricular_pv' in outputs:
+        intervent_data = from_jarray(dmrp.getInterVentricularPV(), dimensions)
+        header['cal_max'] = np.nanmax(intervent_data)
+        results['inter_ventricular_pv'] = nb.Nifti1Image(intervent_data,
+                                                         affine, header)
+        if save_data:
+            save_volume(os.path.join(output_dir, intervent_file),
+                        results['inter_ventricular_pv'])
+
+    if 'ventricular_horns_pv' in outputs:
+        horns_data = from_jarray(dmrp.getVentricularHornsPV(), dimensions)
+        header['cal_max'] = np.nanmax(horns_data)
+        results['ventricular_horns_pv'] = nb.Nifti1Image(horns_data,
+                                                         affine, header)
+        if save_data:
+            save_volume(os.path.join(output_dir, horns_file),
+                        results['ventricular_horns_pv'])
+
+    if 'internal_capsule_pv' in outputs:
+        intercap_data = from_jarray(dmrp.getInternalCapsulePV(), dimensions)
+        header['cal_max'] = np.nanmax(intercap_data)
+        results['internal_capsule_pv'] = nb.Nifti1Image(intercap_data,
+                                                        affine, header)
+        if save_data:
+            save_volume(os.path.join(output_dir, intercap_file),
+                        results['internal_capsule_pv'])
+
+    return results
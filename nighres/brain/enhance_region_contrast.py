@@ -5,14 +5,19 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_atlas_file, \
+                    _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 from colorama.ansi import Back
 
 
+@cached
 def enhance_region_contrast(intensity_image, segmentation_image,
                             levelset_boundary_image, atlas_file,
                             enhanced_region, contrast_background,
-                            partial_voluming_distance,
+                            partial_voluming_distance, outputs=None,
                             save_data=False, output_dir=None,
                             file_name=None):
     
@@ -31,8 +36,9 @@ def enhance_region_contrast(intensity_image, segmentation_image,
     levelset_boundary_image: niimg
        MGDM distance to closest boundary (_mgdm_dist)
     
-    atlas_file: str, optional
-        Path to MGDM brain atlas file (default is stored in DEFAULT_ATLAS)
+    atlas_file: str or Atlas, optional
+        Path to MGDM brain atlas file (default is stored in DEFAULT_ATLAS),
+        or a parsed :class:`nighres.io.Atlas`
     
     enhanced_region: str
        Region of interest to enhance (choices are: 'crwm', 'cbwm', 'csf' for
@@ -45,11 +51,16 @@ def enhance_region_contrast(intensity_image, segmentation_image,
     partial_voluming_distance: float
       Distance in voxels for estimating partial voluming at the boundaries
 
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
+
     Returns
     ----------
     dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets, with # the region and % the background label above)
+        (suffix of output files in brackets, with # the region and % the background label above),
+        restricted to the selected outputs
 
         * region_mask (niimg): Hard segmentation mask of the (GM) region
           of interest (_emask_#)
@@ -74,18 +85,20 @@ def enhance_region_contrast(intensity_image, segmentation_image,
 
     print('\n Enhance Region Contrast')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['region_mask', 'background_mask',
+                                       'region_proba', 'background_proba',
+                                       'region_pv', 'background_pv'])
+
     # check atlas_file and set default if not given
-    #atlas_file = _check_atlas_file(atlas_file)
+    atlas_file = _check_atlas_file(atlas_file)
 
     # make sure that saving related parameters are correct
     if save_data:
         output_dir = _output_dir_4saving(output_dir, intensity_image)
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(intensity_image)
     # create EnhanceRegionContrast instance
     erc = cbstools.BrainEnhanceRegionContrast()
 
@@ -108,15 +121,15 @@ def enhance_region_contrast(intensity_image, segmentation_image,
     erc.setResolutions(resolution[0], resolution[1], resolution[2])
     
     # input intensity_image
-    erc.setIntensityImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    erc.setIntensityImage(to_jarray(data, 'float'))
 
     # input segmentation_image
     data = load_volume(segmentation_image).get_data()
-    erc.setSegmentationImage(cbstools.JArray('int')((data.flatten('F')).astype(int)))
+    erc.setSegmentationImage(to_jarray(data, 'int'))
 
     # input levelset_boundary_image
     data = load_volume(levelset_boundary_image).get_data()
-    erc.setLevelsetBoundaryImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    erc.setLevelsetBoundaryImage(to_jarray(data, 'float'))
 
     # execute ERC
     try:
@@ -128,88 +141,42 @@ def enhance_region_contrast(intensity_image, segmentation_image,
         print sys.exc_info()[0]
         raise
         return
-   
-
-    if save_data:
-        reg_file = _fname_4saving(file_name=file_name,
-                                  rootfile=intensity_image,
-                                  suffix='emask'+str(erc.getRegionName()))
-
-        back_file = _fname_4saving(file_name=file_name,
-                                  rootfile=intensity_image,
-                                  suffix='emask'+str(erc.getBackgroundName()))
-
-        reg_proba_file = _fname_4saving(file_name=file_name,
-                                   rootfile=intensity_image,
-                                   suffix='eproba'+str(erc.getRegionName()))
-
-        back_proba_file = _fname_4saving(file_name=file_name,
-                                   rootfile=intensity_image,
-                                   suffix='eproba'+str(erc.getBackgroundName()))
-        
-        reg_pv_file = _fname_4saving(file_name=file_name,
-                                   rootfile=intensity_image,
-                                   suffix='epv'+str(erc.getRegionName()))
-        
-        back_pv_file = _fname_4saving(file_name=file_name,
-                                   rootfile=intensity_image,
-                                   suffix='epv'+str(erc.getBackgroundName()))
-        
-    
-    # reshape output to what nibabel likes
-    reg_data = np.reshape(np.array(erc.getRegionMask(),
-                                   dtype=np.int32), dimensions, 'F')
-
-    back_data = np.reshape(np.array(erc.getBackgroundMask(),
-                                    dtype=np.int32), dimensions, 'F')
-    
-    reg_proba_data = np.reshape(np.array(erc.getRegionProbability(),
-                                   dtype=np.float32), dimensions, 'F')
 
-    back_proba_data = np.reshape(np.array(erc.getBackgroundProbability(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    reg_pv_data = np.reshape(np.array(erc.getRegionPartialVolume(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    back_pv_data = np.reshape(np.array(erc.getBackgroundPartialVolume(),
-                                    dtype=np.float32), dimensions, 'F')
-
-    ## membership and labels output has a 4th dimension, set to 6
-    #dimensions4d = [dimensions[0], dimensions[1], dimensions[2], 6]
-    #lbl_data = np.reshape(np.array(mgdm.getPosteriorMaximumLabels4D(),
-    #                               dtype=np.int32), dimensions4d, 'F')
-    #mems_data = np.reshape(np.array(mgdm.getPosteriorMaximumMemberships4D(),
-    #                                dtype=np.float32), dimensions4d, 'F')
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_max'] = np.nanmax(reg_data)
-    reg = nb.Nifti1Image(reg_data, affine, header)
-
-    header['cal_max'] = np.nanmax(back_data)
-    back = nb.Nifti1Image(back_data, affine, header)
-
-    header['cal_max'] = np.nanmax(reg_proba_data)
-    reg_proba = nb.Nifti1Image(reg_proba_data, affine, header)
-
-    header['cal_max'] = np.nanmax(back_proba_data)
-    back_proba = nb.Nifti1Image(back_proba_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(reg_pv_data)
-    reg_pv = nb.Nifti1Image(reg_pv_data, affine, header)
-
-    header['cal_max'] = np.nanmax(back_pv_data)
-    back_pv = nb.Nifti1Image(back_pv_data, affine, header)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, reg_file), reg)
-        save_volume(os.path.join(output_dir, back_file), back)
-        save_volume(os.path.join(output_dir, reg_proba_file), reg_proba)
-        save_volume(os.path.join(output_dir, back_proba_file), back_proba)
-        save_volume(os.path.join(output_dir, reg_pv_file), reg_pv)
-        save_volume(os.path.join(output_dir, back_pv_file), back_pv)
-
-    return {'region_mask': reg, 'background_mask': back,
-            'region_proba': reg_proba, 'background_proba': back_proba,
-            'region_pv': reg_pv, 'background_pv': back_pv}
+    report_heap_usage('enhance_region_contrast')
+
+    # Java methods returning each output, its data type and file prefix
+    getters = {'region_mask': (erc.getRegionMask, np.int32, 'emask'),
+               'background_mask': (erc.getBackgroundMask, np.int32, 'emask'),
+               'region_proba': (erc.getRegionProbability, np.float32,
+                                'eproba'),
+               'background_proba': (erc.getBackgroundProbability, np.float32,
+                                    'eproba'),
+               'region_pv': (erc.getRegionPartialVolume, np.float32, 'epv'),
+               'background_pv': (erc.getBackgroundPartialVolume, np.float32,
+                                 'epv')}
+
+    # names of the region and background, to build names for saving after
+    # the computations
+    names = {'region': str(erc.getRegionName()),
+             'background': str(erc.getBackgroundName())}
+
+    results = {}
+    for output in outputs:
+        # reshape output to what nibabel likes
+        getter, dtype, prefix = getters[output]
+        data = from_jarray(getter(), dimensions, dtype)
+
+        # adapt header max for each image so that correct max is displayed
+        # and create nifiti objects
+        header['cal_max'] = np.nanmax(data)
+        results[output] = nb.Nifti1Image(data, affine, header)
+
+        if save_data:
+            output_file = _fname_4saving(file_name=file_name,
+                                         rootfile=intensity_image,
+                                         suffix=prefix +
+                                         names[output.split('_')[0]])
+            save_volume(os.path.join(output_dir, output_file),
+                        results[output])
+
+    return results
@@ -5,15 +5,19 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
-    _check_topology_lut_dir, _check_atlas_file
+    _check_topology_lut_dir, _check_atlas_file, _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def extract_brain_region(segmentation, levelset_boundary,
                          maximum_membership, maximum_label,
                          extracted_region, atlas_file=None,
                          normalize_probabilities=False,
                          estimate_tissue_densities=False,
-                         partial_volume_distance=1.0,
+                         partial_volume_distance=1.0, outputs=None,
                          save_data=False, output_dir=None,
                          file_name=None):
     """ Extract Brain Region
@@ -32,9 +36,10 @@ def extract_brain_region(segmentation, levelset_boundary,
         4D image of the maximum membership values from MGDM.
     maximum_label: niimg
         4D imageof the maximum labels from MGDM.
-    atlas_file: str, optional
+    atlas_file: str or Atlas, optional
         Path to plain text atlas file (default is stored in DEFAULT_ATLAS).
-        or atlas name to be searched in ATLAS_DIR
+        or atlas name to be searched in ATLAS_DIR, or a parsed
+        :class:`nighres.io.Atlas`
     extracted_region: {'left_cerebrum', 'right_cerebrum', 'cerebrum', 'cerebellum', 'cerebellum_brainstem', 'subcortex', 'tissues(anat)', 'tissues(func)', 'brain_mask'}
         Region to be extracted from the MGDM segmentation.
     normalize_probabilities: bool
@@ -46,6 +51,9 @@ def extract_brain_region(segmentation, levelset_boundary,
     partial_volume_distance: float
         Distance in mm to use for tissues densities, if recomputed
         (default is 1mm).
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -60,7 +68,8 @@ def extract_brain_region(segmentation, levelset_boundary,
         Dictionary collecting outputs under the following keys
         (suffix of output files in brackets, # stands for shorthand names of 
         the different extracted regions, respectively:
-        rcr, lcr, cr, cb, cbs, sub, an, fn)
+        rcr, lcr, cr, cb, cbs, sub, an, fn), restricted to the selected
+        outputs
 
         * region_mask (niimg): Hard segmentation mask of the (GM) region
           of interest (_xmask_#gm)
@@ -88,6 +97,13 @@ def extract_brain_region(segmentation, levelset_boundary,
 
     print('\nExtract Brain Region')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['inside_mask', 'inside_proba',
+                                       'inside_lvl', 'region_mask',
+                                       'region_proba', 'region_lvl',
+                                       'background_mask', 'background_proba',
+                                       'background_lvl'])
+
     # check atlas_file and set default if not given
     atlas_file = _check_atlas_file(atlas_file)
 
@@ -96,10 +112,7 @@ def extract_brain_region(segmentation, levelset_boundary,
         output_dir = _output_dir_4saving(output_dir, segmentation)
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='8000m', maxheap='8000m')
-    except ValueError:
-        pass
+    start_jvm(segmentation, default_heap='8000m')
     # create algorithm instance
     xbr = cbstools.BrainExtractBrainRegion()
 
@@ -122,20 +135,16 @@ def extract_brain_region(segmentation, levelset_boundary,
     xbr.setResolutions(resolution[0], resolution[1], resolution[2])
     xbr.setComponents(load_volume(maximum_membership).get_header().get_data_shape()[3])
 
-    xbr.setSegmentationImage(cbstools.JArray('int')(
-        (data.flatten('F')).astype(int)))
+    xbr.setSegmentationImage(to_jarray(data, 'int'))
 
     data = load_volume(levelset_boundary).get_data()
-    xbr.setLevelsetBoundaryImage(cbstools.JArray('float')(
-        (data.flatten('F')).astype(float)))
+    xbr.setLevelsetBoundaryImage(to_jarray(data, 'float'))
 
     data = load_volume(maximum_membership).get_data()
-    xbr.setMaximumMembershipImage(cbstools.JArray('float')(
-        (data.flatten('F')).astype(float)))
+    xbr.setMaximumMembershipImage(to_jarray(data, 'float'))
 
     data = load_volume(maximum_label).get_data()
-    xbr.setMaximumLabelImage(cbstools.JArray('int')(
-        (data.flatten('F')).astype(int)))
+    xbr.setMaximumLabelImage(to_jarray(data, 'int'))
 
     # execute
     try:
@@ -148,134 +157,46 @@ def extract_brain_region(segmentation, levelset_boundary,
         raise
         return
 
-	# build names for saving after the computations to get the proper names
-    if save_data:
-        reg_mask_file = _fname_4saving(file_name=file_name,
-                                       rootfile=segmentation,
-                                       suffix='xmask'+xbr.getStructureName(), )
-
-        ins_mask_file = _fname_4saving(file_name=file_name,
-                                       rootfile=segmentation,
-                                       suffix='xmask'+xbr.getInsideName(), )
-
-        bg_mask_file = _fname_4saving(file_name=file_name,
-                                      rootfile=segmentation,
-                                      suffix='xmask'+xbr.getBackgroundName(), )
-
-        reg_proba_file = _fname_4saving(file_name=file_name,
-                                        rootfile=segmentation,
-                                        suffix='xproba'+xbr.getStructureName(), )
-
-        ins_proba_file = _fname_4saving(file_name=file_name,
-                                        rootfile=segmentation,
-                                        suffix='xproba'+xbr.getInsideName(), )
-
-        bg_proba_file = _fname_4saving(file_name=file_name,
-                                       rootfile=segmentation,
-                                       suffix='xproba'+xbr.getBackgroundName(), )
-
-        reg_lvl_file = _fname_4saving(file_name=file_name,
-                                      rootfile=segmentation,
-                                      suffix='xlvl'+xbr.getStructureName(), )
-
-        ins_lvl_file = _fname_4saving(file_name=file_name,
-                                      rootfile=segmentation,
-                                      suffix='xlvl'+xbr.getInsideName(), )
-
-        bg_lvl_file = _fname_4saving(file_name=file_name,
-                                     rootfile=segmentation,
-                                     suffix='xlvl'+xbr.getBackgroundName(), )
-
-
-    # inside region
-    # reshape output to what nibabel likes
-    mask_data = np.reshape(np.array(xbr.getInsideWMmask(),
-                                    dtype=np.int32), dimensions, 'F')
-
-    proba_data = np.reshape(np.array(xbr.getInsideWMprobability(),
-                                     dtype=np.float32), dimensions, 'F')
-
-    lvl_data = np.reshape(np.array(xbr.getInsideWMlevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_min'] = np.nanmin(mask_data)
-    header['cal_max'] = np.nanmax(mask_data)
-    inside_mask = nb.Nifti1Image(mask_data, affine, header)
-
-    header['cal_min'] = np.nanmin(proba_data)
-    header['cal_max'] = np.nanmax(proba_data)
-    inside_proba = nb.Nifti1Image(proba_data, affine, header)
-
-    header['cal_min'] = np.nanmin(lvl_data)
-    header['cal_max'] = np.nanmax(lvl_data)
-    inside_lvl = nb.Nifti1Image(lvl_data, affine, header)
-
-    # main region
-    # reshape output to what nibabel likes
-    mask_data = np.reshape(np.array(xbr.getStructureGMmask(),
-                                    dtype=np.int32), dimensions, 'F')
-
-    proba_data = np.reshape(np.array(xbr.getStructureGMprobability(),
-                                     dtype=np.float32), dimensions, 'F')
-
-    lvl_data = np.reshape(np.array(xbr.getStructureGMlevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_min'] = np.nanmin(mask_data)
-    header['cal_max'] = np.nanmax(mask_data)
-    region_mask = nb.Nifti1Image(mask_data, affine, header)
-
-    header['cal_min'] = np.nanmin(proba_data)
-    header['cal_max'] = np.nanmax(proba_data)
-    region_proba = nb.Nifti1Image(proba_data, affine, header)
-
-    header['cal_min'] = np.nanmin(lvl_data)
-    header['cal_max'] = np.nanmax(lvl_data)
-    region_lvl = nb.Nifti1Image(lvl_data, affine, header)
-
-    # background region
-    # reshape output to what nibabel likes
-    mask_data = np.reshape(np.array(xbr.getBackgroundCSFmask(),
-                                    dtype=np.int32), dimensions, 'F')
-
-    proba_data = np.reshape(np.array(xbr.getBackgroundCSFprobability(),
-                                     dtype=np.float32), dimensions, 'F')
-
-    lvl_data = np.reshape(np.array(xbr.getBackgroundCSFlevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_min'] = np.nanmin(mask_data)
-    header['cal_max'] = np.nanmax(mask_data)
-    background_mask = nb.Nifti1Image(mask_data, affine, header)
-
-    header['cal_min'] = np.nanmin(proba_data)
-    header['cal_max'] = np.nanmax(proba_data)
-    background_proba = nb.Nifti1Image(proba_data, affine, header)
-
-    header['cal_min'] = np.nanmin(lvl_data)
-    header['cal_max'] = np.nanmax(lvl_data)
-    background_lvl = nb.Nifti1Image(lvl_data, affine, header)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, ins_mask_file), inside_mask)
-        save_volume(os.path.join(output_dir, ins_proba_file), inside_proba)
-        save_volume(os.path.join(output_dir, ins_lvl_file), inside_lvl)
-        save_volume(os.path.join(output_dir, reg_mask_file), region_mask)
-        save_volume(os.path.join(output_dir, reg_proba_file), region_proba)
-        save_volume(os.path.join(output_dir, reg_lvl_file), region_lvl)
-        save_volume(os.path.join(output_dir, bg_mask_file), background_mask)
-        save_volume(os.path.join(output_dir, bg_proba_file), background_proba)
-        save_volume(os.path.join(output_dir, bg_lvl_file), background_lvl)
-
-    return {'inside_mask': inside_mask, 'inside_proba': inside_proba,
-            'inside_lvl': inside_lvl, 'region_mask': region_mask,
-            'region_proba': region_proba, 'inside_lvl': region_lvl,
-            'background_mask': background_mask,
-            'background_proba': background_proba,
-            'background_lvl': background_lvl}
+    report_heap_usage('extract_brain_region')
+
+    # Java methods returning each output, and its data type
+    getters = {'inside_mask': (xbr.getInsideWMmask, np.int32),
+               'inside_proba': (xbr.getInsideWMprobability, np.float32),
+               'inside_lvl': (xbr.getInsideWMlevelset, np.float32),
+               'region_mask': (xbr.getStructureGMmask, np.int32),
+               'region_proba': (xbr.getStructureGMprobability, np.float32),
+               'region_lvl': (xbr.getStructureGMlevelset, np.float32),
+               'background_mask': (xbr.getBackgroundCSFmask, np.int32),
+               'background_proba': (xbr.getBackgroundCSFprobability,
+                                    np.float32),
+               'background_lvl': (xbr.getBackgroundCSFlevelset, np.float32)}
+
+    # names of the regions and prefixes of the output types, to build names
+    # for saving after the computations
+    region_names = {'inside': xbr.getInsideName(),
+                    'region': xbr.getStructureName(),
+                    'background': xbr.getBackgroundName()}
+    prefixes = {'mask': 'xmask', 'proba': 'xproba', 'lvl': 'xlvl'}
+
+    results = {}
+    for output in outputs:
+        # reshape output to what nibabel likes
+        getter, dtype = getters[output]
+        data = from_jarray(getter(), dimensions, dtype)
+
+        # adapt header min, max for each image so that correct range is
+        # displayed and create nifiti objects
+        header['cal_min'] = np.nanmin(data)
+        header['cal_max'] = np.nanmax(data)
+        results[output] = nb.Nifti1Image(data, affine, header)
+
+        if save_data:
+            region, kind = output.split('_')
+            output_file = _fname_4saving(file_name=file_name,
+                                         rootfile=segmentation,
+                                         suffix=prefixes[kind] +
+                                         region_names[region])
+            save_volume(os.path.join(output_dir, output_file),
+                        results[output])
+
+    return results
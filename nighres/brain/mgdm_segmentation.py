@@ -3,9 +3,15 @@ import nibabel as nb
 import os
 import sys
 import cbstools
-from ..io import load_volume, save_volume
+from ..io import load_volume, save_volume, Atlas
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
+
+# outputs of the MGDM module, in the order they are saved
+_MGDM_OUTPUTS = ['segmentation', 'distance', 'labels', 'memberships']
 
 
 def _get_mgdm_orientation(affine, mgdm):
@@ -39,22 +45,134 @@ def _get_mgdm_orientation(affine, mgdm):
     return sliceorder, LR, AP, IS
 
 
-def _get_mgdm_intensity_priors(atlas_file):
+def _check_contrast_types(contrasts, ctypes, mgdm_intensity_priors):
+    for idx, ctype in enumerate(ctypes):
+        if ctype is None and contrasts[idx] is not None:
+            raise ValueError(("If specifying contrast_image{0}, please also "
+                              "specify contrast_type{0}".format(idx+1, idx+1)))
+
+        elif ctype is not None and ctype not in mgdm_intensity_priors:
+            raise ValueError(("{0} is not a valid contrast type for  "
+                              "contrast_type{1} please choose from the "
+                              "following contrasts provided by the chosen "
+                              "atlas: ").format(ctype, idx+1),
+                             ", ".join(mgdm_intensity_priors))
+
+
+def _create_mgdm(atlas_file, topology_lut_dir, n_steps, max_iterations,
+                 topology, adjust_intensity_priors, compute_posterior,
+                 diffuse_probabilities):
     """
-    Returns a list of available as intensity priors
-    in the MGDM atlas that you are using
+    Creates an MGDM instance with all the parameters that do not depend on
+    the subject, so that it can be reused across subjects
     """
-    priors = []
-    with open(atlas_file) as fp:
-        for i, line in enumerate(fp):
-            if "Structures:" in line:  # this is the beginning of the LUT
-                lut_idx = i
-                lut_rows = map(int, [line.split()[1]])[0]
-            if "Intensity Prior:" in line:
-                priors.append(line.split()[-1])
-    return priors
+    mgdm = cbstools.BrainMgdmMultiSegmentation2()
+
+    # set mgdm parameters
+    mgdm.setAtlasFile(atlas_file)
+    mgdm.setTopologyLUTdirectory(topology_lut_dir)
+    mgdm.setOutputImages('label_memberships')
+    mgdm.setAdjustIntensityPriors(adjust_intensity_priors)
+    mgdm.setComputePosterior(compute_posterior)
+    mgdm.setDiffuseProbabilities(diffuse_probabilities)
+    mgdm.setSteps(n_steps)
+    mgdm.setMaxIterations(max_iterations)
+    mgdm.setTopology(topology)
+    mgdm.setNormalizeQuantitativeMaps(True)
+    # set to False for "quantitative" brain prior atlases
+    # (version quant-3.0.5 and above)
+
+    return mgdm
+
+
+def _run_mgdm(mgdm, contrasts, ctypes, outputs):
+    """
+    Runs an MGDM instance on one subject's contrast images and returns
+    the selected outputs as nifti images
+    """
+    # load contrast image 1 and use it to set dimensions and resolution
+    img = load_volume(contrasts[0])
+    data = img.get_data()
+    affine = img.get_affine()
+    header = img.get_header()
+    resolution = [x.item() for x in header.get_zooms()]
+    dimensions = data.shape
+
+    mgdm.setDimensions(dimensions[0], dimensions[1], dimensions[2])
+    mgdm.setResolutions(resolution[0], resolution[1], resolution[2])
+
+    # convert orientation information to mgdm slice and orientation info
+    sliceorder, LR, AP, IS = _get_mgdm_orientation(affine, mgdm)
+    mgdm.setOrientations(sliceorder, LR, AP, IS)
+
+    # input image 1
+    mgdm.setContrastImage1(to_jarray(data, 'float'))
+    mgdm.setContrastType1(ctypes[0])
+
+    # if further contrast are specified, input them
+    if contrasts[1] is not None:
+        data = load_volume(contrasts[1]).get_data()
+        mgdm.setContrastImage2(to_jarray(data, 'float'))
+        mgdm.setContrastType2(ctypes[1])
+
+        if contrasts[2] is not None:
+            data = load_volume(contrasts[2]).get_data()
+            mgdm.setContrastImage3(to_jarray(data, 'float'))
+            mgdm.setContrastType3(ctypes[2])
 
+            if contrasts[3] is not None:
+                data = load_volume(contrasts[3]).get_data()
+                mgdm.setContrastImage4(to_jarray(data, 'float'))
+                mgdm.setContrastType4(ctypes[3])
 
+    # execute MGDM
+    try:
+        mgdm.execute()
+
+    except:
+        # if the Java module fails, reraise the error it throws
+        print("\n The underlying Java code did not execute cleanly: ")
+        print sys.exc_info()[0]
+        raise
+        return
+
+    report_heap_usage('mgdm_segmentation')
+
+    # reshape the selected outputs to what nibabel likes, adapt header max
+    # for each image so that correct max is displayed and create nifti
+    # objects
+    results = {}
+
+    if 'segmentation' in outputs:
+        seg_data = from_jarray(mgdm.getSegmentedBrainImage(), dimensions,
+                               np.int32)
+        header['cal_max'] = np.nanmax(seg_data)
+        results['segmentation'] = nb.Nifti1Image(seg_data, affine, header)
+
+    if 'distance' in outputs:
+        dist_data = from_jarray(mgdm.getLevelsetBoundaryImage(), dimensions)
+        header['cal_max'] = np.nanmax(dist_data)
+        results['distance'] = nb.Nifti1Image(dist_data, affine, header)
+
+    # membership and labels output has a 4th dimension, set to 6
+    dimensions4d = [dimensions[0], dimensions[1], dimensions[2], 6]
+
+    if 'labels' in outputs:
+        lbl_data = from_jarray(mgdm.getPosteriorMaximumLabels4D(),
+                               dimensions4d, np.int32)
+        header['cal_max'] = np.nanmax(lbl_data)
+        results['labels'] = nb.Nifti1Image(lbl_data, affine, header)
+
+    if 'memberships' in outputs:
+        mems_data = from_jarray(mgdm.getPosteriorMaximumMemberships4D(),
+                                dimensions4d)
+        header['cal_max'] = np.nanmax(mems_data)
+        results['memberships'] = nb.Nifti1Image(mems_data, affine, header)
+
+    return results
+
+
+@cached
 def mgdm_segmentation(contrast_image1, contrast_type1,
                       contrast_image2=None, contrast_type2=None,
                       contrast_image3=None, contrast_type3=None,
@@ -63,7 +181,7 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
                       atlas_file=None, topology_lut_dir=None,
                       adjust_intensity_priors=False,
                       compute_posterior=False,
-                      diffuse_probabilities=False,
+                      diffuse_probabilities=False, outputs=None,
                       save_data=False, output_dir=None,
                       file_name=None):
     """ MGDM segmentation
@@ -106,9 +224,10 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
     topology: {'wcs', 'no'}, optional
         Topology setting, choose 'wcs' (well-composed surfaces) for strongest
         topology constraint, 'no' for no topology constraint (default is 'wcs')
-    atlas_file: str, optional
+    atlas_file: str or Atlas, optional
         Path to plain text atlas file (default is stored in DEFAULT_ATLAS)
-        or atlas name to be searched in ATLAS_DIR
+        or atlas name to be searched in ATLAS_DIR, or an atlas parsed with
+        :meth:`nighres.io.Atlas.load`
     topology_lut_dir: str, optional
         Path to directory in which topology files are stored (default is stored
         in TOPOLOGY_LUT_DIR)
@@ -120,6 +239,9 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
     diffuse_probabilities: bool
         Regularize probability distribution with a non-linear diffusion scheme
         (default is False)
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -132,7 +254,8 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
     ----------
     dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
         * segmentation (niimg): Hard brain segmentation with topological
           constraints (if chosen) (_mgdm_seg)
@@ -160,30 +283,24 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
 
     print('\nMGDM Segmentation')
 
-    # check atlas_file and set default if not given
-    atlas_file = _check_atlas_file(atlas_file)
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, _MGDM_OUTPUTS)
+
+    # check atlas_file and set default if not given, parsing it once
+    atlas = Atlas.load(atlas_file)
+    atlas_file = atlas.path
 
     # check topology_lut_dir and set default if not given
     topology_lut_dir = _check_topology_lut_dir(topology_lut_dir)
 
     # find available intensity priors in selected MGDM atlas
-    mgdm_intensity_priors = _get_mgdm_intensity_priors(atlas_file)
+    mgdm_intensity_priors = atlas.contrasts
 
     # sanity check contrast types
     contrasts = [contrast_image1, contrast_image2,
                  contrast_image3, contrast_image4]
     ctypes = [contrast_type1, contrast_type2, contrast_type3, contrast_type4]
-    for idx, ctype in enumerate(ctypes):
-        if ctype is None and contrasts[idx] is not None:
-            raise ValueError(("If specifying contrast_image{0}, please also "
-                              "specify contrast_type{0}".format(idx+1, idx+1)))
-
-        elif ctype is not None and ctype not in mgdm_intensity_priors:
-            raise ValueError(("{0} is not a valid contrast type for  "
-                              "contrast_type{1} please choose from the "
-                              "following contrasts provided by the chosen "
-                              "atlas: ").format(ctype, idx+1),
-                             ", ".join(mgdm_intensity_priors))
+    _check_contrast_types(contrasts, ctypes, mgdm_intensity_priors)
 
     # make sure that saving related parameters are correct
     if save_data:
@@ -206,110 +323,171 @@ def mgdm_segmentation(contrast_image1, contrast_type1,
                                    suffix='mgdm_dist')
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(contrast_image1)
     # create mgdm instance
-    mgdm = cbstools.BrainMgdmMultiSegmentation2()
+    mgdm = _create_mgdm(atlas_file, topology_lut_dir, n_steps,
+                        max_iterations, topology, adjust_intensity_priors,
+                        compute_posterior, diffuse_probabilities)
 
-    # set mgdm parameters
-    mgdm.setAtlasFile(atlas_file)
-    mgdm.setTopologyLUTdirectory(topology_lut_dir)
-    mgdm.setOutputImages('label_memberships')
-    mgdm.setAdjustIntensityPriors(adjust_intensity_priors)
-    mgdm.setComputePosterior(compute_posterior)
-    mgdm.setDiffuseProbabilities(diffuse_probabilities)
-    mgdm.setSteps(n_steps)
-    mgdm.setMaxIterations(max_iterations)
-    mgdm.setTopology(topology)
-    mgdm.setNormalizeQuantitativeMaps(True)
-    # set to False for "quantitative" brain prior atlases
-    # (version quant-3.0.5 and above)
-
-    # load contrast image 1 and use it to set dimensions and resolution
-    img = load_volume(contrast_image1)
-    data = img.get_data()
-    affine = img.get_affine()
-    header = img.get_header()
-    resolution = [x.item() for x in header.get_zooms()]
-    dimensions = data.shape
-
-    mgdm.setDimensions(dimensions[0], dimensions[1], dimensions[2])
-    mgdm.setResolutions(resolution[0], resolution[1], resolution[2])
-
-    # convert orientation information to mgdm slice and orientation info
-    sliceorder, LR, AP, IS = _get_mgdm_orientation(affine, mgdm)
-    mgdm.setOrientations(sliceorder, LR, AP, IS)
-
-    # input image 1
-    mgdm.setContrastImage1(cbstools.JArray('float')(
-                                            (data.flatten('F')).astype(float)))
-    mgdm.setContrastType1(contrast_type1)
-
-    # if further contrast are specified, input them
-    if contrast_image2 is not None:
-        data = load_volume(contrast_image2).get_data()
-        mgdm.setContrastImage2(cbstools.JArray('float')(
-                                            (data.flatten('F')).astype(float)))
-        mgdm.setContrastType2(contrast_type2)
-
-        if contrast_image3 is not None:
-            data = load_volume(contrast_image3).get_data()
-            mgdm.setContrastImage3(cbstools.JArray('float')(
-                                            (data.flatten('F')).astype(float)))
-            mgdm.setContrastType3(contrast_type3)
-
-            if contrast_image4 is not None:
-                data = load_volume(contrast_image4).get_data()
-                mgdm.setContrastImage4(cbstools.JArray('float')(
-                                            (data.flatten('F')).astype(float)))
-                mgdm.setContrastType4(contrast_type4)
-
-    # execute MGDM
-    try:
-        mgdm.execute()
+    # run mgdm on the contrast images
+    results = _run_mgdm(mgdm, contrasts, ctypes, outputs)
 
-    except:
-        # if the Java module fails, reraise the error it throws
-        print("\n The underlying Java code did not execute cleanly: ")
-        print sys.exc_info()[0]
-        raise
-        return
+    if save_data:
+        if 'segmentation' in results:
+            save_volume(os.path.join(output_dir, seg_file),
+                        results['segmentation'])
+        if 'distance' in results:
+            save_volume(os.path.join(output_dir, dist_file),
+                        results['distance'])
+        if 'labels' in results:
+            save_volume(os.path.join(output_dir, lbl_file),
+                        results['labels'])
+        if 'memberships' in results:
+            save_volume(os.path.join(output_dir, mems_file),
+                        results['memberships'])
+
+    return results
+
+
+def mgdm_segmentation_batch(subjects, contrast_types,
+                            n_steps=5, max_iterations=800, topology='wcs',
+                            atlas_file=None, topology_lut_dir=None,
+                            adjust_intensity_priors=False,
+                            compute_posterior=False,
+                            diffuse_probabilities=False, outputs=None,
+                            output_dir=None, file_names=None):
+    """ MGDM segmentation of a group of subjects
+
+    Runs :func:`mgdm_segmentation` on a list of subjects sharing the same
+    contrast types, checking the atlas and creating the MGDM module only
+    once, and saving the outputs of each subject as soon as they are
+    computed
 
-    # reshape output to what nibabel likes
-    seg_data = np.reshape(np.array(mgdm.getSegmentedBrainImage(),
-                                   dtype=np.int32), dimensions, 'F')
+    Parameters
+    ----------
+    subjects: list
+        Input images of each subject, either a single niimg or a list of
+        up to four niimgs in the same space, in the order of contrast_types
+    contrast_types: str or list of str
+        Contrast types of the input images of every subject, must be listed
+        as priors in used atlas (specified in atlas_file)
+    n_steps: int, optional
+        Number of steps for MGDM (default is 5)
+    max_iterations: int, optional
+        Maximum number of iterations per step for MGDM (default is 800)
+    topology: {'wcs', 'no'}, optional
+        Topology setting, choose 'wcs' (well-composed surfaces) for strongest
+        topology constraint, 'no' for no topology constraint (default is 'wcs')
+    atlas_file: str or Atlas, optional
+        Path to plain text atlas file (default is stored in DEFAULT_ATLAS)
+        or atlas name to be searched in ATLAS_DIR, or an atlas parsed with
+        :meth:`nighres.io.Atlas.load`
+    topology_lut_dir: str, optional
+        Path to directory in which topology files are stored (default is stored
+        in TOPOLOGY_LUT_DIR)
+    adjust_intensity_priors: bool
+        Adjust intensity priors based on dataset (default is False)
+    compute_posterior: bool
+        Compute posterior probabilities for segmented structures
+        (default is False)
+    diffuse_probabilities: bool
+        Regularize probability distribution with a non-linear diffusion scheme
+        (default is False)
+    outputs: list of str, optional
+        Outputs to compute and save, among the keys of the outputs of
+        :func:`mgdm_segmentation` (default is all outputs)
+    output_dir: str, optional
+        Path to desired output directory, will be created if it doesn't exist
+        (default is the directory of each subject's first image)
+    file_names: list of str, optional
+        Desired base name for the output files of each subject, with file
+        extension (required if the inputs are data objects)
 
-    dist_data = np.reshape(np.array(mgdm.getLevelsetBoundaryImage(),
-                                    dtype=np.float32), dimensions, 'F')
+    Returns
+    ----------
+    list of dict
+        For each subject, dictionary collecting the paths of the saved
+        outputs under the same keys as :func:`mgdm_segmentation`
 
-    # membership and labels output has a 4th dimension, set to 6
-    dimensions4d = [dimensions[0], dimensions[1], dimensions[2], 6]
-    lbl_data = np.reshape(np.array(mgdm.getPosteriorMaximumLabels4D(),
-                                   dtype=np.int32), dimensions4d, 'F')
-    mems_data = np.reshape(np.array(mgdm.getPosteriorMaximumMemberships4D(),
-                                    dtype=np.float32), dimensions4d, 'F')
+    Notes
+    ----------
+    The outputs are not kept in memory, so that arbitrarily large groups can
+    be processed. The shape priors and topology template of the atlas and
+    the topology look-up tables are read from their files for the first
+    subject only, and copied in memory for the next ones.
+    """
 
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_max'] = np.nanmax(seg_data)
-    seg = nb.Nifti1Image(seg_data, affine, header)
+    print('\nMGDM Segmentation (batch)')
 
-    header['cal_max'] = np.nanmax(dist_data)
-    dist = nb.Nifti1Image(dist_data, affine, header)
+    # check which outputs to compute and save
+    outputs = _check_outputs(outputs, _MGDM_OUTPUTS)
 
-    header['cal_max'] = np.nanmax(lbl_data)
-    lbls = nb.Nifti1Image(lbl_data, affine, header)
+    # check atlas_file and set default if not given, parsing it once
+    atlas = Atlas.load(atlas_file)
+    atlas_file = atlas.path
 
-    header['cal_max'] = np.nanmax(mems_data)
-    mems = nb.Nifti1Image(mems_data, affine, header)
+    # check topology_lut_dir and set default if not given
+    topology_lut_dir = _check_topology_lut_dir(topology_lut_dir)
 
-    if save_data:
-        save_volume(os.path.join(output_dir, seg_file), seg)
-        save_volume(os.path.join(output_dir, dist_file), dist)
-        save_volume(os.path.join(output_dir, lbl_file), lbls)
-        save_volume(os.path.join(output_dir, mems_file), mems)
+    # find available intensity priors in selected MGDM atlas
+    mgdm_intensity_priors = atlas.contrasts
+
+    # sanity check contrast types, once for all subjects
+    if isinstance(contrast_types, basestring):
+        contrast_types = [contrast_types]
+    if len(contrast_types) < 1 or len(contrast_types) > 4:
+        raise ValueError("Please specify between 1 and 4 contrast types")
+    ctypes = list(contrast_types) + [None] * (4 - len(contrast_types))
+    _check_contrast_types(ctypes, ctypes, mgdm_intensity_priors)
+
+    if file_names is not None and len(file_names) != len(subjects):
+        raise ValueError("Please specify one file name per subject")
+
+    # prepare the contrasts and output files of all subjects before running
+    # anything, so that errors are caught early
+    batch = []
+    for idx, subject in enumerate(subjects):
+        if isinstance(subject, (list, tuple)):
+            contrasts = list(subject)
+        else:
+            contrasts = [subject]
+        if len(contrasts) != len(contrast_types):
+            raise ValueError(("Subject {0} has {1} contrast images, but {2} "
+                              "contrast types are given").format(
+                                idx, len(contrasts), len(contrast_types)))
+        contrasts = contrasts + [None] * (4 - len(contrasts))
+
+        file_name = None
+        if file_names is not None:
+            file_name = file_names[idx]
+        subject_dir = _output_dir_4saving(output_dir, contrasts[0])
+        files = {}
+        for key, suffix in [('segmentation', 'mgdm_seg'),
+                            ('labels', 'mgdm_lbls'),
+                            ('memberships', 'mgdm_mems'),
+                            ('distance', 'mgdm_dist')]:
+            files[key] = os.path.join(subject_dir, _fname_4saving(
+                                        file_name=file_name,
+                                        rootfile=contrasts[0],
+                                        suffix=suffix))
+        batch.append((contrasts, files))
+
+    if len(batch) == 0:
+        return []
 
-    return {'segmentation': seg, 'labels': lbls,
-            'memberships': mems, 'distance': dist}
+    # start virtual machine, if not already running
+    start_jvm(batch[0][0][0])
+    # create a single mgdm instance for all subjects
+    mgdm = _create_mgdm(atlas_file, topology_lut_dir, n_steps,
+                        max_iterations, topology, adjust_intensity_priors,
+                        compute_posterior, diffuse_probabilities)
+
+    results = []
+    for idx, (contrasts, files) in enumerate(batch):
+        print("\nSubject {0} of {1}".format(idx + 1, len(batch)))
+        subject_outputs = _run_mgdm(mgdm, contrasts, ctypes, outputs)
+        for key in outputs:
+            save_volume(files[key], subject_outputs[key])
+        results.append(dict((key, files[key]) for key in outputs))
+
+    return results
@@ -6,8 +6,12 @@ import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
                     _check_topology_lut_dir
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
                            skip_zero_values=True, topology_lut_dir=None,
                            save_data=False, output_dir=None,
@@ -90,10 +94,7 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
                                         suffix='strip_t1map')
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(second_inversion)
 
     # create skulltripping instance
     stripper = cbstools.BrainMp2rageSkullStripping()
@@ -107,8 +108,7 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
     dimensions = inv2_data.shape
     stripper.setDimensions(dimensions[0], dimensions[1], dimensions[2])
     stripper.setResolutions(resolution[0], resolution[1], resolution[2])
-    stripper.setSecondInversionImage(cbstools.JArray('float')(
-                                    (inv2_data.flatten('F')).astype(float)))
+    stripper.setSecondInversionImage(to_jarray(inv2_data, 'float'))
 
     # pass other inputs
     if (t1_weighted is None and t1_map is None):
@@ -119,15 +119,13 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
         t1w_data = t1w_img.get_data()
         t1w_affine = t1w_img.get_affine()
         t1w_hdr = t1w_img.get_header()
-        stripper.setT1weightedImage(cbstools.JArray('float')(
-                                      (t1w_data.flatten('F')).astype(float)))
+        stripper.setT1weightedImage(to_jarray(t1w_data, 'float'))
     if t1_map is not None:
         t1map_img = load_volume(t1_map)
         t1map_data = t1map_img.get_data()
         t1map_affine = t1map_img.get_affine()
         t1map_hdr = t1map_img.get_header()
-        stripper.setT1MapImage(cbstools.JArray('float')(
-                                    (t1map_data.flatten('F')).astype(float)))
+        stripper.setT1MapImage(to_jarray(t1map_data, 'float'))
 
     stripper.setSkipZeroValues(skip_zero_values)
     stripper.setTopologyLUTdirectory(topology_lut_dir)
@@ -143,15 +141,16 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
         raise
         return
 
+    report_heap_usage('mp2rage_skullstripping')
+
     # collect outputs and potentially save
-    inv2_masked_data = np.reshape(np.array(
-                                stripper.getMaskedSecondInversionImage(),
-                                dtype=np.float32), dimensions, 'F')
+    inv2_masked_data = from_jarray(stripper.getMaskedSecondInversionImage(),
+                                   dimensions)
     inv2_hdr['cal_max'] = np.nanmax(inv2_masked_data)
     inv2_masked = nb.Nifti1Image(inv2_masked_data, inv2_affine, inv2_hdr)
 
-    mask_data = np.reshape(np.array(stripper.getBrainMaskImage(),
-                                    dtype=np.uint32), dimensions, 'F')
+    mask_data = from_jarray(stripper.getBrainMaskImage(),
+                            dimensions, np.uint32)
     inv2_hdr['cal_max'] = np.nanmax(mask_data)
     mask = nb.Nifti1Image(mask_data, inv2_affine, inv2_hdr)
 
@@ -162,9 +161,8 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
         save_volume(os.path.join(output_dir, mask_file), mask)
 
     if t1_weighted is not None:
-        t1w_masked_data = np.reshape(np.array(
-                                stripper.getMaskedT1weightedImage(),
-                                dtype=np.float32), dimensions, 'F')
+        t1w_masked_data = from_jarray(stripper.getMaskedT1weightedImage(),
+                                      dimensions)
         t1w_hdr['cal_max'] = np.nanmax(t1w_masked_data)
         t1w_masked = nb.Nifti1Image(t1w_masked_data, t1w_affine, t1w_hdr)
         outputs['t1w_masked'] = t1w_masked
@@ -173,9 +171,8 @@ def mp2rage_skullstripping(second_inversion, t1_weighted=None, t1_map=None,
             save_volume(os.path.join(output_dir, t1w_file), t1w_masked)
 
     if t1_map is not None:
-        t1map_masked_data = np.reshape(np.array(
-                                        stripper.getMaskedT1MapImage(),
-                                        dtype=np.float32), dimensions, 'F')
+        t1map_masked_data = from_jarray(stripper.getMaskedT1MapImage(),
+                                        dimensions)
         t1map_hdr['cal_max'] = np.nanmax(t1map_masked_data)
         t1map_masked = nb.Nifti1Image(t1map_masked_data, t1map_affine,
                                       t1map_hdr)
@@ -0,0 +1,331 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+import functools
+import numpy as np
+import nibabel as nb
+import global_settings
+from nighres import __version__
+from io import save_volume, SparseVolume, Atlas
+from utils import _saving_log, _output_dir_4saving, _fname_4saving
+
+# parameters that only control how outputs are saved, not their values
+_SAVING_PARAMETERS = ['save_data', 'output_dir', 'file_name']
+
+# parameters holding input images or files, besides those whose name ends
+# with _image or _levelset, or starts with contrast_image
+_FILE_PARAMETERS = ['segmentation', 'levelset_boundary', 'maximum_membership',
+                    'maximum_label', 'second_inversion', 't1_weighted',
+                    't1_map', 'loc_prior', 'atlas_file']
+
+# hashes of the source files of the cached modules
+_source_hashes = {}
+
+# name under which the output of modules returning a single image is stored
+_SINGLE_OUTPUT = 'output'
+
+_cache_settings = {'cache_dir': None, 'max_size': None}
+
+
+def configure_cache(cache_dir=None, max_size=None):
+    '''
+    Enables the cache of module results, overriding the NIGHRES_CACHE_DIR
+    and NIGHRES_CACHE_MAX_SIZE environment variables
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory in which the results are stored, will be created if it
+        doesn't exist (None disables the cache)
+    max_size: float, optional
+        Maximum size of the cache in gigabytes, the least recently used
+        results are removed beyond it (default is 20)
+    '''
+    _cache_settings['cache_dir'] = cache_dir
+    _cache_settings['max_size'] = max_size
+
+
+def _cache_dir():
+    return _cache_settings['cache_dir'] or global_settings.CACHE_DIR
+
+
+def _max_size():
+    size = _cache_settings['max_size'] or global_settings.CACHE_MAX_SIZE
+    return float(size) * 1024 ** 3
+
+
+def _is_file_parameter(name):
+    return name in _FILE_PARAMETERS or \
+        name.endswith(('_image', '_levelset')) or \
+        name.startswith('contrast_image')
+
+
+def _hash_file(sha, path):
+    # files are identified by their path, size and modification time rather
+    # than read, which would cost as much as loading the inputs again
+    stat = os.stat(path)
+    sha.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime)))
+
+
+def _hash_image(sha, image):
+    # images read from a file and not loaded yet are hashed as their file
+    filename = getattr(image, 'get_filename', lambda: None)()
+    if filename is not None and nb.is_proxy(getattr(image, 'dataobj', None)) \
+            and os.path.isfile(filename):
+        _hash_file(sha, filename)
+    else:
+        sha.update(np.ascontiguousarray(image.get_data()).view(np.uint8))
+        sha.update(str(image.get_data().dtype))
+        sha.update(str(image.get_data().shape))
+    sha.update(np.asarray(image.get_affine(), dtype=np.float64).tostring())
+
+
+def _hash_value(sha, value, is_file=False):
+    # hashes the content of a parameter: image data and affine for images,
+    # file identity for file parameters (e.g. images or atlases given as
+    # paths), the value otherwise
+    if isinstance(value, (nb.spatialimages.SpatialImage, SparseVolume)):
+        _hash_image(sha, value)
+    elif isinstance(value, Atlas):
+        _hash_file(sha, value.path)
+    elif isinstance(value, np.ndarray):
+        sha.update(np.ascontiguousarray(value).view(np.uint8))
+        sha.update(str(value.dtype) + str(value.shape))
+    elif isinstance(value, (list, tuple)):
+        sha.update('[')
+        for item in value:
+            _hash_value(sha, item, is_file)
+            sha.update(',')
+        sha.update(']')
+    elif is_file and isinstance(value, basestring) and (
+            os.path.isfile(value) or
+            os.path.isfile(os.path.join(global_settings.ATLAS_DIR, value))):
+        if not os.path.isfile(value):
+            value = os.path.join(global_settings.ATLAS_DIR, value)
+        _hash_file(sha, value)
+    else:
+        sha.update(repr(value))
+
+
+def _source_hash(func):
+    # changes whenever the source file of the module is edited, so that
+    # results computed by an older version of a module are not reused
+    if func not in _source_hashes:
+        sha = hashlib.sha1()
+        with open(inspect.getsourcefile(func), 'rb') as fp:
+            sha.update(fp.read())
+        _source_hashes[func] = sha.hexdigest()
+    return _source_hashes[func]
+
+
+def _cache_key(func, callargs):
+    sha = hashlib.sha1()
+    sha.update(func.__module__ + '.' + func.__name__)
+    sha.update(__version__ + _source_hash(func))
+    for name in sorted(callargs.keys()):
+        if name not in _SAVING_PARAMETERS:
+            sha.update(name + '=')
+            _hash_value(sha, callargs[name], _is_file_parameter(name))
+            sha.update(';')
+    return sha.hexdigest()
+
+
+def _find_parameter(callargs, value):
+    # name of the parameter that was passed to the naming functions
+    if value is None:
+        return None
+    for name, arg in callargs.items():
+        if arg is value or (isinstance(arg, basestring) and arg == value):
+            return name
+    return None
+
+
+def _naming_info(callargs, records, outputs):
+    # matches each saved output with the directory and name it was given,
+    # so that the same names can be built for a later call
+    dirs = [r for r in records if r[0] == 'dir']
+    names = dict((r[3], r) for r in records if r[0] == 'name')
+    saved = [r for r in records if r[0] == 'volume']
+    naming = {}
+    for key, image in outputs.items():
+        for _, filename, volume in saved:
+            name = names.get(os.path.basename(filename))
+            if volume is image and name is not None:
+                naming[key] = {'dir_parameter': _find_parameter(
+                                    callargs, dirs[-1][1] if dirs else None),
+                               'name_parameter': _find_parameter(
+                                    callargs, name[1]),
+                               'suffix': name[2]}
+    return naming
+
+
+def _store(entry, outputs, naming):
+    # writes the outputs in a temporary directory then moves it into place,
+    # so that an interrupted call never leaves an incomplete entry
+    parent = os.path.dirname(entry)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    tmp = tempfile.mkdtemp(prefix='.tmp', dir=parent)
+    try:
+        for key, image in outputs.items():
+            # keep the data type of the outputs, which save_volume may have
+            # changed in their header
+            data = np.asarray(image.get_data())
+            stored = nb.Nifti1Image(data, image.get_affine(),
+                                    image.get_header().copy())
+            stored.set_data_dtype(data.dtype)
+            stored.to_filename(os.path.join(tmp, key + '.nii'))
+        with open(os.path.join(tmp, 'outputs.json'), 'w') as fp:
+            json.dump({'outputs': sorted(outputs.keys()),
+                       'naming': naming}, fp)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+    except OSError:
+        # another thread or process stored the same result in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _retrieve(entry):
+    with open(os.path.join(entry, 'outputs.json')) as fp:
+        meta = json.load(fp)
+    outputs = {}
+    for key in meta['outputs']:
+        # read the data in memory, as the file may be evicted at any time
+        image = nb.load(os.path.join(entry, key + '.nii'))
+        outputs[str(key)] = nb.Nifti1Image(np.asarray(image.get_data()),
+                                           image.get_affine(),
+                                           image.get_header())
+    # mark the entry as recently used
+    os.utime(entry, None)
+    return outputs, meta['naming']
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f))
+               for f in os.listdir(entry))
+
+
+def _evict(cache_dir):
+    # removes the least recently used entries beyond the maximum size
+    entries = []
+    for module in os.listdir(cache_dir):
+        module_dir = os.path.join(cache_dir, module)
+        if not os.path.isdir(module_dir):
+            continue
+        for key in os.listdir(module_dir):
+            if key.startswith('.'):
+                # entry being written
+                continue
+            entry = os.path.join(module_dir, key)
+            try:
+                entries.append((os.path.getmtime(entry), _entry_size(entry),
+                                entry))
+            except OSError:
+                continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= _max_size():
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def clear_cache():
+    '''
+    Removes all the results stored in the cache
+    '''
+    cache_dir = _cache_dir()
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def cached(func):
+    '''
+    Decorator caching the outputs of a nighres module on disk, when a cache
+    directory is set with :func:`configure_cache` or the NIGHRES_CACHE_DIR
+    environment variable
+
+    Notes
+    ----------
+    Results are looked up with a hash of the module name and source file,
+    the nighres version, the parameters, and the input images: their voxel
+    data and affine for images in memory, and the path, size and
+    modification time for images and atlases given as files (or read from a
+    file and not loaded yet). Editing or replacing an input file therefore
+    invalidates the results computed from it. The saving parameters
+    (save_data, output_dir and file_name) are not part of the hash: when a
+    cached result is returned with save_data=True, the outputs are saved
+    under the same names the module would have used.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache_dir = _cache_dir()
+        if cache_dir is None:
+            return func(*args, **kwargs)
+
+        callargs = inspect.getcallargs(func, *args, **kwargs)
+        entry = os.path.join(cache_dir, func.__name__,
+                             _cache_key(func, callargs))
+
+        try:
+            outputs, naming = _retrieve(entry)
+        except (IOError, OSError, ValueError):
+            # not cached, or evicted while being read
+            outputs = None
+        if outputs is not None:
+            save_data = callargs.get('save_data', False)
+            if not save_data or all(key in naming for key in outputs):
+                print("\n{0}: using cached results from {1}".format(
+                      func.__name__, entry))
+                if save_data:
+                    output_dirs = {}
+                    for key in sorted(outputs.keys()):
+                        info = naming[key]
+                        if info['dir_parameter'] not in output_dirs:
+                            output_dirs[info['dir_parameter']] = \
+                                _output_dir_4saving(
+                                    callargs.get('output_dir'),
+                                    callargs.get(info['dir_parameter']))
+                        output_dir = output_dirs[info['dir_parameter']]
+                        output_file = _fname_4saving(
+                            file_name=callargs.get('file_name'),
+                            rootfile=callargs.get(info['name_parameter']),
+                            suffix=info['suffix'])
+                        save_volume(os.path.join(output_dir, output_file),
+                                    outputs[key])
+                if _SINGLE_OUTPUT in outputs:
+                    return outputs[_SINGLE_OUTPUT]
+                return outputs
+
+        # run the module, logging the names under which outputs are saved
+        previous = getattr(_saving_log, 'records', None)
+        _saving_log.records = []
+        try:
+            outputs = func(*args, **kwargs)
+            records = _saving_log.records
+        finally:
+            _saving_log.records = previous
+
+        # modules return either a dictionary of images or a single image
+        if isinstance(outputs, nb.spatialimages.SpatialImage):
+            images = {_SINGLE_OUTPUT: outputs}
+        else:
+            images = outputs
+        if isinstance(images, dict) and all(
+                isinstance(image, nb.spatialimages.SpatialImage)
+                for image in images.values()):
+            _store(entry, images, _naming_info(callargs, records, images))
+            _evict(cache_dir)
+        return outputs
+
+    # lets documentation tools show the signature of the module
+    wrapper.__wrapped__ = func
+    return wrapper
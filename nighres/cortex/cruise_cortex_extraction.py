@@ -3,17 +3,25 @@ import nibabel as nb
 import os
 import sys
 import cbstools
-from ..io import load_volume, save_volume
+from ..io import load_volume, save_volume, NarrowBandLevelset
+from ..io.io_sparse import _sparse_fname
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_atlas_file, \
+                    _check_outputs, _crop_box, _uncrop
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
                              vd_image=None, data_weight=0.4,
                              regularization_weight=0.1,
                              max_iterations=500, normalize_probabilities=False,
                              correct_wm_pv=True, wm_dropoff_dist=1.0,
                              topology='wcs', topology_lut_dir=None,
+                             crop_margin=None, narrow_band=None,
+                             outputs=None,
                              save_data=False, output_dir=None,
                              file_name=None):
     """ CRUISE cortex extraction
@@ -65,6 +73,20 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
     topology_lut_dir: str
         Path to directory in which topology files are stored (default is stored
         in TOPOLOGY_LUT_DIR)
+    crop_margin: int, optional
+        If given, the images are cropped to the bounding box of the cerebrum
+        (voxels of the initial WM segmentation, or with WM or GM probability
+        above 0.5) grown by this many voxels before running CRUISE, and the
+        results are pasted back into the full image (default is None, no
+        cropping)
+    narrow_band: float, optional
+        If given, the gwb, cgb and avg levelsets are returned as
+        :class:`nighres.io.NarrowBandLevelset` only holding the voxels within
+        this distance (in voxels) of their surface and clamped beyond it,
+        saved as .npz files (default is None, full levelsets)
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -77,7 +99,8 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
     ----------
     dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
         * cortex (niimg): Hard segmentation of the cortex with labels
           background=0, gm=1, and wm=2 (_cruise_cortex)
@@ -98,11 +121,19 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
         * pcsf (niimg): Optimized CSF probability, including sulcal ridges and
           vessel/dura correction (_cruise_pwm)
 
+        The gwb, cgb and avg levelsets are NarrowBandLevelset if narrow_band
+        is given.
+
     Notes
     ----------
     Original algorithm by Xiao Han. Java module by Pierre-Louis Bazin.
     Algorithm details can be found in [1]_
 
+    When cropping, the level sets outside the bounding box take their
+    largest absolute value in the box plus the distance to the box, and the
+    other outputs are copied from its border, so the margin should leave a
+    few voxels of background around the cortex.
+
     References
     ----------
     .. [1] X. Han, D.L. Pham, D. Tosun, M.E. Rettmann, C. Xu, and J. L. Prince,
@@ -112,6 +143,10 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
 
     print('\nCRUISE Cortical Extraction')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['cortex', 'gwb', 'cgb', 'avg',
+                                       'thickness', 'pwm', 'pgm', 'pcsf'])
+
     # check topology_lut_dir and set default if not given
     topology_lut_dir = _check_topology_lut_dir(topology_lut_dir)
 
@@ -119,43 +154,8 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
     if save_data:
         output_dir = _output_dir_4saving(output_dir, gm_image)
 
-        cortex_file = _fname_4saving(file_name=file_name,
-                                     rootfile=gm_image,
-                                     suffix='cruise_cortex', )
-
-        gwb_file = _fname_4saving(file_name=file_name,
-                                  rootfile=gm_image,
-                                  suffix='cruise_gwb', )
-
-        cgb_file = _fname_4saving(file_name=file_name,
-                                  rootfile=gm_image,
-                                  suffix='cruise_cgb', )
-
-        avg_file = _fname_4saving(file_name=file_name,
-                                  rootfile=gm_image,
-                                  suffix='cruise_avg', )
-
-        thick_file = _fname_4saving(file_name=file_name,
-                                    rootfile=gm_image,
-                                    suffix='cruise_thick', )
-
-        pwm_file = _fname_4saving(file_name=file_name,
-                                  rootfile=gm_image,
-                                  suffix='cruise_pwm', )
-
-        pgm_file = _fname_4saving(file_name=file_name,
-                                  rootfile=gm_image,
-                                  suffix='cruise_pgm', )
-
-        pcsf_file = _fname_4saving(file_name=file_name,
-                                   rootfile=gm_image,
-                                   suffix='cruise_pcsf', )
-
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(init_image)
     # create instance
     cruise = cbstools.CortexOptimCRUISE()
 
@@ -176,27 +176,32 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
     header = init.get_header()
     resolution = [x.item() for x in header.get_zooms()]
     dimensions = init_data.shape
-    cruise.setDimensions(dimensions[0], dimensions[1], dimensions[2])
-    cruise.setResolutions(resolution[0], resolution[1], resolution[2])
-    cruise.importInitialWMSegmentationImage(cbstools.JArray('int')(
-                                        (init_data.flatten('F')).astype(int)))
 
     wm_data = load_volume(wm_image).get_data()
-    cruise.setFilledWMProbabilityImage(cbstools.JArray('float')(
-                                        (wm_data.flatten('F')).astype(float)))
-
     gm_data = load_volume(gm_image).get_data()
-    cruise.setGMProbabilityImage(cbstools.JArray('float')(
-                                        (gm_data.flatten('F')).astype(float)))
+
+    # restrict processing to the bounding box of the cerebrum, if required
+    if crop_margin is not None:
+        box = _crop_box((init_data > 0) | (wm_data > 0.5) |
+                        (gm_data > 0.5), crop_margin)
+    else:
+        box = tuple(slice(0, n) for n in dimensions)
+    crop_dimensions = tuple(b.stop - b.start for b in box)
+
+    cruise.setDimensions(crop_dimensions[0], crop_dimensions[1],
+                         crop_dimensions[2])
+    cruise.setResolutions(resolution[0], resolution[1], resolution[2])
+    cruise.importInitialWMSegmentationImage(to_jarray(init_data[box], 'int'))
+    cruise.setFilledWMProbabilityImage(to_jarray(wm_data[box], 'float'))
+    cruise.setGMProbabilityImage(to_jarray(gm_data[box], 'float'))
 
     csf_data = load_volume(csf_image).get_data()
-    cruise.setCSFandBGProbabilityImage(cbstools.JArray('float')(
-                                        (csf_data.flatten('F')).astype(float)))
+    cruise.setCSFandBGProbabilityImage(to_jarray(csf_data[box], 'float'))
 
     if vd_image is not None:
         vd_data = load_volume(vd_image).get_data()
-        cruise.setVeinsAndDuraProbabilityImage(cbstools.JArray('float')(
-                                        (vd_data.flatten('F')).astype(float)))
+        cruise.setVeinsAndDuraProbabilityImage(to_jarray(vd_data[box],
+                                                         'float'))
 
     # execute
     try:
@@ -209,67 +214,46 @@ def cruise_cortex_extraction(init_image, wm_image, gm_image, csf_image,
         raise
         return
 
-    # reshape output to what nibabel likes
-    cortex_data = np.reshape(np.array(cruise.getCortexMask(),
-                                      dtype=np.int32), dimensions, 'F')
-    gwb_data = np.reshape(np.array(cruise.getWMGMLevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-    cgb_data = np.reshape(np.array(cruise.getGMCSFLevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-    avg_data = np.reshape(np.array(cruise.getCentralLevelset(),
-                                   dtype=np.float32), dimensions, 'F')
-    thick_data = np.reshape(np.array(cruise.getCorticalThickness(),
-                                     dtype=np.float32), dimensions, 'F')
-    pwm_data = np.reshape(np.array(cruise.getCerebralWMprobability(),
-                                   dtype=np.float32), dimensions, 'F')
-    pgm_data = np.reshape(np.array(cruise.getCorticalGMprobability(),
-                                   dtype=np.float32), dimensions, 'F')
-    pcsf_data = np.reshape(np.array(cruise.getSulcalCSFprobability(),
-                                    dtype=np.float32), dimensions, 'F')
-
-    # adapt header min, max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_min'] = np.nanmax(cortex_data)
-    header['cal_max'] = np.nanmax(cortex_data)
-    cortex = nb.Nifti1Image(cortex_data, affine, header)
-
-    header['cal_min'] = np.nanmax(gwb_data)
-    header['cal_max'] = np.nanmax(gwb_data)
-    gwb = nb.Nifti1Image(gwb_data, affine, header)
-
-    header['cal_min'] = np.nanmax(cgb_data)
-    header['cal_max'] = np.nanmax(cgb_data)
-    cgb = nb.Nifti1Image(cgb_data, affine, header)
-
-    header['cal_min'] = np.nanmax(avg_data)
-    header['cal_max'] = np.nanmax(avg_data)
-    avg = nb.Nifti1Image(avg_data, affine, header)
-
-    header['cal_min'] = np.nanmax(thick_data)
-    header['cal_max'] = np.nanmax(thick_data)
-    thickness = nb.Nifti1Image(thick_data, affine, header)
-
-    header['cal_min'] = np.nanmax(pwm_data)
-    header['cal_max'] = np.nanmax(pwm_data)
-    pwm = nb.Nifti1Image(pwm_data, affine, header)
-
-    header['cal_min'] = np.nanmax(pgm_data)
-    header['cal_max'] = np.nanmax(pgm_data)
-    pgm = nb.Nifti1Image(pgm_data, affine, header)
-
-    header['cal_min'] = np.nanmax(pcsf_data)
-    header['cal_max'] = np.nanmax(pcsf_data)
-    pcsf = nb.Nifti1Image(pcsf_data, affine, header)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, cortex_file), cortex)
-        save_volume(os.path.join(output_dir, gwb_file), gwb)
-        save_volume(os.path.join(output_dir, cgb_file), cgb)
-        save_volume(os.path.join(output_dir, avg_file), avg)
-        save_volume(os.path.join(output_dir, thick_file), thickness)
-        save_volume(os.path.join(output_dir, pwm_file), pwm)
-        save_volume(os.path.join(output_dir, pgm_file), pgm)
-        save_volume(os.path.join(output_dir, pcsf_file), pcsf)
-
-    return {'cortex': cortex, 'gwb': gwb, 'cgb': cgb, 'avg': avg,
-            'thickness': thickness, 'pwm': pwm, 'pgm': pgm, 'pcsf': pcsf}
+    report_heap_usage('cruise_cortex_extraction')
+
+    # Java methods returning each output, its data type and file suffix
+    getters = {'cortex': (cruise.getCortexMask, np.int32, 'cruise_cortex'),
+               'gwb': (cruise.getWMGMLevelset, np.float32, 'cruise_gwb'),
+               'cgb': (cruise.getGMCSFLevelset, np.float32, 'cruise_cgb'),
+               'avg': (cruise.getCentralLevelset, np.float32, 'cruise_avg'),
+               'thickness': (cruise.getCorticalThickness, np.float32,
+                             'cruise_thick'),
+               'pwm': (cruise.getCerebralWMprobability, np.float32,
+                       'cruise_pwm'),
+               'pgm': (cruise.getCorticalGMprobability, np.float32,
+                       'cruise_pgm'),
+               'pcsf': (cruise.getSulcalCSFprobability, np.float32,
+                        'cruise_pcsf')}
+
+    results = {}
+    for output in outputs:
+        # reshape output to what nibabel likes
+        getter, dtype, suffix = getters[output]
+        levelset = output in ('gwb', 'cgb', 'avg')
+        data = _uncrop(from_jarray(getter(), crop_dimensions, dtype), box,
+                       dimensions, levelset=levelset)
+
+        # adapt header min, max for each image so that correct range is
+        # displayed and create nifiti objects
+        header['cal_min'] = np.nanmin(data)
+        header['cal_max'] = np.nanmax(data)
+        results[output] = nb.Nifti1Image(data, affine, header)
+        if narrow_band is not None and levelset:
+            results[output] = NarrowBandLevelset.from_nifti(results[output],
+                                                            narrow_band)
+
+        if save_data:
+            output_file = _fname_4saving(file_name=file_name,
+                                         rootfile=gm_image,
+                                         suffix=suffix)
+            if narrow_band is not None and levelset:
+                output_file = _sparse_fname(output_file)
+            save_volume(os.path.join(output_dir, output_file),
+                        results[output])
+
+    return results
@@ -2,15 +2,38 @@ import numpy as np
 import nibabel as nb
 import os
 import sys
+from multiprocessing.pool import ThreadPool
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
                     _check_topology_lut_dir
 
+# memory used by the Fourier transforms of the slabs of the time series
+# being filtered at once
+_SLAB_MEMORY = 256 * 1024 * 1024
+
+
+def _real_fft():
+    # real Fourier transforms of the fastest backend installed: pyFFTW or
+    # scipy.fft (scipy >= 1.4), which both release the interpreter lock
+    # while they run, or numpy
+    try:
+        import pyfftw
+        pyfftw.interfaces.cache.enable()
+        return (pyfftw.interfaces.numpy_fft.rfft,
+                pyfftw.interfaces.numpy_fft.irfft, 'pyfftw')
+    except ImportError:
+        pass
+    try:
+        import scipy.fft
+        return scipy.fft.rfft, scipy.fft.irfft, 'scipy'
+    except ImportError:
+        return np.fft.rfft, np.fft.irfft, 'numpy'
+
 
 def bandpass_filtering(time_series, repetition_time,
                        low_frequency=0.01, high_frequency=0.1,
-                       save_data=False, output_dir=None,
+                       n_jobs=1, save_data=False, output_dir=None,
                        file_name=None):
     """ Basic bandpass filtering
 
@@ -28,6 +51,9 @@ def bandpass_filtering(time_series, repetition_time,
         High frequency cutoff (default is 0.1 Hz)
     repetition_time: float
         Time interval between samples, aka repetition time or TR
+    n_jobs: int
+        Number of threads filtering slabs of the time series in parallel
+        (default is 1)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -42,10 +68,22 @@ def bandpass_filtering(time_series, repetition_time,
         Dictionary collecting outputs under the following keys
         (suffix of output files in brackets)
 
-        * filtered (niimg): Binary brain mask (_bpf)
+        * filtered (niimg): Bandpass filtered time series (_bpf)
 
     Notes
     ----------
+    The time series are processed by slabs of a few slices, with real
+    Fourier transforms, so that the working memory stays small whatever the
+    length of the series. Uncompressed input files are memory-mapped, and
+    if the output is saved as an uncompressed nifti file (.nii) each slab
+    is written directly into it, so that the filtered series is never held
+    in memory as a whole.
+
+    The transforms use pyFFTW or scipy.fft if installed, and numpy
+    otherwise. With n_jobs > 1 the slabs are shared between threads, which
+    run in parallel with pyFFTW and scipy.fft as they release the Python
+    interpreter lock (and with numpy from version 1.17); the slabs are
+    then made smaller so that the memory used stays the same.
 
     References
     ----------
@@ -53,66 +91,131 @@ def bandpass_filtering(time_series, repetition_time,
 
     print('\nBandpass filtering')
 
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be at least 1")
+
     # make sure that saving related parameters are correct
     if save_data:
-        output_dir = _output_dir_4saving(output_dir, second_inversion)
-    
+        output_dir = _output_dir_4saving(output_dir, time_series)
+
         filtered_file = _fname_4saving(file_name=file_name,
-                                   rootfile=time_series,
-                                   suffix='bpf')
-    
-     # get dimensions and resolution from second inversion image
+                                       rootfile=time_series,
+                                       suffix='bpf')
+
+    # get dimensions and resolution from the time series, reading slabs
+    # directly from uncompressed files (which are memory-mapped), while
+    # compressed files have to be decompressed at once
     img = load_volume(time_series)
-    data = img.get_data()
-    affine = img.affine #or img.get_affine(), which I think is being deprecated?
-    header = img.header
-    
-    length = np.shape(data)[3]
-    
+    if isinstance(time_series, basestring) and time_series.endswith('.gz'):
+        data = img.get_data()
+    else:
+        data = img.dataobj
+    affine = img.get_affine()
+    dimensions = img.shape
+    length = dimensions[3]
+
     print("defining the frequency window")
     nextpowerof2 = np.ceil(np.log2(length))
     padded = int(np.power(2, nextpowerof2))
-    
-    #print("freq:",freq,"lf:",low,"hf:",high,"length:",padded)
-    if (low >= freq/2):
-    	lowid = int(padded/2)
+
+    freq = 1.0 / repetition_time
+    if (low_frequency >= freq / 2):
+        lowid = int(padded / 2)
     else:
-    	lowid = int(np.ceil(low*padded*tr))
-    
-    if (high >= freq/2):
-    	highid = int(padded/2)
+        lowid = int(np.ceil(low_frequency * padded * repetition_time))
+
+    if (high_frequency >= freq / 2):
+        highid = int(padded / 2)
     else:
-    	highid = int(np.floor(high*padded*tr))
-    
-    frequencymask = np.zeros(padded)
-    frequencymask[lowid+1:highid+1] = 1
-    frequencymask[padded-highid:padded-lowid] = 1
-    #print(lowid,highid)
-    #print(frequencymask)
-    
-    print("removing the mean")
-    datamean = data.mean(3,keepdims=True)
-    datamean = np.repeat(datamean,length,axis=3)
-    
-    data = np.pad(data-datamean,((0,0),(0,0),(0,0),(0,padded-length)),'constant') 
-    #print("shape: ",np.shape(data))
-    
-    print("filtering")
-    data = np.fft.fft(data,axis=3)
-    #print("shape: ",np.shape(data))
-    data[:,:,:,np.nonzero(frequencymask==0)] = 0
-    data = np.real(np.fft.ifft(data,axis=3))
-    
-    data = data[:,:,:,0:length]+datamean
-    
+        highid = int(np.floor(high_frequency * padded * repetition_time))
+
+    # the window is symmetric in the full spectrum, so only the positive
+    # frequencies of the real transform need to be masked
+    frequencymask = np.zeros(padded // 2 + 1, dtype=bool)
+    frequencymask[lowid + 1:highid + 1] = True
+
+    # output is written directly to file if possible, kept in memory
+    # otherwise
+    if save_data and filtered_file.endswith('.nii'):
+        filtered_data, header = _memmap_nifti(
+                                    os.path.join(output_dir, filtered_file),
+                                    dimensions, affine, img.get_header())
+    else:
+        filtered_data = np.zeros(dimensions, dtype=np.float32, order='F')
+        header = img.get_header().copy()
+
+    # number of slices filtered at once by each thread
+    slab = max(1, int(_SLAB_MEMORY // (16 * (padded // 2 + 1) * n_jobs *
+                                       dimensions[0] * dimensions[1])))
+    rfft, irfft, backend = _real_fft()
+
+    def filter_slab(start):
+        stop = min(start + slab, dimensions[2])
+        slab_data = np.asarray(data[:, :, start:stop, :], dtype=np.float64)
+
+        # remove the mean, the transforms pad the series with zeros
+        slab_mean = slab_data.mean(axis=3, keepdims=True)
+        spectrum = rfft(slab_data - slab_mean, n=padded, axis=3)
+        spectrum[:, :, :, ~frequencymask] = 0
+        filtered = irfft(spectrum, n=padded, axis=3)[:, :, :, 0:length]
+        filtered += slab_mean
+        filtered_data[:, :, start:stop, :] = filtered
+        return np.min(filtered), np.max(filtered)
+
+    print("filtering ({0} FFT, {1} thread(s))".format(backend, n_jobs))
+    starts = range(0, dimensions[2], slab)
+    if n_jobs > 1:
+        pool = ThreadPool(n_jobs)
+        try:
+            ranges = pool.map(filter_slab, starts, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        ranges = [filter_slab(start) for start in starts]
+
     # collect outputs and potentially save
-    filtered_img = nb.Nifti1Image(data, affine, header)
-    filtered_img.header['cal_min'] = np.min(data)
-    filtered_img.header['cal_max'] = np.max(data)
-    
+    header['cal_min'] = min(low for low, high in ranges)
+    header['cal_max'] = max(high for low, high in ranges)
+
+    if save_data and filtered_file.endswith('.nii'):
+        filtered_data.flush()
+        filtered_img = _close_memmap_nifti(
+                            os.path.join(output_dir, filtered_file), header)
+    else:
+        filtered_img = nb.Nifti1Image(filtered_data, affine, header)
+        if save_data:
+            save_volume(os.path.join(output_dir, filtered_file),
+                        filtered_img)
+
     outputs = {'filtered': filtered_img}
-    
-    if save_data:
-        save_volume(os.path.join(output_dir, filtered_file), filtered)
-    
+
     return outputs
+
+
+def _memmap_nifti(filename, dimensions, affine, header):
+    # creates a float32 nifti file and returns its memory-mapped data, so
+    # that the output can be written slab by slab
+    image = nb.Nifti1Image(np.zeros((1, 1, 1, 1), dtype=np.float32), affine,
+                           nb.Nifti1Header.from_header(header))
+    image.update_header()
+    header = image.get_header()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(dimensions)
+    header.set_slope_inter(1, 0)
+    header['vox_offset'] = 352
+    with open(filename, 'wb') as fp:
+        fp.write(header.binaryblock)
+        # empty extension flag
+        fp.write(b'\x00' * 4)
+    data = np.memmap(filename, dtype=header.get_data_dtype(), mode='r+',
+                     offset=352, shape=tuple(dimensions), order='F')
+    return data, header
+
+
+def _close_memmap_nifti(filename, header):
+    # writes the final header of a memory-mapped nifti file and reloads it
+    with open(filename, 'r+b') as fp:
+        fp.write(header.binaryblock)
+    print("\nSaving {0}").format(filename)
+    return load_volume(filename)
@@ -6,7 +6,11 @@ import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
     _check_topology_lut_dir, _check_atlas_file
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
+@cached
 def filter_ridge_structures(input_image,
                             structure_intensity='bright',
                             output_type='probability',
@@ -62,10 +66,7 @@ def filter_ridge_structures(input_image,
     outputs = {}
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(input_image)
     # create algorithm instance
     filter_ridge = cbstools.FilterRidgeStructures()
 
@@ -88,8 +89,7 @@ def filter_ridge_structures(input_image,
     filter_ridge.setResolutions(resolution[0], resolution[1], resolution[2])
 
     data = load_volume(input_image).get_data()
-    filter_ridge.setInputImage(cbstools.JArray('float')(
-                               (data.flatten('F')).astype(float)))
+    filter_ridge.setInputImage(to_jarray(data, 'float'))
 
 
     # execute
@@ -103,10 +103,12 @@ def filter_ridge_structures(input_image,
         raise
         return
 
+    report_heap_usage('filter_ridge_structures')
+
     # Collect output
-    ridge_structure_image_data = np.reshape(np.array(
+    ridge_structure_image_data = from_jarray(
                                     filter_ridge.getRidgeStructureImage(),
-                                    dtype=np.float32), dimensions, 'F')
+                                    dimensions)
 
     if output_type == 'probability':
         header['cal_min'] = 0.0
@@ -5,14 +5,19 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_atlas_file, \
+                    _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surface_levelset,
                               orientation, ang_factor, loc_prior, min_scale, 
                               max_scale, propagation_model, diffusion_factor, 
                               similarity_scale, neighborhood_size,
-                              max_iter, max_diff,
+                              max_iter, max_diff, outputs=None,
                               save_data=False, output_dir=None,
                               file_name=None):
     
@@ -51,13 +56,19 @@ def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surf
 	max_iter:
 
 	max_diff:
+
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     
     Returns
     ----------
    	dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
+        * ridge_pv (niimg): 
         * filter (niimg): 
         * proba (niimg): 
         * propagation (niimg): 
@@ -77,6 +88,12 @@ def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surf
 
     print('\n Recursive Ridge Diffusion')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['ridge_pv', 'filter', 'proba',
+                                       'propagation', 'scale',
+                                       'ridge_direction', 'correction',
+                                       'ridge_size'])
+
     # check atlas_file and set default if not given
     #atlas_file = _check_atlas_file(atlas_file)
 
@@ -84,43 +101,8 @@ def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surf
     if save_data:
         output_dir = _output_dir_4saving(output_dir, input_image)
 
-        ridge_pv_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_pv')
-
-        filter_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_filter')
-
-        proba_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_proba')
-
-        propagation_file = _fname_4saving(file_name=file_name,
-                                   rootfile=input_image,
-                                   suffix='rrd_propag')
-
-        scale_file = _fname_4saving(file_name=file_name,
-                                   rootfile=input_image,
-                                   suffix='rrd_scale')
-
-        ridge_direction_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_dir')
-
-        correction_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_correct')
-        
-        ridge_size_file = _fname_4saving(file_name=file_name,
-                                  rootfile=input_image,
-                                  suffix='rrd_size')
-
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(input_image)
     # create extraction instance
     rrd = cbstools.FilterRecursiveRidgeDiffusion()
 
@@ -151,19 +133,19 @@ def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surf
     rrd.setResolutions(resolution[0], resolution[1], resolution[2])
 
     # input input_image
-    rrd.setInputImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    rrd.setInputImage(to_jarray(data, 'float'))
 
     # input surface_levelset : dirty fix for the case where surface image not input
     try:
         data = load_volume(surface_levelset).get_data()
-        rrd.setSurfaceLevelSet(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+        rrd.setSurfaceLevelSet(to_jarray(data, 'float'))
     except:
         print("no surface image")
     
     # input location prior image : loc_prior is optional
     try:
         data = load_volume(loc_prior).get_data()
-        rrd.setLocationPrior(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+        rrd.setLocationPrior(to_jarray(data, 'float'))
     except:
         print("no location prior image")
     
@@ -179,68 +161,45 @@ def recursive_ridge_diffusion(input_image, ridge_intensities, ridge_filter, surf
         raise
         return
 
-    # reshape output to what nibabel likes
-    ridge_pv_data = np.reshape(np.array(rrd.getRidgePartialVolumeImage(),
-                                   dtype=np.float32), dimensions, 'F')
-        
-    filter_data = np.reshape(np.array(rrd.getFilterResponseImage(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    proba_data = np.reshape(np.array(rrd.getProbabilityResponseImage(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    propagation_data = np.reshape(np.array(rrd.getPropagatedResponseImage(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    scale_data = np.reshape(np.array(rrd.getDetectionScaleImage(),
-                                   dtype=np.int32), dimensions, 'F')
-
-    ridge_direction_data = np.reshape(np.array(rrd.getRidgeDirectionImage(),
-                                    dtype=np.float32), (dimensions[0],dimensions[1],dimensions[2],3) , 'F')
-    
-    correction_data = np.reshape(np.array(rrd.getDirectionalCorrectionImage(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    ridge_size_data = np.reshape(np.array(rrd.getRidgeSizeImage(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_max'] = np.nanmax(ridge_pv_data)
-    ridge_pv = nb.Nifti1Image(ridge_pv_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(filter_data)
-    filter = nb.Nifti1Image(filter_data, affine, header)
-
-    header['cal_max'] = np.nanmax(proba_data)
-    proba = nb.Nifti1Image(proba_data, affine, header)
-
-    header['cal_max'] = np.nanmax(propagation_data)
-    propagation = nb.Nifti1Image(propagation_data, affine, header)
-
-    header['cal_max'] = np.nanmax(scale_data)
-    scale = nb.Nifti1Image(scale_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(ridge_direction_data)
-    ridge_direction = nb.Nifti1Image(ridge_direction_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(correction_data)
-    correction = nb.Nifti1Image(correction_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(ridge_size_data)
-    ridge_size = nb.Nifti1Image(ridge_size_data, affine, header)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, ridge_pv_file), ridge_pv)
-        save_volume(os.path.join(output_dir, filter_file), filter)
-        save_volume(os.path.join(output_dir, proba_file), proba)
-        save_volume(os.path.join(output_dir, propagation_file), propagation)
-        save_volume(os.path.join(output_dir, scale_file), scale)
-        save_volume(os.path.join(output_dir, ridge_direction_file), ridge_direction)
-        save_volume(os.path.join(output_dir, correction_file), correction)
-        save_volume(os.path.join(output_dir, ridge_size_file), ridge_size)
-
-    return {'ridge_pv': ridge_pv, 'filter': filter, 'proba': proba,
-            'propagation': propagation, 'scale': scale,
-            'ridge_direction': ridge_direction, 'correction': correction, 'ridge_size': ridge_size}
+    report_heap_usage('recursive_ridge_diffusion')
+
+    # Java methods returning each output, its data type and file suffix
+    getters = {'ridge_pv': (rrd.getRidgePartialVolumeImage, np.float32,
+                            'rrd_pv'),
+               'filter': (rrd.getFilterResponseImage, np.float32,
+                          'rrd_filter'),
+               'proba': (rrd.getProbabilityResponseImage, np.float32,
+                         'rrd_proba'),
+               'propagation': (rrd.getPropagatedResponseImage, np.float32,
+                               'rrd_propag'),
+               'scale': (rrd.getDetectionScaleImage, np.int32, 'rrd_scale'),
+               'ridge_direction': (rrd.getRidgeDirectionImage, np.float32,
+                                   'rrd_dir'),
+               'correction': (rrd.getDirectionalCorrectionImage, np.float32,
+                              'rrd_correct'),
+               'ridge_size': (rrd.getRidgeSizeImage, np.float32, 'rrd_size')}
+
+    results = {}
+    for output in outputs:
+        # reshape output to what nibabel likes, the ridge direction has
+        # a 4th dimension for the vector components
+        getter, dtype, suffix = getters[output]
+        if output == 'ridge_direction':
+            shape = (dimensions[0], dimensions[1], dimensions[2], 3)
+        else:
+            shape = dimensions
+        data = from_jarray(getter(), shape, dtype)
+
+        # adapt header max for each image so that correct max is displayed
+        # and create nifiti objects
+        header['cal_max'] = np.nanmax(data)
+        results[output] = nb.Nifti1Image(data, affine, header)
+
+        if save_data:
+            output_file = _fname_4saving(file_name=file_name,
+                                         rootfile=input_image,
+                                         suffix=suffix)
+            save_volume(os.path.join(output_dir, output_file),
+                        results[output])
+
+    return results
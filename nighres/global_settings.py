@@ -6,3 +6,30 @@ ATLAS_DIR = os.path.join(__dir__, 'atlases')
 TOPOLOGY_LUT_DIR = os.path.join(ATLAS_DIR, 'topology_lut')
 DEFAULT_ATLAS = os.path.join(ATLAS_DIR, 'brain-segmentation-prior3.0',
                              'brain-atlas-3.0.3.txt')
+
+# directory in which uncompressed copies of the topology look-up tables are
+# written once (64 MB each), so that the Java modules map them in memory
+# rather than decompressing them. Not used if not set
+TOPOLOGY_LUT_CACHE_DIR = os.environ.get('NIGHRES_TOPOLOGY_LUT_CACHE_DIR')
+
+# Java heap for the cbstools virtual machine, e.g. '8000m' or '16g'. If not
+# set, the heap is sized from the first volume processed in the session
+JVM_INITIAL_HEAP = os.environ.get('NIGHRES_JVM_INITIAL_HEAP')
+JVM_MAX_HEAP = os.environ.get('NIGHRES_JVM_MAX_HEAP')
+
+# directory in which module results are cached (see nighres.cache), the
+# cache is disabled if not set, and its maximum size in gigabytes
+CACHE_DIR = os.environ.get('NIGHRES_CACHE_DIR')
+CACHE_MAX_SIZE = os.environ.get('NIGHRES_CACHE_MAX_SIZE', 20)
+
+# compression of the images saved by the modules (save_data=True): 'gzip'
+# keeps the .nii.gz files, 'none' saves them as uncompressed .nii files,
+# which are faster to write and to read again in the next processing step.
+# Images saved with save_volume under a given name keep their extension
+COMPRESSION = os.environ.get('NIGHRES_COMPRESSION', 'gzip')
+# gzip level of the .nii.gz files, from 1 (fastest) to 9 (smallest)
+COMPRESSION_LEVEL = os.environ.get('NIGHRES_COMPRESSION_LEVEL', 1)
+
+# how .nii.gz images are read (see nighres.io.load_volume): 'nibabel',
+# 'zlib' or 'pigz'
+GZIP_READER = os.environ.get('NIGHRES_GZIP_READER', 'nibabel')
@@ -1,3 +1,6 @@
-from io_volume import load_volume, save_volume
+from io_volume import load_volume, save_volume, configure_compression, \
+                      BackgroundWriter
 from io_mesh import load_mesh_geometry, save_mesh_geometry, \
                     load_mesh_data, save_mesh_data
+from io_sparse import SparseVolume, NarrowBandLevelset
+from io_atlas import Atlas
@@ -0,0 +1,201 @@
+import os
+import threading
+import numpy as np
+from ..utils import _check_atlas_file
+
+_ATLAS_HEADER = 'Structure Atlas File (edit at your own risks)'
+
+# atlases already parsed, keyed by path and modification time of their file
+_atlases = {}
+_atlases_lock = threading.Lock()
+
+
+def _fields(line):
+    # the fields of the atlas files are separated by one or more tabs
+    return [field.strip() for field in line.split('\t') if field.strip()]
+
+
+def _read_only(values, dtype):
+    values = np.array(values, dtype=dtype)
+    values.setflags(write=False)
+    return values
+
+
+class Atlas(object):
+    '''
+    Brain atlas of the MGDM based modules, parsed once from its text file
+
+    Parameters
+    ----------
+    atlas_file: str
+        Path to plain text atlas file
+
+    Attributes
+    ----------
+    path: str
+        Absolute path of the atlas file, which the Java modules read
+    structures: list of str
+        Names of the structures of the atlas
+    labels: np.ndarray
+        Label of each structure in the segmentations
+    types: list of str
+        Type of each structure (e.g. 'gm', 'wm', 'csf' or 'mask')
+    contrasts: list of str
+        Names of the contrasts with intensity priors, in the order of the
+        file
+    intensity_priors: dict
+        Intensity priors of each contrast, as an array with one row per
+        structure (typically the median, spread and weight of the intensity)
+    topology: dict
+        File, dimensions and resolutions of the topology template, or None
+    shapes: dict
+        Dimensions and resolutions of the shape priors, and the file of each
+        structure having one (under 'files'), or None
+    registered_shapes: np.ndarray
+        Whether the shape prior of each structure is registered
+    regularization: np.ndarray
+        Regularization factor of each structure
+
+    Notes
+    ----------
+    Use :meth:`load` to get atlases, which parses each atlas file only once
+    and keeps it for the next calls, until the file is modified. The arrays
+    of the atlas cannot be modified, as the same atlas is shared by all the
+    callers. Atlases can be passed as atlas_file to the modules, the Java
+    modules reading the atlas from its file.
+    '''
+
+    def __init__(self, atlas_file):
+        self.path = os.path.abspath(atlas_file)
+        with open(self.path) as fp:
+            lines = [line.rstrip('\r\n') for line in fp]
+        if not lines or lines[0].strip() != _ATLAS_HEADER:
+            raise ValueError('{0} is not a structure atlas file'.format(
+                             atlas_file))
+
+        self.structures = []
+        self.types = []
+        labels = []
+        self.contrasts = []
+        self.intensity_priors = {}
+        self.topology = None
+        self.shapes = None
+        registered = None
+        regularization = None
+
+        directory = os.path.dirname(self.path)
+        n = 1
+        try:
+            while n < len(lines):
+                line = lines[n]
+                if line.startswith('Structures'):
+                    count = int(_fields(line)[1])
+                    for row in lines[n + 1:n + 1 + count]:
+                        name, label, kind = _fields(row)[:3]
+                        self.structures.append(name)
+                        labels.append(int(label))
+                        self.types.append(kind)
+                    n += count
+                elif line.startswith('Topology Atlas'):
+                    self.topology = {
+                        'file': os.path.join(directory,
+                                             _fields(lines[n + 1])[1]),
+                        'dimensions': tuple(int(value) for value
+                                            in _fields(lines[n + 2])[1:4]),
+                        'resolutions': tuple(float(value) for value
+                                             in _fields(lines[n + 3])[1:4])}
+                    n += 3
+                elif line.startswith('Shape Atlas'):
+                    self.shapes = {
+                        'dimensions': tuple(int(value) for value
+                                            in _fields(lines[n + 1])[1:4]),
+                        'resolutions': tuple(float(value) for value
+                                             in _fields(lines[n + 2])[1:4]),
+                        'files': {}}
+                    n += 3
+                    while n < len(lines) and \
+                            lines[n].startswith('Structure:'):
+                        self.shapes['files'][_fields(lines[n])[1]] = \
+                            os.path.join(directory, _fields(lines[n + 1])[1])
+                        n += 2
+                    continue
+                elif line.startswith('Registered Shapes'):
+                    # the line of structure abbreviations is optional
+                    if not lines[n + 1].startswith(('0', '1')):
+                        n += 1
+                    registered = [int(value) == 1 for value
+                                  in _fields(lines[n + 1])]
+                    n += 1
+                elif line.startswith('Regularization Factor'):
+                    regularization = [float(value) for value
+                                      in _fields(lines[n + 2])]
+                    n += 2
+                elif line.startswith('Intensity Prior:'):
+                    contrast = _fields(line)[1]
+                    count = len(self.structures)
+                    rows = dict((fields[0], [float(value) for value
+                                             in fields[1:]])
+                                for fields in (_fields(row) for row
+                                               in lines[n + 1:n + 1 + count]))
+                    self.contrasts.append(contrast)
+                    self.intensity_priors[contrast] = _read_only(
+                        [rows.get(name, [np.nan] * len(rows.values()[0]))
+                         for name in self.structures], np.float64)
+                    n += count
+                n += 1
+        except (IndexError, ValueError):
+            raise ValueError('Could not parse line {0} of the atlas file '
+                             '{1}'.format(n + 1, atlas_file))
+
+        self.labels = _read_only(labels, np.int32)
+        # default values of the Java modules
+        if registered is None:
+            registered = [index > 0 for index in range(len(labels))]
+        if regularization is None:
+            regularization = [1.0] * len(labels)
+        self.registered_shapes = _read_only(registered[:len(labels)], bool)
+        self.regularization = _read_only(regularization[:len(labels)],
+                                         np.float32)
+
+    @classmethod
+    def load(cls, atlas_file=None):
+        '''
+        Returns the parsed atlas of a file, parsing it only if it has not
+        been parsed since it was last modified
+
+        Parameters
+        ----------
+        atlas_file: str or Atlas, optional
+            Path to plain text atlas file (default is stored in DEFAULT_ATLAS)
+            or atlas name to be searched in ATLAS_DIR. Atlases are returned
+            as they are
+
+        Returns
+        ----------
+        Atlas
+        '''
+        if isinstance(atlas_file, Atlas):
+            return atlas_file
+        path = os.path.abspath(_check_atlas_file(atlas_file))
+        key = (path, os.path.getmtime(path))
+        with _atlases_lock:
+            if key not in _atlases:
+                # forget the earlier versions of the file
+                for old in [old for old in _atlases if old[0] == path]:
+                    del _atlases[old]
+                _atlases[key] = cls(path)
+            return _atlases[key]
+
+    def label(self, structure):
+        '''
+        Returns the label of a structure of the atlas
+        '''
+        if structure not in self.structures:
+            raise ValueError("{0} is not a structure of the atlas, please "
+                             "choose from the following structures: "
+                             "{1}".format(structure,
+                                          ", ".join(self.structures)))
+        return int(self.labels[self.structures.index(structure)])
+
+    def __repr__(self):
+        return 'Atlas({0!r})'.format(self.path)
@@ -1,3 +1,4 @@
+import re
 import nibabel as nb
 import numpy as np
 
@@ -14,7 +15,7 @@ def load_mesh_geometry(surf_mesh):
     surf_mesh:
         Mesh geometry to be loaded, can be a path to a file
         (currently supported formats are freesurfer geometry formats,
-        gii and ASCII-coded vtk, ply or obj) or a dictionary with the
+        gii, ASCII or binary coded vtk and ply, and obj) or a dictionary with the
         keys "coords" and "faces"
 
     Returns
@@ -41,9 +42,10 @@ def load_mesh_geometry(surf_mesh):
                 surf_mesh.endswith('inflated')):
             coords, faces = nb.freesurfer.io.read_geometry(surf_mesh)
         elif surf_mesh.endswith('gii'):
-            coords, faces = nb.gifti.read(surf_mesh).getArraysFromIntent(
-                nb.nifti1.intent_codes['NIFTI_INTENT_POINTSET'])[0].data, \
-                nb.gifti.read(surf_mesh).getArraysFromIntent(
+            gii = nb.gifti.read(surf_mesh)
+            coords = gii.getArraysFromIntent(
+                nb.nifti1.intent_codes['NIFTI_INTENT_POINTSET'])[0].data
+            faces = gii.getArraysFromIntent(
                 nb.nifti1.intent_codes['NIFTI_INTENT_TRIANGLE'])[0].data
         elif surf_mesh.endswith('vtk'):
             coords, faces, _ = _read_vtk(surf_mesh)
@@ -77,7 +79,8 @@ def load_mesh_data(surf_data, gii_darray=None):
     surf_data:
         Mesh data to be loaded, can be a Numpy array or a path to a file.
         Currently supported formats are freesurfer data formats (mgz, curv,
-        sulc, thickness, annot, label), nii, gii, ASCII-coded vtk and txt
+        sulc, thickness, annot, label), nii, gii, ASCII or binary coded vtk
+        and txt
     gii_darray: int, optional
         Index of gii data array to load (default is to load all)
 
@@ -131,8 +134,8 @@ def load_mesh_data(surf_data, gii_darray=None):
         else:
             raise ValueError('Format of data file not recognized. Currently '
                              'supported formats are freesurfer data formats '
-                             '(mgz, sulc, curv, thickness, annot, label)'
-                             'nii', 'gii, ASCII-coded vtk and txt')
+                             '(mgz, sulc, curv, thickness, annot, label), '
+                             'nii, gii, vtk and txt')
     elif isinstance(surf_data, np.ndarray):
         data = np.squeeze(surf_data)
     return data
@@ -177,7 +180,7 @@ def save_mesh_data(filename, surf_data):
         raise ValueError('Filename must be a string')
 
 
-def save_mesh_geometry(filename, surf_dict):
+def save_mesh_geometry(filename, surf_dict, binary=False):
     '''
     Saves surface mesh geometry to file
 
@@ -186,12 +189,15 @@ def save_mesh_geometry(filename, surf_dict):
     filename: str
         Full path and filename under which surfaces data should be saved. The
         extension determines the file format. Currently supported are
-        freesurfer geometry formats, gii and ASCII-coded vtk, obj, ply'
+        freesurfer geometry formats, gii, vtk, ply and ASCII-coded obj
     surf_dict: dict
         Surface mesh geometry to be saved. Dictionary with a numpy array with
         key "coords" for a Numpy array of the x-y-z coordinates of the mesh
         vertices and key "faces2 for a Numpy array of the the indices
         (into coords) of the mesh faces
+    binary: bool
+        Write vtk and ply files in binary rather than ASCII format, which is
+        much smaller and faster for large meshes (default is False)
 
     Notes
     ----------
@@ -216,13 +222,15 @@ def save_mesh_geometry(filename, surf_dict):
         elif filename.endswith('vtk'):
             if 'data' in surf_dict.keys():
                 _write_vtk(filename, surf_dict['coords'], surf_dict['faces'],
-                           surf_dict['data'])
+                           surf_dict['data'], binary=binary)
                 print("\nSaving {0}").format(filename)
             else:
-                _write_vtk(filename, surf_dict['coords'], surf_dict['faces'])
+                _write_vtk(filename, surf_dict['coords'], surf_dict['faces'],
+                           binary=binary)
                 print("\nSaving {0}").format(filename)
         elif filename.endswith('ply'):
-            _write_ply(filename, surf_dict['coords'], surf_dict['faces'])
+            _write_ply(filename, surf_dict['coords'], surf_dict['faces'],
+                       binary=binary)
             print("\nSaving {0}").format(filename)
         elif filename.endswith('obj'):
             _write_obj(filename, surf_dict['coords'], surf_dict['faces'])
@@ -234,106 +242,205 @@ def save_mesh_geometry(filename, surf_dict):
                          'dictionary with keys "coords" and "faces"')
 
 
-# function to read vtk files
-# ideally use pyvtk, but it didn't work for our data, look into why
+# numpy types of the data types used in vtk files
+_VTK_TYPES = {'bit': 'u1', 'unsigned_char': 'u1', 'char': 'i1',
+              'unsigned_short': 'u2', 'short': 'i2',
+              'unsigned_int': 'u4', 'int': 'i4',
+              'unsigned_long': 'u8', 'long': 'i8',
+              'float': 'f4', 'double': 'f8'}
+
+# numpy types of the property types used in ply files
+_PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+              'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+              'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+              'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+# keyword lines starting the sections of a vtk file
+_VTK_KEYWORD = re.compile(r'^[A-Z][A-Z_]+\b', re.MULTILINE)
+
+
+def _next_line(content, pos):
+    # returns the next non-empty line of content and the position after it
+    while pos < len(content):
+        end = content.find('\n', pos)
+        if end < 0:
+            end = len(content)
+        line = content[pos:end].strip()
+        pos = end + 1
+        if line:
+            return line, pos
+    return None, pos
+
+
+def _read_vtk_section(content, pos, count, dtype, binary):
+    # reads count values of a vtk data section starting at pos, returns them
+    # with the position of the rest of the file
+    if binary:
+        # binary vtk data is always big endian
+        dtype = np.dtype(dtype).newbyteorder('>')
+        values = np.frombuffer(content, dtype=dtype, count=count, offset=pos)
+        return values.astype(dtype.newbyteorder('=')), pos + values.nbytes
+    else:
+        match = _VTK_KEYWORD.search(content, pos)
+        end = match.start() if match else len(content)
+        values = np.fromstring(content[pos:end], sep=' ')
+        if values.size < count:
+            raise ValueError('The vtk file is truncated')
+        # ASCII values are returned as parsed, in double precision, unless
+        # the section holds integers
+        if np.dtype(dtype).kind != 'f':
+            return values[:count].astype(int), end
+        return values[:count], end
+
+
+# single pass reader for legacy vtk polydata files, the data sections are
+# parsed in bulk rather than line by line
 def _read_vtk(file):
     '''
-    Reads ASCII coded vtk files using pandas,
+    Reads ASCII or binary coded vtk files,
     returning vertices, faces and data as three numpy arrays.
+    ASCII coded points and data are read as float64, binary coded ones
+    keep the type stored in the file.
     '''
-    import pandas as pd
-    import csv
-    # read full file while dropping empty lines
-    try:
-        vtk_df = pd.read_csv(file, header=None, engine='python')
-    except csv.Error:
-        raise ValueError(
-            'This vtk file appears to be binary coded currently only ASCII '
-            'coded vtk files can be read')
-    vtk_df = vtk_df.dropna()
-    # extract number of vertices and faces
-    number_vertices = int(vtk_df[vtk_df[0].str.contains(
-                                            'POINTS')][0].iloc[0].split()[1])
-    number_faces = int(vtk_df[vtk_df[0].str.contains(
-                                            'POLYGONS')][0].iloc[0].split()[1])
-    # read vertices into df and array
-    start_vertices = (vtk_df[vtk_df[0].str.contains(
-                                            'POINTS')].index.tolist()[0]) + 1
-    vertex_df = pd.read_csv(file, skiprows=range(start_vertices),
-                            nrows=number_vertices, sep='\s*',
-                            header=None, engine='python')
-    if np.array(vertex_df).shape[1] == 3:
-        vertex_array = np.array(vertex_df)
-    # sometimes the vtk format is weird with 9 indices per line,
-    # then it has to be reshaped
-    elif np.array(vertex_df).shape[1] == 9:
-        vertex_df = pd.read_csv(file, skiprows=range(start_vertices),
-                                nrows=int(number_vertices / 3) + 1,
-                                sep='\s*', header=None, engine='python')
-        vertex_array = np.array(vertex_df.iloc[0:1, 0:3])
-        vertex_array = np.append(vertex_array, vertex_df.iloc[0:1, 3:6],
-                                 axis=0)
-        vertex_array = np.append(vertex_array, vertex_df.iloc[0:1, 6:9],
-                                 axis=0)
-        for row in range(1, (int(number_vertices / 3) + 1)):
-            for col in [0, 3, 6]:
-                vertex_array = np.append(vertex_array, np.array(
-                    vertex_df.iloc[row:(row + 1), col:(col + 3)]), axis=0)
-        # strip rows containing nans
-        vertex_array = vertex_array[~np.isnan(vertex_array)].reshape(
-                                                            number_vertices, 3)
-    else:
-        print "vertex indices out of shape"
-    # read faces into df and array
-    start_faces = (vtk_df[vtk_df[0].str.contains(
-                                            'POLYGONS')].index.tolist()[0]) + 1
-    face_df = pd.read_csv(file, skiprows=range(start_faces),
-                          nrows=number_faces, sep='\s*', header=None,
-                          engine='python')
-    face_array = np.array(face_df.iloc[:, 1:4])
-    # read data into df and array if exists
-    if vtk_df[vtk_df[0].str.contains('POINT_DATA')].index.tolist() != []:
-        start_data = (vtk_df[vtk_df[0].str.contains(
-                                        'POINT_DATA')].index.tolist()[0]) + 3
-        number_data = number_vertices
-        data_df = pd.read_csv(file, skiprows=range(start_data),
-                              nrows=number_data, sep='\s*', header=None,
-                              engine='python')
-        data_array = np.array(data_df)
-    else:
-        data_array = np.empty(0)
+    with open(file, 'rb') as fp:
+        content = fp.read()
+
+    # fixed header: version, comment, encoding and dataset type
+    pos = content.find('\n') + 1
+    pos = content.find('\n', pos) + 1
+    encoding, pos = _next_line(content, pos)
+    binary = encoding.upper() == 'BINARY'
+    dataset, pos = _next_line(content, pos)
+    if dataset is None or dataset.split()[-1].upper() != 'POLYDATA':
+        raise ValueError('Only vtk files with polydata datasets can be read')
+
+    vertex_array = None
+    face_array = None
+    data_array = np.empty(0)
+    number_data = None
+    while True:
+        line, pos = _next_line(content, pos)
+        if line is None:
+            break
+        keyword = line.split()
+        if keyword[0] == 'POINTS':
+            number_vertices = int(keyword[1])
+            values, pos = _read_vtk_section(content, pos, 3 * number_vertices,
+                                            _VTK_TYPES[keyword[2].lower()],
+                                            binary)
+            vertex_array = values.reshape(number_vertices, 3)
+        elif keyword[0] == 'POLYGONS':
+            number_faces, size = int(keyword[1]), int(keyword[2])
+            values, pos = _read_vtk_section(content, pos, size, 'i4', binary)
+            if size != 4 * number_faces or np.any(values[::4] != 3):
+                raise ValueError('Only triangular meshes can be read')
+            face_array = values.reshape(number_faces, 4)[:, 1:].astype(int)
+        elif keyword[0] == 'POINT_DATA':
+            number_data = int(keyword[1])
+        elif keyword[0] == 'SCALARS' and number_data is not None:
+            n_components = int(keyword[3]) if len(keyword) > 3 else 1
+            line, after = _next_line(content, pos)
+            if line is not None and line.startswith('LOOKUP_TABLE'):
+                pos = after
+            values, pos = _read_vtk_section(content, pos,
+                                            number_data * n_components,
+                                            _VTK_TYPES[keyword[2].lower()],
+                                            binary)
+            data_array = values.reshape(number_data, n_components)
+            # only the first data array is read
+            break
+        elif binary:
+            raise ValueError('Unsupported section {0} in binary vtk '
+                             'file'.format(keyword[0]))
+
+    if vertex_array is None or face_array is None:
+        raise ValueError('The vtk file does not contain both POINTS and '
+                         'POLYGONS sections')
 
     return vertex_array, face_array, data_array
 
 
+# single pass reader for ply files, ASCII or binary coded
 def _read_ply(file):
-    import pandas as pd
-    import csv
-    # read full file and drop empty lines
-    try:
-        ply_df = pd.read_csv(file, header=None, engine='python')
-    except csv.Error:
-        raise ValueError(
-            'This ply file appears to be binary coded currently only '
-            'ASCII coded ply files can be read')
-    ply_df = ply_df.dropna()
-    # extract number of vertices and faces, and row that marks end of header
-    number_vertices = int(ply_df[ply_df[0].str.contains(
-                                    'element vertex')][0].iloc[0].split()[2])
-    number_faces = int(ply_df[ply_df[0].str.contains(
-                                    'element face')][0].iloc[0].split()[2])
-    end_header = ply_df[ply_df[0].str.contains('end_header')].index.tolist()[0]
-    # read vertex coordinates into dict
-    vertex_df = pd.read_csv(file, skiprows=range(end_header + 1),
-                            nrows=number_vertices, sep='\s*', header=None,
-                            engine='python')
-    vertex_array = np.array(vertex_df)
-    # read face indices into dict
-    face_df = pd.read_csv(file,
-                          skiprows=range(end_header + number_vertices + 1),
-                          nrows=number_faces, sep='\s*', header=None,
-                          engine='python')
-    face_array = np.array(face_df.iloc[:, 1:4])
+    with open(file, 'rb') as fp:
+        content = fp.read()
+
+    end_header = content.find('end_header')
+    if not content.startswith('ply') or end_header < 0:
+        raise ValueError('{0} is not a valid ply file'.format(file))
+    header = content[:end_header].splitlines()
+    pos = content.find('\n', end_header) + 1
+
+    # parse the format and the list of elements with their properties
+    fmt = None
+    elements = []
+    for line in header:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            elements[-1][2].append(words[1:])
+    if fmt not in ('ascii', 'binary_little_endian', 'binary_big_endian'):
+        raise ValueError('Unknown ply format {0}'.format(fmt))
+
+    if fmt == 'ascii':
+        values = np.fromstring(content[pos:], sep=' ')
+        offset = 0
+
+    vertex_array = None
+    face_array = None
+    for name, count, properties in elements:
+        if fmt == 'ascii':
+            # all elements need a fixed number of values per row, i.e.
+            # triangular faces
+            width = sum(4 if prop[0] == 'list' else 1 for prop in properties)
+            if values.size < offset + count * width:
+                raise ValueError('Only triangular meshes can be read')
+            rows = values[offset:offset + count * width].reshape(count, width)
+            offset += count * width
+        else:
+            order = '<' if fmt == 'binary_little_endian' else '>'
+            fields = []
+            for prop in properties:
+                if prop[0] == 'list':
+                    fields.append(('count_' + prop[3],
+                                   order + _PLY_TYPES[prop[1]]))
+                    fields.append((prop[3], order + _PLY_TYPES[prop[2]], 3))
+                else:
+                    fields.append((prop[1], order + _PLY_TYPES[prop[0]]))
+            rows = np.frombuffer(content, dtype=np.dtype(fields), count=count,
+                                 offset=pos)
+            pos += rows.nbytes
+
+        if name == 'vertex':
+            names = [prop[-1] for prop in properties]
+            if fmt == 'ascii':
+                vertex_array = rows[:, [names.index(c) for c in 'xyz']]
+            else:
+                vertex_array = np.column_stack([rows[c] for c in 'xyz'])
+                vertex_array = vertex_array.astype(
+                                    vertex_array.dtype.newbyteorder('='))
+        elif name == 'face':
+            # the vertex indices are the first list property
+            lists = [prop[0] == 'list' for prop in properties]
+            column = lists.index(True)
+            prop = properties[column]
+            if fmt == 'ascii':
+                counts = rows[:, column]
+                face_array = rows[:, column + 1:column + 4].astype(int)
+            else:
+                counts = rows['count_' + prop[3]]
+                face_array = rows[prop[3]].astype(int)
+            if np.any(counts != 3):
+                raise ValueError('Only triangular meshes can be read')
+
+    if vertex_array is None or face_array is None:
+        raise ValueError('The ply file does not contain both vertex and face '
+                         'elements')
 
     return vertex_array, face_array
 
@@ -391,63 +498,49 @@ def _write_gifti(surf_mesh, coords, faces):
     nb.gifti.write(gii, surf_mesh)
 
 
+def _format_rows(array, fmt):
+    # formats all the rows of a 2D array in a single string operation,
+    # which is much faster than formatting (or np.savetxt-ing) row by row
+    array = np.asarray(array)
+    row = ' '.join([fmt] * array.shape[1]) + '\n'
+    return (row * array.shape[0]) % tuple(array.ravel().tolist())
+
+
+def _format_rows_of_8(values):
+    # formats a list of integers on rows of 8 values, as in MNI obj files
+    values = np.asarray(values).ravel().tolist()
+    full = len(values) // 8 * 8
+    text = ((' %i' * 8 + '\n') * (full // 8)) % tuple(values[:full])
+    if full < len(values):
+        text += (' %i' * (len(values) - full)) % tuple(values[full:])
+    else:
+        text += ' '
+    return text + '\n'
+
+
 def _write_obj(surf_mesh, coords, faces):
     # write out MNI - obj format
     n_vert = len(coords)
-    XYZ = coords.tolist()
-    Tri = faces.tolist()
+    n_tri = len(faces)
     with open(surf_mesh, 'w') as s:
-        line1 = "P 0.3 0.3 0.4 10 1 " + str(n_vert) + "\n"
-        s.write(line1)
-        k = -1
-        for a in XYZ:
-            k += 1
-            cor = ' ' + ' '.join(map(str, XYZ[k]))
-            s.write('%s\n' % cor)
+        s.write("P 0.3 0.3 0.4 10 1 %i\n" % n_vert)
+        s.write((' %.12g %.12g %.12g\n' * n_vert) %
+                tuple(np.asarray(coords).ravel().tolist()))
         s.write('\n')
-        for a in XYZ:
-            s.write(' 0 0 0\n')
+        s.write(' 0 0 0\n' * n_vert)
         s.write('\n')
-        l = ' ' + str(len(Tri)) + '\n'
-        s.write(l)
+        s.write(' %i\n' % n_tri)
         s.write(' 0 1 1 1 1\n')
         s.write('\n')
-        nt = len(Tri) * 3
-        Triangles = np.arange(3, nt + 1, 3)
-        Rounded8 = np.shape(Triangles)[0] / 8
-        N8 = 8 * Rounded8
-        Triangles8 = Triangles[0:N8]
-        RowsOf8 = np.split(Triangles8, N8 / 8)
-        for r in RowsOf8:
-            L = r.tolist()
-            Lint = map(int, L)
-            Line = ' ' + ' '.join(map(str, Lint))
-            s.write('%s\n' % Line)
-        L = Triangles[N8:].tolist()
-        Lint = map(int, L)
-        Line = ' ' + ' '.join(map(str, Lint))
-        s.write('%s\n' % Line)
+        s.write(_format_rows_of_8(np.arange(3, 3 * n_tri + 1, 3)))
         s.write('\n')
-        ListOfTriangles = np.array(Tri).flatten()
-        Rounded8 = np.shape(ListOfTriangles)[0] / 8
-        N8 = 8 * Rounded8
-        Triangles8 = ListOfTriangles[0:N8]
-        ListTri8 = ListOfTriangles[0:N8]
-        RowsOf8 = np.split(Triangles8, N8 / 8)
-        for r in RowsOf8:
-            L = r.tolist()
-            Lint = map(int, L)
-            Line = ' ' + ' '.join(map(str, Lint))
-            s.write('%s\n' % Line)
-        L = ListOfTriangles[N8:].tolist()
-        Lint = map(int, L)
-        Line = ' ' + ' '.join(map(str, Lint))
-        s.write('%s\n' % Line)
-
-
-def _write_vtk(filename, vertices, faces, data=None, comment=None):
+        s.write(_format_rows_of_8(faces))
+
+
+def _write_vtk(filename, vertices, faces, data=None, comment=None,
+               binary=False):
     '''
-    Creates ASCII coded vtk file from numpy arrays using pandas.
+    Creates ASCII or binary coded vtk file from numpy arrays.
     Inputs:
     -------
     (mandatory)
@@ -458,69 +551,61 @@ def _write_vtk(filename, vertices, faces, data=None, comment=None):
     * data: numpy array with data points, shape (n_vertices, n_datapoints)
         NOTE: n_datapoints can be =1 but cannot be skipped (n_vertices,)
     * comment: str, is written into the comment section of the vtk file
+    * binary: bool, write the data sections in binary (big endian) rather
+        than ASCII format
     Usage:
     ---------------------
     _write_vtk('/path/to/vtk/file.vtk', v_array, f_array)
     '''
-
-    import pandas as pd
     # infer number of vertices and faces
     number_vertices = vertices.shape[0]
     number_faces = faces.shape[0]
-    if data is not None:
-        number_data = data.shape[0]
-    # make header and subheader dataframe
-    header = ['# vtk DataFile Version 3.0',
-              '%s' % comment,
-              'ASCII',
-              'DATASET POLYDATA',
-              'POINTS %i float' % number_vertices
-              ]
-    header_df = pd.DataFrame(header)
-    sub_header = ['POLYGONS %i %i' % (number_faces, 4 * number_faces)]
-    sub_header_df = pd.DataFrame(sub_header)
-    # make dataframe from vertices
-    vertex_df = pd.DataFrame(vertices)
-    # make dataframe from faces, appending first row of 3's
-    # (indicating the polygons are triangles)
-    triangles = np.reshape(3 * (np.ones(number_faces)), (number_faces, 1))
-    triangles = triangles.astype(int)
-    faces = faces.astype(int)
-    faces_df = pd.DataFrame(np.concatenate((triangles, faces), axis=1))
-    # write dfs to csv
-    header_df.to_csv(filename, header=None, index=False)
-    with open(filename, 'a') as f:
-        vertex_df.to_csv(f, header=False, index=False, float_format='%.3f',
-                         sep=' ')
-    with open(filename, 'a') as f:
-        sub_header_df.to_csv(f, header=False, index=False)
-    with open(filename, 'a') as f:
-        faces_df.to_csv(f, header=False, index=False, float_format='%.0f',
-                        sep=' ')
-    # if there is data append second subheader and data
-    if data is not None:
-        datapoints = data.shape[1]
-        sub_header2 = ['POINT_DATA %i' % (number_data),
-                       'SCALARS EmbedVertex float %i' % (datapoints),
-                       'LOOKUP_TABLE default']
-        sub_header_df2 = pd.DataFrame(sub_header2)
-        data_df = pd.DataFrame(data)
-        with open(filename, 'a') as f:
-            sub_header_df2.to_csv(f, header=False, index=False)
-        with open(filename, 'a') as f:
-            data_df.to_csv(f, header=False, index=False, float_format='%.16f',
-                           sep=' ')
-
-
-def _write_ply(filename, vertices, faces, comment=None):
-    import pandas as pd
-    print "writing ply format"
+    # faces with a first column of 3's (indicating the polygons are
+    # triangles)
+    triangles = np.column_stack((3 * np.ones(number_faces, dtype=int),
+                                 np.asarray(faces, dtype=int)))
+
+    with open(filename, 'wb') as f:
+        f.write('# vtk DataFile Version 3.0\n'
+                '%s\n'
+                '%s\n'
+                'DATASET POLYDATA\n'
+                'POINTS %i float\n' % (comment,
+                                       'BINARY' if binary else 'ASCII',
+                                       number_vertices))
+        if binary:
+            np.asarray(vertices, dtype='>f4').tofile(f)
+            f.write('\n')
+        else:
+            f.write(_format_rows(vertices, '%.3f'))
+        f.write('POLYGONS %i %i\n' % (number_faces, 4 * number_faces))
+        if binary:
+            triangles.astype('>i4').tofile(f)
+            f.write('\n')
+        else:
+            f.write(_format_rows(triangles, '%i'))
+        # if there is data append second subheader and data
+        if data is not None:
+            data = np.asarray(data).reshape(data.shape[0], -1)
+            f.write('POINT_DATA %i\n'
+                    'SCALARS EmbedVertex float %i\n'
+                    'LOOKUP_TABLE default\n' % data.shape)
+            if binary:
+                data.astype('>f4').tofile(f)
+                f.write('\n')
+            else:
+                f.write(_format_rows(data, '%.16f'))
+
+
+def _write_ply(filename, vertices, faces, comment=None, binary=False):
     # infer number of vertices and faces
     number_vertices = vertices.shape[0]
     number_faces = faces.shape[0]
-    # make header dataframe
+    # binary ply files are written in little endian, the native byte order
+    # of most machines
     header = ['ply',
-              'format ascii 1.0',
+              'format %s 1.0' % ('binary_little_endian' if binary
+                                 else 'ascii'),
               'comment %s' % comment,
               'element vertex %i' % number_vertices,
               'property float x',
@@ -530,19 +615,19 @@ def _write_ply(filename, vertices, faces, comment=None):
               'property list uchar int vertex_indices',
               'end_header'
               ]
-    header_df = pd.DataFrame(header)
-    # make dataframe from vertices
-    vertex_df = pd.DataFrame(vertices)
-    # make dataframe from faces, adding first row of 3s (indicating triangles)
-    triangles = np.reshape(3 * (np.ones(number_faces)), (number_faces, 1))
-    triangles = triangles.astype(int)
-    faces = faces.astype(int)
-    faces_df = pd.DataFrame(np.concatenate((triangles, faces), axis=1))
-    # write dfs to csv
-    header_df.to_csv(filename, header=None, index=False)
-    with open(filename, 'a') as f:
-        vertex_df.to_csv(f, header=False, index=False,
-                         float_format='%.3f', sep=' ')
-    with open(filename, 'a') as f:
-        faces_df.to_csv(f, header=False, index=False,
-                        float_format='%.0f', sep=' ')
+    with open(filename, 'wb') as f:
+        f.write('\n'.join(header) + '\n')
+        if binary:
+            np.asarray(vertices, dtype='<f4').tofile(f)
+            face_array = np.empty(number_faces,
+                                  dtype=[('count', 'u1'),
+                                         ('indices', '<i4', 3)])
+            face_array['count'] = 3
+            face_array['indices'] = faces
+            face_array.tofile(f)
+        else:
+            f.write(_format_rows(vertices, '%.3f'))
+            # add a first column of 3s (indicating triangles)
+            f.write(_format_rows(np.column_stack(
+                        (3 * np.ones(number_faces, dtype=int),
+                         np.asarray(faces, dtype=int))), '%i'))
@@ -0,0 +1,281 @@
+import os
+import numpy as np
+import nibabel as nb
+
+
+class SparseVolume(object):
+    '''
+    Compact representation of an image that is only defined in a region,
+    e.g. the cortex, storing the values of the voxels of a mask rather than
+    the full volume
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        3D boolean array, True in the voxels where the image is defined
+    values: np.ndarray
+        Values of the image in the voxels of the mask, taken in Fortran
+        (x fastest) order, with shape (n_voxels,) for a 3D image or
+        (n_voxels, ...) for images with more dimensions
+    affine: np.ndarray
+        Affine of the full image
+    header: nibabel header, optional
+        Header of the full image
+    fill: float
+        Value of the full image outside of the mask (default is 0)
+
+    Notes
+    ----------
+    Sparse volumes are saved as .npz files holding the mask voxels, the
+    values, the affine and the nifti header, and can be loaded back with
+    :func:`nighres.io.load_volume`. They provide get_data(), get_affine()
+    and get_header() as nibabel images do, so they can be passed to any
+    nighres module, the full image being rebuilt when its data is needed.
+    Saving a sparse volume as a nifti file writes the full image.
+    '''
+
+    def __init__(self, mask, values, affine, header=None, fill=0):
+        mask = np.asarray(mask, dtype=bool)
+        values = np.asarray(values)
+        if mask.ndim != 3:
+            raise ValueError('The mask of a sparse volume must be 3D')
+        if values.shape[0] != np.count_nonzero(mask):
+            raise ValueError('There must be one row of values for each voxel '
+                             'of the mask')
+        self.mask = mask
+        self.values = values
+        self.affine = np.asarray(affine)
+        self.fill = fill
+        self.header = nb.Nifti1Header.from_header(header)
+        self.header.set_data_shape(self.shape)
+        self.header.set_data_dtype(values.dtype)
+
+    @property
+    def shape(self):
+        return self.mask.shape + self.values.shape[1:]
+
+    @classmethod
+    def from_nifti(cls, image, mask=None, fill=0):
+        '''
+        Creates a sparse volume from a full image
+
+        Parameters
+        ----------
+        image: niimg
+            Image to convert
+        mask: np.ndarray, optional
+            3D boolean array of the voxels to keep (default is the voxels
+            where any volume of the image differs from fill)
+        fill: float
+            Value of the image outside of the mask (default is 0)
+
+        Returns
+        ----------
+        SparseVolume
+        '''
+        if isinstance(image, basestring):
+            image = nb.load(image)
+        data = image.get_data()
+        if mask is None:
+            if fill is not None and np.isnan(fill):
+                differs = ~np.isnan(data)
+            else:
+                differs = data != fill
+            mask = differs.reshape(data.shape[:3] + (-1,)).any(axis=3)
+        mask = np.asarray(mask, dtype=bool)
+        voxels = np.flatnonzero(mask.ravel(order='F'))
+        values = data.reshape((-1,) + data.shape[3:], order='F')[voxels]
+        return cls(mask, values, image.get_affine(), image.get_header(),
+                   fill)
+
+    def get_data(self):
+        '''
+        Returns the full image data, with fill outside of the mask
+        '''
+        dtype = np.result_type(self.values, np.min_scalar_type(self.fill))
+        data = np.empty(self.shape, dtype=dtype, order='F')
+        data.fill(self.fill)
+        flat = data.reshape((-1,) + self.values.shape[1:], order='F')
+        flat[np.flatnonzero(self.mask.ravel(order='F'))] = self.values
+        return data
+
+    def get_affine(self):
+        return self.affine
+
+    def get_header(self):
+        return self.header
+
+    def set_data_dtype(self, dtype):
+        self.values = self.values.astype(dtype)
+        self.header.set_data_dtype(dtype)
+
+    def to_nifti(self):
+        '''
+        Returns the full image as a Nifti1Image
+        '''
+        return nb.Nifti1Image(self.get_data(), self.affine, self.header)
+
+    def to_filename(self, filename):
+        '''
+        Saves the sparse volume in a .npz file, or the full image if the
+        file name has an extension of another format
+        '''
+        if not filename.endswith('.npz'):
+            self.to_nifti().to_filename(filename)
+            return
+        np.savez(filename, **self._stored_arrays())
+
+    def _stored_arrays(self):
+        # arrays saved in the .npz file
+        return {'voxels': np.flatnonzero(self.mask.ravel(order='F')),
+                'mask_shape': np.array(self.mask.shape),
+                'values': self.values,
+                'affine': self.affine,
+                'header': np.frombuffer(self.header.binaryblock,
+                                        dtype=np.uint8),
+                'fill': np.array(self.fill)}
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads a sparse volume saved with to_filename, as a
+        :class:`NarrowBandLevelset` if it was saved from one
+        '''
+        with np.load(filename) as stored:
+            size = int(np.prod(stored['mask_shape']))
+            if 'mask_bits' in stored.files:
+                mask = np.unpackbits(stored['mask_bits'])[:size].view(bool)
+            else:
+                mask = np.zeros(size, dtype=bool)
+                mask[stored['voxels']] = True
+            mask = mask.reshape(tuple(stored['mask_shape']), order='F')
+            header = nb.Nifti1Header(
+                            binaryblock=stored['header'].tostring())
+            if 'band' in stored.files:
+                return NarrowBandLevelset(mask, stored['values'],
+                                          stored['affine'], header,
+                                          stored['band'].item(),
+                                          inside_bits=stored['inside'])
+            return cls(mask, stored['values'], stored['affine'], header,
+                       stored['fill'].item())
+
+
+class NarrowBandLevelset(SparseVolume):
+    '''
+    Levelset only stored in a narrow band around its zero level, e.g. a
+    surface of the cortex, its values being clamped to -band inside and
+    +band outside of the surface away from it
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        3D boolean array, True in the voxels of the band
+    values: np.ndarray
+        Values of the levelset in the voxels of the band, taken in Fortran
+        (x fastest) order, with shape (n_voxels,) for a 3D levelset or
+        (n_voxels, n_levelsets) for a 4D image of several levelsets
+    affine: np.ndarray
+        Affine of the full image
+    header: nibabel header, optional
+        Header of the full image
+    band: float
+        Distance to the zero level beyond which the values are clamped
+    inside: np.ndarray, optional
+        Boolean array with the shape of the full image, True where the
+        levelset is negative, which gives the sign of the values outside of
+        the band (default is positive everywhere)
+    inside_bits: np.ndarray, optional
+        The inside array packed with np.packbits in Fortran order, in place
+        of inside
+
+    Notes
+    ----------
+    A narrow band levelset is a :class:`SparseVolume`, which only keeps
+    the inside array as one bit per voxel besides the band. It is saved as
+    a .npz file, holding the band as one bit per voxel as well, and loaded
+    back with :func:`nighres.io.load_volume`. get_data() returns the full
+    clamped levelset, so it can be passed to any nighres module expecting a
+    levelset. The band must then be wide enough for the module, e.g. wider
+    than the cortical thickness for
+    :func:`nighres.laminar.volumetric_layering`.
+    '''
+
+    def __init__(self, mask, values, affine, header=None, band=1.0,
+                 inside=None, inside_bits=None):
+        if band <= 0:
+            raise ValueError('The band of a narrow band levelset must be '
+                             'positive')
+        SparseVolume.__init__(self, mask, values, affine, header, fill=band)
+        self.band = band
+        if inside_bits is None:
+            if inside is None:
+                inside = np.zeros(self.shape, dtype=bool)
+            inside = np.asarray(inside, dtype=bool)
+            if inside.shape != self.shape:
+                raise ValueError('The inside array must have the shape of '
+                                 'the full image')
+            inside_bits = np.packbits(inside.ravel(order='F'))
+        self.inside_bits = np.asarray(inside_bits, dtype=np.uint8)
+
+    @classmethod
+    def from_nifti(cls, image, band):
+        '''
+        Creates a narrow band levelset from a full levelset image
+
+        Parameters
+        ----------
+        image: niimg
+            3D levelset, or 4D image of several levelsets
+        band: float
+            Distance to the zero level beyond which the values are clamped,
+            in the units of the levelset (voxels for the nighres modules)
+
+        Returns
+        ----------
+        NarrowBandLevelset
+            Levelset holding the voxels where any of the levelsets is
+            within the band
+        '''
+        if isinstance(image, basestring):
+            image = nb.load(image)
+        data = image.get_data()
+        mask = (np.abs(data) < band).reshape(data.shape[:3] + (-1,)).any(
+                                                                    axis=3)
+        voxels = np.flatnonzero(mask.ravel(order='F'))
+        values = np.clip(data.reshape((-1,) + data.shape[3:],
+                                      order='F')[voxels], -band, band)
+        return cls(mask, values, image.get_affine(), image.get_header(),
+                   band, inside=data < 0)
+
+    def get_data(self):
+        '''
+        Returns the full levelset data, clamped outside of the band
+        '''
+        size = int(np.prod(self.shape))
+        inside = np.unpackbits(self.inside_bits)[:size].view(bool)
+        data = np.empty(size, dtype=self.values.dtype)
+        data.fill(self.band)
+        data[inside] = -self.band
+        del inside
+        data = data.reshape(self.shape, order='F')
+        flat = data.reshape((-1,) + self.values.shape[1:], order='F')
+        flat[np.flatnonzero(self.mask.ravel(order='F'))] = self.values
+        return data
+
+    def _stored_arrays(self):
+        # the band is saved as one bit per voxel rather than as the indices
+        # of its voxels, as it holds a large part of the image
+        arrays = SparseVolume._stored_arrays(self)
+        del arrays['voxels']
+        arrays['mask_bits'] = np.packbits(self.mask.ravel(order='F'))
+        arrays['band'] = np.array(self.band)
+        arrays['inside'] = self.inside_bits
+        return arrays
+
+
+def _sparse_fname(file_name):
+    # replaces the extension of a nifti file name by .npz
+    for ext in ('.nii.gz', '.nii', '.mgz', '.img', '.hdr'):
+        if file_name.endswith(ext):
+            return file_name[:-len(ext)] + '.npz'
+    return os.path.splitext(file_name)[0] + '.npz'
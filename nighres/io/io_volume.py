@@ -1,8 +1,60 @@
+import os
+import io
+import gzip
+import zlib
+import struct
+import Queue
+import atexit
+import threading
+import subprocess
 import nibabel as nb
 import numpy as np
+from distutils.spawn import find_executable
+from nibabel.fileholders import FileHolder
+from .. import global_settings
+from ..utils import _log_saving, _compression_settings, _compression_level
+from io_sparse import SparseVolume
 
+_GZIP_READERS = ('nibabel', 'zlib', 'pigz')
 
-def load_volume(volume):
+
+def _decompress(filename, reader):
+    # reads a whole gzip file in memory, with the pigz program (which reads,
+    # inflates and checks the data in separate threads) or with zlib in one
+    # call (which lets other Python threads run meanwhile)
+    if reader == 'pigz' and find_executable('pigz') is not None:
+        process = subprocess.Popen(['pigz', '-dc', filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        data, error = process.communicate()
+        if process.returncode != 0:
+            raise IOError("pigz could not decompress {0}: {1}".format(
+                          filename, error))
+        return data
+    with open(filename, 'rb') as fp:
+        compressed = fp.read()
+    chunks = []
+    while compressed:
+        # gzip files can hold several members one after the other
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks.append(decompressor.decompress(compressed))
+        compressed = decompressor.unused_data
+    return b''.join(chunks)
+
+
+def _load_gzip_nifti(filename, reader):
+    raw = _decompress(filename, reader)
+    # nifti-1 and nifti-2 headers start with their size, 348 or 540 bytes,
+    # in the byte order of the file (0x5C010000 is 348 byte-swapped)
+    if struct.unpack('<i', raw[:4])[0] in (348, 0x5C010000):
+        klass = nb.Nifti1Image
+    else:
+        klass = nb.Nifti2Image
+    holder = FileHolder(filename=filename, fileobj=io.BytesIO(raw))
+    return klass.from_file_map({'header': holder, 'image': holder})
+
+
+def load_volume(volume, mmap=True, gzip_reader=None):
     """
     Load volumetric data into a
     `Nibabel SpatialImage <http://nipy.org/nibabel/reference/nibabel.spatialimages.html#nibabel.spatialimages.SpatialImage>`_
@@ -11,14 +63,31 @@ def load_volume(volume):
     ----------
     volume: niimg
         Volumetric data to be loaded, can be a path to a file that nibabel can
-        load, or a Nibabel SpatialImage
+        load, or a Nibabel SpatialImage, or a sparse volume (see
+        :class:`nighres.io.SparseVolume`) or its .npz file
+    mmap: bool or str, optional
+        Memory-map the data of uncompressed files rather than reading it
+        (default is True, 'c' maps a copy that can be modified, see
+        nibabel.load)
+    gzip_reader: str, optional
+        How .nii.gz files are read: 'nibabel' reads the data when it is
+        first accessed, 'zlib' or 'pigz' decompress the whole file at once,
+        in a single call or with the pigz program (default is
+        NIGHRES_GZIP_READER, or 'nibabel')
 
     Returns
     ----------
-    image: Nibabel SpatialImage
+    image: Nibabel SpatialImage or SparseVolume
 
     Notes
     ----------
+    The data of the images is only read when it is accessed. Slicing
+    image.dataobj, e.g. image.dataobj[..., 0], only reads the slice asked
+    for (from the part of the file up to it for .nii.gz files, unless
+    indexed_gzip is installed), while get_data() reads and keeps the whole
+    data. pigz reads, inflates and checks the data in separate threads,
+    zlib is used instead when pigz is not installed.
+
     Originally created as part of Laminar Python [1]_ .
 
     References
@@ -30,10 +99,24 @@ def load_volume(volume):
 
     # if input is a filename, try to load it
     if isinstance(volume, basestring):
-        # importing nifti files
-        image = nb.load(volume)
-    # if volume is already a nibabel object
-    elif isinstance(volume, nb.spatialimages.SpatialImage):
+        for writer in _writers:
+            writer.wait(volume)
+        if volume.endswith('.npz'):
+            # importing sparse volumes
+            image = SparseVolume.load(volume)
+        else:
+            if gzip_reader is None:
+                gzip_reader = global_settings.GZIP_READER
+            if gzip_reader not in _GZIP_READERS:
+                raise ValueError("gzip_reader must be one of {0}".format(
+                                 ', '.join(_GZIP_READERS)))
+            if volume.endswith('.nii.gz') and gzip_reader != 'nibabel':
+                image = _load_gzip_nifti(volume, gzip_reader)
+            else:
+                # importing nifti files
+                image = nb.load(volume, mmap=mmap)
+    # if volume is already a nibabel object (or a sparse volume)
+    elif isinstance(volume, (nb.spatialimages.SpatialImage, SparseVolume)):
         image = volume
     else:
         raise ValueError('Input volume must be a either a path to a file in a '
@@ -51,8 +134,9 @@ def save_volume(filename, volume, dtype='float32', overwrite_file=True):
     ----------
     filename: str
         Full path and filename under which volume should be saved. The
-        extension determines the file format (must be supported by Nibabel)
-    volume: Nibabel SpatialImage
+        extension determines the file format (must be supported by Nibabel,
+        or .npz for sparse volumes)
+    volume: Nibabel SpatialImage or SparseVolume
         Volumetric data to be saved
     dtype: str, optional
         Datatype in which volumetric data should be stored (default is float32)
@@ -61,6 +145,9 @@ def save_volume(filename, volume, dtype='float32', overwrite_file=True):
 
     Notes
     ----------
+    .nii.gz files are compressed with the level set by
+    :func:`configure_compression` (default is 1, the fastest).
+
     Originally created as part of Laminar Python [1]_ .
 
     References
@@ -69,15 +156,222 @@ def save_volume(filename, volume, dtype='float32', overwrite_file=True):
        depth-resolved analysis of high-resolution brain imaging data in
        Python. DOI: 10.3897/rio.3.e12346
     """  # noqa
-    import os
     if dtype is not None:
         volume.set_data_dtype(dtype)
     if os.path.isfile(filename) and overwrite_file is False:
         print("\nThis file exists and overwrite_file was set to False, "
               "file not saved.")
     else:
-        try:
-            volume.to_filename(filename)
-            print("\nSaving {0}").format(filename)
-        except AttributeError:
+        if not hasattr(volume, 'to_filename'):
             print('\nInput volume must be a Nibabel SpatialImage.')
+            return
+        if _writers:
+            # compress and write in the background
+            _writers[-1].save(filename, volume)
+        else:
+            _write_volume(filename, volume)
+        print("\nSaving {0}").format(filename)
+        _log_saving('volume', filename, volume)
+
+
+def _write_volume(filename, volume):
+    if filename.endswith('.gz') and \
+            len(getattr(volume, 'files_types', ())) == 1:
+        # compress with the configured level, which nibabel doesn't expose
+        with gzip.GzipFile(filename, 'wb',
+                           compresslevel=_compression_level()) as fp:
+            holder = FileHolder(filename=filename, fileobj=fp)
+            volume.to_file_map({volume.files_types[0][0]: holder})
+    else:
+        volume.to_filename(filename)
+
+
+def _image_nbytes(volume):
+    # memory held by the data of an image waiting to be saved
+    if isinstance(volume, SparseVolume):
+        return volume.values.nbytes
+    return getattr(volume.dataobj, 'nbytes',
+                   int(np.prod(volume.shape)) *
+                   volume.get_data_dtype().itemsize)
+
+
+# background writers in use, save_volume hands images to the last one
+_writers = []
+
+
+class BackgroundWriter(object):
+    """
+    Saves images in background threads, so that the compression and writing
+    of the outputs of a module overlap with the next computations
+
+    Parameters
+    ----------
+    n_threads: int, optional
+        Number of images written at the same time (default is 2)
+    max_memory: float, optional
+        Maximum size in megabytes of the images waiting to be written,
+        save_volume waits for earlier images to be written beyond it
+        (default is 2000)
+
+    Notes
+    ----------
+    While a writer is started, with start() or a with statement,
+    :func:`save_volume` queues the images and returns immediately. Loading
+    a file that is waiting to be written with :func:`load_volume` waits for
+    it to be written. Images must not be modified after they are saved,
+    until flush() returns. Errors raised while writing are raised again by
+    flush(), which is called when the with statement ends or when Python
+    exits.
+
+    Example
+    ----------
+    >>> with nighres.io.BackgroundWriter():
+    ...     cruise = nighres.cortex.cruise_cortex_extraction(
+    ...                 ..., save_data=True)
+    ...     depth = nighres.laminar.volumetric_layering(
+    ...                 cruise['inner'], cruise['outer'], save_data=True)
+    """
+
+    def __init__(self, n_threads=2, max_memory=2000):
+        if n_threads < 1:
+            raise ValueError("n_threads must be at least 1")
+        self.n_threads = n_threads
+        self.max_memory = max_memory * 1024 ** 2
+        self._queue = Queue.Queue()
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._pending_bytes = 0
+        self._errors = []
+        self._threads = []
+
+    def start(self):
+        '''
+        Makes save_volume hand the images to this writer
+        '''
+        if not self._threads:
+            for _ in range(self.n_threads):
+                thread = threading.Thread(target=self._run)
+                # the remaining images are written by flush() at exit
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        if self not in _writers:
+            _writers.append(self)
+        return self
+
+    def save(self, filename, volume):
+        '''
+        Queues an image to be written to filename
+        '''
+        filename = os.path.abspath(filename)
+        nbytes = _image_nbytes(volume)
+        with self._condition:
+            while self._pending_bytes > 0 and \
+                    self._pending_bytes + nbytes > self.max_memory:
+                self._condition.wait()
+            while filename in self._pending:
+                # the same file is already being written
+                self._condition.wait()
+            self._pending[filename] = nbytes
+            self._pending_bytes += nbytes
+        self._queue.put((filename, volume))
+
+    def wait(self, filename):
+        '''
+        Waits until filename is written, if it is waiting to be
+        '''
+        filename = os.path.abspath(filename)
+        with self._condition:
+            while filename in self._pending:
+                self._condition.wait()
+
+    def flush(self):
+        '''
+        Waits until all the queued images are written
+        '''
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        '''
+        Writes the queued images and ends the threads of the writer
+        '''
+        if self in _writers:
+            _writers.remove(self)
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.stop()
+        else:
+            # don't hide the error raised in the with block
+            try:
+                self.stop()
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            filename, volume = item
+            try:
+                _write_volume(filename, volume)
+            except Exception as error:
+                with self._condition:
+                    self._errors.append(error)
+            with self._condition:
+                self._pending_bytes -= self._pending.pop(filename)
+                self._condition.notify_all()
+
+
+@atexit.register
+def _stop_writers():
+    for writer in reversed(_writers[:]):
+        writer.stop()
+
+
+def configure_compression(compression=None, level=None):
+    """
+    Sets how the images saved by the modules are compressed, overriding the
+    NIGHRES_COMPRESSION and NIGHRES_COMPRESSION_LEVEL environment variables
+
+    Parameters
+    ----------
+    compression: str, optional
+        'gzip' to save the outputs of the modules as .nii.gz files (default),
+        or 'none' to save them as uncompressed .nii files, which are faster
+        to write and to read in the next steps of a pipeline
+    level: int, optional
+        Compression level of the .nii.gz files, from 1 (fastest, default) to
+        9 (smallest)
+
+    Notes
+    ----------
+    The compression applies to the outputs the modules save with
+    save_data=True, which are usually inputs of the next steps: images saved
+    with
+    :func:`save_volume` under a given name, e.g. the final results of a
+    pipeline, keep the extension of that name.
+    """
+    if compression is not None and compression not in ('gzip', 'none'):
+        raise ValueError("The compression must be 'gzip' or 'none'")
+    if level is not None and (level < 1 or level > 9):
+        raise ValueError("The compression level must be between 1 and 9")
+    _compression_settings['compression'] = compression
+    _compression_settings['level'] = level
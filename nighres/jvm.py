@@ -0,0 +1,197 @@
+import threading
+import warnings
+import numpy as np
+import cbstools
+import global_settings
+from io import load_volume
+
+# heap assumed to be needed by a module when nothing else is known
+DEFAULT_HEAP = '6000m'
+
+# rough number of float volumes the size of the input that a cbstools
+# module keeps in memory at once (inputs, outputs and working arrays)
+_VOLUMES_PER_MODULE = 40
+
+_lock = threading.Lock()
+_jvm_settings = {'initial_heap': None, 'max_heap': None}
+_running_heap = {}
+
+
+def _heap_to_mb(heap):
+    # converts a Java heap specification (e.g. '6000m', '8g') to megabytes
+    heap = str(heap).strip().lower()
+    units = {'k': 1.0 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+    try:
+        if heap[-1] in units:
+            return int(np.ceil(float(heap[:-1]) * units[heap[-1]]))
+        else:
+            # plain numbers are in bytes, as for the -Xmx option of java
+            return int(np.ceil(float(heap) / (1024 * 1024)))
+    except (ValueError, IndexError):
+        raise ValueError("Invalid Java heap size {0}, please use a value "
+                         "such as '6000m' or '8g'".format(heap))
+
+
+def _estimate_heap(reference_image):
+    # estimates the heap needed to process an image of that size, from its
+    # header only so that the data itself is not loaded
+    if reference_image is None:
+        return None
+    shape = load_volume(reference_image).get_header().get_data_shape()
+    nbytes = 4 * int(np.prod(shape)) * _VOLUMES_PER_MODULE
+    return '{0}m'.format(int(np.ceil(nbytes / (1024.0 * 1024.0))))
+
+
+def configure_jvm(initial_heap=None, max_heap=None):
+    '''
+    Sets the heap sizes of the Java virtual machine used by the cbstools
+    modules, overriding the NIGHRES_JVM_INITIAL_HEAP and NIGHRES_JVM_MAX_HEAP
+    environment variables
+
+    Parameters
+    ----------
+    initial_heap: str
+        Initial heap size, e.g. '4000m' or '8g' (default is max_heap)
+    max_heap: str
+        Maximum heap size, e.g. '12000m' or '16g'
+
+    Notes
+    ----------
+    The virtual machine can only be started once per process, so this has
+    no effect if a module has already been run.
+    '''
+    if initial_heap is not None:
+        _heap_to_mb(initial_heap)
+    if max_heap is not None:
+        _heap_to_mb(max_heap)
+    if _running_heap:
+        warnings.warn("The Java virtual machine is already running with a "
+                      "maximum heap of {0}, the new settings will be "
+                      "ignored".format(_running_heap['max_heap']),
+                      stacklevel=2)
+    _jvm_settings['initial_heap'] = initial_heap
+    _jvm_settings['max_heap'] = max_heap
+
+
+def start_jvm(reference_image=None, default_heap=DEFAULT_HEAP):
+    '''
+    Starts the Java virtual machine running the cbstools modules, if not
+    already running, and attaches the calling thread to it
+
+    Parameters
+    ----------
+    reference_image: niimg, optional
+        Image the module is about to process, used to estimate the heap
+        needed when it is not configured explicitly
+    default_heap: str
+        Minimal heap to use when the heap is estimated (default is '6000m')
+
+    Returns
+    ----------
+    dict
+        Initial and maximum heap of the running virtual machine
+
+    Notes
+    ----------
+    The heap sizes are taken, in this order, from :func:`configure_jvm`,
+    from the NIGHRES_JVM_INITIAL_HEAP and NIGHRES_JVM_MAX_HEAP environment
+    variables, or from the largest of default_heap and the estimated
+    footprint of reference_image. Once started, the virtual machine is
+    kept for the lifetime of the process: a warning is issued if a later
+    module seems to need more memory than is available.
+    '''
+    with _lock:
+        initial_heap = _jvm_settings['initial_heap'] \
+            or global_settings.JVM_INITIAL_HEAP
+        max_heap = _jvm_settings['max_heap'] \
+            or global_settings.JVM_MAX_HEAP
+
+        if max_heap is None:
+            max_heap = default_heap
+            estimate = _estimate_heap(reference_image)
+            if estimate is not None \
+                    and _heap_to_mb(estimate) > _heap_to_mb(max_heap):
+                max_heap = estimate
+            required = max_heap
+        else:
+            required = None
+        if initial_heap is None:
+            initial_heap = max_heap
+
+        if not _running_heap:
+            try:
+                cbstools.initVM(initialheap=initial_heap, maxheap=max_heap)
+                _running_heap['initial_heap'] = initial_heap
+                _running_heap['max_heap'] = max_heap
+            except ValueError:
+                # started outside of nighres, heap sizes are unknown
+                _running_heap['initial_heap'] = None
+                _running_heap['max_heap'] = None
+        elif required is not None and _running_heap['max_heap'] is not None \
+                and _heap_to_mb(required) > _heap_to_mb(
+                    _running_heap['max_heap']):
+            warnings.warn("This module may need up to {0} of Java heap but "
+                          "the virtual machine was started with {1}. Set "
+                          "NIGHRES_JVM_MAX_HEAP or call "
+                          "nighres.jvm.configure_jvm() before running the "
+                          "first module to increase it.".format(
+                              required, _running_heap['max_heap']))
+
+    attach_current_thread()
+    return dict(_running_heap)
+
+
+def attach_current_thread():
+    '''
+    Attaches the calling thread to the running Java virtual machine, which
+    is required before calling cbstools from any thread other than the one
+    that started it. Attaching an already attached thread has no effect.
+    '''
+    env = cbstools.getVMEnv()
+    if env is None:
+        raise ValueError("The Java virtual machine is not running, please "
+                         "start it with nighres.jvm.start_jvm() first")
+    env.attachCurrentThread()
+
+
+def heap_usage():
+    '''
+    Returns the current heap usage of the Java virtual machine
+
+    Returns
+    ----------
+    dict
+        Dictionary collecting the heap sizes in megabytes, with the
+        following entries ::
+
+        * used: memory occupied by Java objects
+        * total: memory currently reserved by the virtual machine
+        * max: maximum memory the virtual machine may reserve
+
+        or None if the virtual machine is not running or cbstools has not
+        been built with java.lang.Runtime.
+    '''
+    if cbstools.getVMEnv() is None or not hasattr(cbstools, 'Runtime'):
+        return None
+    runtime = cbstools.Runtime.getRuntime()
+    total = runtime.totalMemory()
+    mb = 1024.0 * 1024.0
+    return {'used': (total - runtime.freeMemory()) / mb,
+            'total': total / mb,
+            'max': runtime.maxMemory() / mb}
+
+
+def report_heap_usage(module_name):
+    '''
+    Prints the heap usage of the Java virtual machine after running a module
+
+    Parameters
+    ----------
+    module_name: str
+        Name of the module that just ran
+    '''
+    usage = heap_usage()
+    if usage is not None:
+        print("\nJava heap after {0}: {1:.0f}MB used, {2:.0f}MB reserved, "
+              "{3:.0f}MB maximum".format(module_name, usage['used'],
+                                         usage['total'], usage['max']))
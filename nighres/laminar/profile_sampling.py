@@ -1,14 +1,24 @@
 import os
+import sys
 import numpy as np
 import nibabel as nb
 import cbstools
-from ..io import load_volume, save_volume
-from ..utils import _output_dir_4saving, _fname_4saving
+from ..io import load_volume, save_volume, SparseVolume
+from ..io.io_sparse import _sparse_fname
+from ..utils import _output_dir_4saving, _fname_4saving, _crop_box, \
+                    _uncrop
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
+# offsets of the 8 corners of a voxel, for trilinear interpolation
+_CORNERS = [(dx, dy, dz) for dz in (0, 1) for dy in (0, 1) for dx in (0, 1)]
 
+
+@cached
 def profile_sampling(profile_surface_image, intensity_image,
-                     save_data=False, output_dir=None,
-                     file_name=None):
+                     crop_margin=None, engine='java', sparse=False,
+                     save_data=False, output_dir=None, file_name=None):
 
     '''Sampling data on multiple intracortical layers
 
@@ -17,8 +27,22 @@ def profile_sampling(profile_surface_image, intensity_image,
     profile_surface_image: niimg
         4D image containing levelset representations of different intracortical
         surfaces on which data should be sampled
-    intensity_image: niimg
-        Image from which data should be sampled
+    intensity_image: niimg or list of niimg
+        Image from which data should be sampled, or several images to sample
+        on the same surfaces, given as a list of 3D images or as a 4D image
+    crop_margin: int, optional
+        If given, the images are cropped to the bounding box of the cortex
+        (between the first and last surfaces) grown by this many voxels
+        before sampling, and the profiles are pasted back into the full image
+        (default is None, no cropping)
+    engine: {'java', 'numpy'}
+        Implementation of the sampling, either the cbstools Java module or
+        a vectorized NumPy port of it that does not need the Java virtual
+        machine (default is 'java')
+    sparse: bool
+        Return the profiles as :class:`nighres.io.SparseVolume` only holding
+        the voxels of the cortex (where they are not zero), saved as .npz
+        files (default is False)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -31,31 +55,41 @@ def profile_sampling(profile_surface_image, intensity_image,
     -----------
     niimg
         4D profile image , where the 4th dimension represents the
-        profile for each voxel (output file suffix _profiles)
+        profile for each voxel (output file suffix _profiles). If a list of
+        intensity images is given, a list with the profile image of each of
+        them; if a 4D intensity image is given, a 5D image stacking the
+        profiles of each volume along the 5th dimension
 
     Notes
     ----------
     Original Java module by Pierre-Louis Bazin and Juliane Dinse
+
+    When sampling several images, the surfaces are converted and passed to
+    the Java module once, and the module is run once for each image. The
+    NumPy engine computes the profile trajectories only once and then
+    interpolates each image along them, which is much faster in that case.
+
+    When cropping, the profiles outside the bounding box are copied from its
+    border, where they are zero outside the cortex.
     '''
 
     print('\nProfile sampling')
 
-    # make sure that saving related parameters are correct
-    if save_data:
-        output_dir = _output_dir_4saving(output_dir, intensity_image)
-
-        profile_file = _fname_4saving(file_name=file_name,
-                                      rootfile=intensity_image,
-                                      suffix='profiles')
+    if engine not in ('java', 'numpy'):
+        raise ValueError("engine must be either 'java' or 'numpy'")
 
-    # start VM if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    # list the intensity images to sample, either given as a list or as the
+    # volumes of a 4D image
+    if isinstance(intensity_image, (list, tuple)):
+        intensity_list = list(intensity_image)
+        stacked = False
+    else:
+        intensity_list = [intensity_image]
+        stacked = len(load_volume(intensity_image).shape) == 4
 
-    # initate class
-    sampler = cbstools.LaminarProfileSampling()
+    # make sure that saving related parameters are correct
+    if save_data:
+        output_dir = _output_dir_4saving(output_dir, intensity_list[0])
 
     # load the data
     surface_img = load_volume(profile_surface_image)
@@ -65,37 +99,238 @@ def profile_sampling(profile_surface_image, intensity_image,
     resolution = [x.item() for x in hdr.get_zooms()]
     dimensions = surface_data.shape
 
-    intensity_data = load_volume(intensity_image).get_data()
+    # restrict sampling to the bounding box of the cortex, if required
+    cortex = (surface_data[:, :, :, 0] >= 0) & \
+             (surface_data[:, :, :, -1] <= 0)
+    if crop_margin is not None:
+        box = _crop_box(cortex, crop_margin)
+    else:
+        box = tuple(slice(0, n) for n in dimensions[:3])
+    crop_dimensions = tuple(b.stop - b.start for b in box) + dimensions[3:]
 
-    # pass inputs
-    sampler.setIntensityImage(cbstools.JArray('float')(
-                                  (intensity_data.flatten('F')).astype(float)))
-    sampler.setProfileSurfaceImage(cbstools.JArray('float')(
-                                   (surface_data.flatten('F')).astype(float)))
-    sampler.setResolutions(resolution[0], resolution[1], resolution[2])
-    sampler.setDimensions(dimensions[0], dimensions[1],
-                          dimensions[2], dimensions[3])
+    if engine == 'java':
+        # start VM if not already running
+        start_jvm(profile_surface_image)
 
-    # execute class
-    try:
-        sampler.execute()
+        # initate class
+        sampler = cbstools.LaminarProfileSampling()
 
-    except:
-        # if the Java module fails, reraise the error it throws
-        print("\n The underlying Java code did not execute cleanly: ")
-        print sys.exc_info()[0]
-        raise
-        return
+        # pass inputs, the surfaces are converted only once for all the
+        # images
+        surface_jarray = to_jarray(surface_data[box], 'float')
+        sampler.setResolutions(resolution[0], resolution[1], resolution[2])
+        sampler.setDimensions(crop_dimensions[0], crop_dimensions[1],
+                              crop_dimensions[2], crop_dimensions[3])
+    else:
+        # compute the profile trajectories once for all the images
+        layers = [np.asarray(surface_data[box + (l,)],
+                             dtype=np.float32).ravel(order='F')
+                  for l in range(dimensions[3])]
+        voxels, points = _profile_trajectories(layers, crop_dimensions[:3])
 
-    # collecting outputs
-    profile_data = np.reshape(np.array(
-                                sampler.getProfileMappedIntensityImage(),
-                                dtype=np.float32), dimensions, 'F')
+    if stacked:
+        intensity_data = load_volume(intensity_image).get_data()
+        volumes = [intensity_data[:, :, :, t]
+                   for t in range(intensity_data.shape[3])]
+    else:
+        volumes = [load_volume(image).get_data() for image in intensity_list]
 
-    hdr['cal_max'] = np.nanmax(profile_data)
-    profiles = nb.Nifti1Image(profile_data, aff, hdr)
+    profiles = []
+    for volume in volumes:
+        if engine == 'numpy':
+            profiles.append(_uncrop(_sample_profiles(
+                                        volume[box], voxels, points,
+                                        crop_dimensions), box, dimensions))
+            continue
 
-    if save_data:
-        save_volume(os.path.join(output_dir, profile_file), profiles)
+        # the module releases the surfaces after each run
+        sampler.setProfileSurfaceImage(surface_jarray)
+        sampler.setIntensityImage(to_jarray(volume[box], 'float'))
+
+        # execute class
+        try:
+            sampler.execute()
+
+        except:
+            # if the Java module fails, reraise the error it throws
+            print("\n The underlying Java code did not execute cleanly: ")
+            print sys.exc_info()[0]
+            raise
+            return
+
+        # collecting outputs
+        profiles.append(_uncrop(from_jarray(
+                                    sampler.getProfileMappedIntensityImage(),
+                                    crop_dimensions), box, dimensions))
+
+    if engine == 'java':
+        report_heap_usage('profile_sampling')
+
+    if stacked:
+        profiles = [np.stack(profiles, axis=4)]
+
+    results = []
+    for profile_data, image in zip(profiles, intensity_list):
+        hdr['cal_max'] = np.nanmax(profile_data)
+        results.append(nb.Nifti1Image(profile_data, aff, hdr))
+        if sparse:
+            results[-1] = SparseVolume.from_nifti(results[-1], mask=cortex)
+
+        if save_data:
+            # number the outputs if they would all get the same name
+            if file_name is not None and len(intensity_list) > 1:
+                suffix = 'profiles{0}'.format(len(results))
+            else:
+                suffix = 'profiles'
+            profile_file = _fname_4saving(file_name=file_name,
+                                          rootfile=image,
+                                          suffix=suffix)
+            if sparse:
+                profile_file = _sparse_fname(profile_file)
+            save_volume(os.path.join(output_dir, profile_file), results[-1])
+
+    if isinstance(intensity_image, (list, tuple)):
+        return results
+    return results[0]
+
+
+# NumPy port of LaminarProfileSampling and CorticalProfile (cbstools), where
+# all the cortical voxels are processed at once rather than one by one
+
+def _interpolate(image, shape, points):
+    # trilinear interpolation of a flat (Fortran-ordered) image at points,
+    # with 0 outside the image as in ImageInterpolation.linearInterpolation
+    nx, ny, nz = shape
+    corner = np.floor(points).astype(int)
+    inside = np.all((corner >= 0) & (corner <= np.array(shape) - 2), axis=1)
+    values = np.zeros(len(points))
+
+    corner = corner[inside]
+    alpha = points[inside] - corner
+    index = corner[:, 0] + nx * corner[:, 1] + nx * ny * corner[:, 2]
+    for dx, dy, dz in _CORNERS:
+        weight = (alpha[:, 0] if dx else 1.0 - alpha[:, 0]) * \
+                 (alpha[:, 1] if dy else 1.0 - alpha[:, 1]) * \
+                 (alpha[:, 2] if dz else 1.0 - alpha[:, 2])
+        values[inside] += weight * image[index + dx + nx * dy + nx * ny * dz]
+    return values
+
+
+def _masked_interpolate(image, mask, shape, points):
+    # trilinear interpolation using only the voxels inside mask, with NaN
+    # where no such voxel is available
+    nx, ny, nz = shape
+    inside = np.all((points >= 0) & (points <= np.array(shape) - 2), axis=1)
+    values = np.zeros(len(points))
+    weights = np.zeros(len(points))
+
+    corner = np.floor(points[inside]).astype(int)
+    alpha = points[inside] - corner
+    index = corner[:, 0] + nx * corner[:, 1] + nx * ny * corner[:, 2]
+    for dx, dy, dz in _CORNERS:
+        weight = (alpha[:, 0] if dx else 1.0 - alpha[:, 0]) * \
+                 (alpha[:, 1] if dy else 1.0 - alpha[:, 1]) * \
+                 (alpha[:, 2] if dz else 1.0 - alpha[:, 2])
+        neighbour = index + dx + nx * dy + nx * ny * dz
+        weight = np.where(mask[neighbour], weight, 0.0)
+        values[inside] += weight * image[neighbour]
+        weights[inside] += weight
+
+    valid = weights > 0
+    values[valid] /= weights[valid]
+    values[~valid] = np.nan
+    return values
+
+
+def _levelset_gradient(levelset, shape, points):
+    # levelset value and central differences gradient at points
+    value = _interpolate(levelset, shape, points)
+    gradient = np.zeros(points.shape)
+    for axis in range(3):
+        step = np.zeros(3, dtype=points.dtype)
+        step[axis] = 1.0
+        gradient[:, axis] = 0.5 * (_interpolate(levelset, shape, points + step)
+                                   - _interpolate(levelset, shape,
+                                                  points - step))
+    return value, gradient
+
+
+def _project_to_levelset(levelset, shape, start):
+    # moves the start points onto the zero level of levelset, following its
+    # gradient with the halfway corrections of CorticalProfile
+    length, gradient = _levelset_gradient(levelset, shape, start)
+    norm = np.sqrt(np.sum(gradient ** 2, axis=1))
+    points = start.copy()
+
+    moving = norm > 0.01
+    points[moving] = (start[moving] - (length[moving] / norm[moving])[:, None]
+                      * gradient[moving]).astype(np.float32)
+    residual = _interpolate(levelset, shape, points)
+    active = np.flatnonzero(moving & (residual ** 2 > 0.0001))
+
+    for trial in range(100):
+        if active.size == 0:
+            break
+        # come back halfway and project again from there
+        current = (points[active] + (0.5 * length[active] / norm[active])
+                   [:, None] * gradient[active]).astype(np.float32)
+        length[active], gradient[active] = _levelset_gradient(
+                                                levelset, shape, current)
+        norm[active] = np.sqrt(np.sum(gradient[active] ** 2, axis=1))
+
+        steep = norm[active] > 0.01
+        current[steep] = (current[steep] -
+                          (length[active][steep] / norm[active][steep])
+                          [:, None] * gradient[active][steep]).astype(
+                                                                np.float32)
+        points[active] = current
+        residual = _interpolate(levelset, shape, current)
+        active = active[(residual ** 2 > 0.0001) & steep]
+
+    return points
+
+
+def _profile_trajectories(layers, shape):
+    # computes, for each cortical voxel (between the first and last
+    # surfaces), the points where its profile crosses each surface
+    n_surfaces = len(layers)
+    mask = (layers[0] >= 0) & (layers[-1] <= 0)
+    voxels = np.flatnonzero(mask)
+    coords = np.column_stack(np.unravel_index(voxels, shape, order='F'))
+    coords = coords.astype(np.float32)
+
+    # start from the closest surface and propagate to the other ones
+    closest = np.argmin(np.abs(np.column_stack(
+                                [layer[voxels] for layer in layers])), axis=1)
+    points = np.zeros((n_surfaces, len(voxels), 3), dtype=np.float32)
+    for first in range(n_surfaces):
+        group = np.flatnonzero(closest == first)
+        if group.size == 0:
+            continue
+        points[first, group] = _project_to_levelset(layers[first], shape,
+                                                    coords[group])
+        for l in range(first - 1, -1, -1):
+            points[l, group] = _project_to_levelset(layers[l], shape,
+                                                    points[l + 1, group])
+        for l in range(first + 1, n_surfaces):
+            points[l, group] = _project_to_levelset(layers[l], shape,
+                                                    points[l - 1, group])
+    return voxels, points
+
+
+def _sample_profiles(volume, voxels, points, dimensions):
+    # interpolates the intensity of the cortical voxels along the profile
+    # trajectories, with 0 where it cannot be interpolated from the cortex
+    n_surfaces = points.shape[0]
+    nxyz = int(np.prod(dimensions[:3]))
+    image = np.asarray(volume, dtype=np.float32).ravel(order='F')
+    mask = np.zeros(nxyz, dtype=bool)
+    mask[voxels] = True
+
+    values = _masked_interpolate(image, mask, dimensions[:3],
+                                 points.reshape(-1, 3))
+    values = np.nan_to_num(values).reshape(n_surfaces, len(voxels))
 
-    return profiles
+    profiles = np.zeros((nxyz, n_surfaces), dtype=np.float32)
+    profiles[voxels] = values.T
+    return profiles.reshape(dimensions, order='F')
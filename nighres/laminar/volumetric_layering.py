@@ -3,14 +3,22 @@ import os
 import numpy as np
 import nibabel as nb
 import cbstools
-from ..io import load_volume, save_volume
+from ..io import load_volume, save_volume, SparseVolume, NarrowBandLevelset
+from ..io.io_sparse import _sparse_fname
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir
+                    _check_topology_lut_dir, _check_outputs, \
+                    _crop_box, _uncrop
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def volumetric_layering(inner_levelset, outer_levelset,
-                        n_layers=4, topology_lut_dir=None,
-                        save_data=False, output_dir=None,
+                        n_layers=4, topology_lut_dir=None, crop_margin=None,
+                        sparse=False, narrow_band=None, outputs=None,
+                        save_data=False,
+                        output_dir=None,
                         file_name=None):
 
     '''Equivolumetric layering of the cortical sheet.
@@ -26,6 +34,24 @@ def volumetric_layering(inner_levelset, outer_levelset,
     topology_lut_dir: str, optional
         Path to directory in which topology files are stored (default is stored
         in TOPOLOGY_LUT_DIR)
+    crop_margin: int, optional
+        If given, the images are cropped to the bounding box of the region
+        inside the outer surface grown by this many voxels before computing
+        the layers, and the results are pasted back into the full image
+        (default is None, no cropping)
+    sparse: bool
+        Return the boundaries as a :class:`nighres.io.SparseVolume` only
+        holding the voxels of the cortex and a margin of 2 voxels around it
+        (NaN elsewhere), saved as a .npz file (default is False)
+    narrow_band: float, optional
+        If given, the boundaries are returned as a
+        :class:`nighres.io.NarrowBandLevelset` only holding the voxels within
+        this distance (in voxels) of any boundary and clamped beyond it,
+        saved as a .npz file (default is None, full levelsets). Cannot be
+        combined with sparse
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     save_data: bool
         Save output data to file (default is False)
     output_dir: str, optional
@@ -38,20 +64,27 @@ def volumetric_layering(inner_levelset, outer_levelset,
     ----------
     dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
         * depth (niimg): Continuous depth from 0 (inner surface) to 1
           (outer surface) (_layering_depth)
         * layers (niimg): Discrete layers from 1 (bordering inner surface) to
           n_layers (bordering outer surface) (_layering_layers)
         * boundaries (niimg): Levelset representations of boundaries between
-          all layers in 4D (_layering_boundaries)
+          all layers in 4D (_layering_boundaries), a SparseVolume if sparse
+          is True, a NarrowBandLevelset if narrow_band is given
 
     Notes
     ----------
     Original Java module by Miriam Waehnert, Pierre-Louis Bazin and
     Juliane Dinse. Algorithm details can be found in [1]_
 
+    When cropping, the boundary levelsets outside the bounding box take their
+    largest absolute value in the box plus the distance to the box, and the
+    depth and layers are copied from its border, which is outside the cortex
+    for any positive margin.
+
     References
     ----------
     .. [1] Waehnert et al (2014) Anatomically motivated modeling of cortical
@@ -60,6 +93,12 @@ def volumetric_layering(inner_levelset, outer_levelset,
 
     print('\nVolumetric Layering')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['depth', 'layers', 'boundaries'])
+
+    if sparse and narrow_band is not None:
+        raise ValueError("sparse and narrow_band cannot be used together")
+
     # check topology lut dir and set default if not given
     topology_lut_dir = _check_topology_lut_dir(topology_lut_dir)
 
@@ -78,12 +117,11 @@ def volumetric_layering(inner_levelset, outer_levelset,
         boundary_file = _fname_4saving(file_name=file_name,
                                        rootfile=inner_levelset,
                                        suffix='layering_boundaries')
+        if sparse or narrow_band is not None:
+            boundary_file = _sparse_fname(boundary_file)
 
     # start virutal machine if not already running
-    try:
-        cbstools.initVM(initialheap='12000m', maxheap='12000m')
-    except ValueError:
-        pass
+    start_jvm(inner_levelset, default_heap='12000m')
 
     # initate class
     lamination = cbstools.LaminarVolumetricLayering()
@@ -98,13 +136,20 @@ def volumetric_layering(inner_levelset, outer_levelset,
 
     outer_data = load_volume(outer_levelset).get_data()
 
+    # restrict processing to the bounding box of the outer surface, if
+    # required
+    if crop_margin is not None:
+        box = _crop_box(outer_data <= 0, crop_margin)
+    else:
+        box = tuple(slice(0, n) for n in dimensions)
+    crop_dimensions = tuple(b.stop - b.start for b in box)
+
     # set parameters from input images
-    lamination.setDimensions(dimensions[0], dimensions[1], dimensions[2])
+    lamination.setDimensions(crop_dimensions[0], crop_dimensions[1],
+                             crop_dimensions[2])
     lamination.setResolutions(resolution[0], resolution[1], resolution[2])
-    lamination.setInnerDistanceImage(cbstools.JArray('float')(
-                                    (inner_data.flatten('F')).astype(float)))
-    lamination.setOuterDistanceImage(cbstools.JArray('float')(
-                                    (outer_data.flatten('F')).astype(float)))
+    lamination.setInnerDistanceImage(to_jarray(inner_data[box], 'float'))
+    lamination.setOuterDistanceImage(to_jarray(outer_data[box], 'float'))
     lamination.setNumberOfLayers(n_layers)
     lamination.setTopologyLUTdirectory(topology_lut_dir)
 
@@ -119,29 +164,52 @@ def volumetric_layering(inner_levelset, outer_levelset,
         raise
         return
 
-    # collect data
-    depth_data = np.reshape(np.array(lamination.getContinuousDepthMeasurement(),
-                                    dtype=np.float32), dimensions, 'F')
-    hdr['cal_max'] = np.nanmax(depth_data)
-    depth = nb.Nifti1Image(depth_data, aff, hdr)
-
-    layer_data = np.reshape(np.array(lamination.getDiscreteSampledLayers(),
-                                     dtype=np.int32), dimensions, 'F')
-    hdr['cal_max'] = np.nanmax(layer_data)
-    layers = nb.Nifti1Image(layer_data, aff, hdr)
-
-    boundary_len = lamination.getLayerBoundarySurfacesLength()
-    boundary_data = np.reshape(np.array(lamination.getLayerBoundarySurfaces(),
-                               dtype=np.float32), (dimensions[0],
-                               dimensions[1], dimensions[2], boundary_len),
-                               'F')
-    hdr['cal_min'] = np.nanmin(boundary_data)
-    hdr['cal_max'] = np.nanmax(boundary_data)
-    boundaries = nb.Nifti1Image(boundary_data, aff, hdr)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, depth_file), depth)
-        save_volume(os.path.join(output_dir, layer_file), layers)
-        save_volume(os.path.join(output_dir, boundary_file), boundaries)
-
-    return {'depth': depth, 'layers': layers, 'boundaries': boundaries}
+    report_heap_usage('volumetric_layering')
+
+    # collect the selected outputs
+    results = {}
+
+    if 'depth' in outputs:
+        depth_data = _uncrop(from_jarray(
+                                lamination.getContinuousDepthMeasurement(),
+                                crop_dimensions), box, dimensions)
+        hdr['cal_max'] = np.nanmax(depth_data)
+        results['depth'] = nb.Nifti1Image(depth_data, aff, hdr)
+        if save_data:
+            save_volume(os.path.join(output_dir, depth_file),
+                        results['depth'])
+
+    if 'layers' in outputs:
+        layer_data = _uncrop(from_jarray(
+                                lamination.getDiscreteSampledLayers(),
+                                crop_dimensions, np.int32), box, dimensions)
+        hdr['cal_max'] = np.nanmax(layer_data)
+        results['layers'] = nb.Nifti1Image(layer_data, aff, hdr)
+        if save_data:
+            save_volume(os.path.join(output_dir, layer_file),
+                        results['layers'])
+
+    if 'boundaries' in outputs:
+        boundary_len = lamination.getLayerBoundarySurfacesLength()
+        boundary_data = _uncrop(from_jarray(
+                                lamination.getLayerBoundarySurfaces(),
+                                crop_dimensions + (boundary_len,)),
+                                box, dimensions, levelset=True)
+        hdr['cal_min'] = np.nanmin(boundary_data)
+        hdr['cal_max'] = np.nanmax(boundary_data)
+        results['boundaries'] = nb.Nifti1Image(boundary_data, aff, hdr)
+        if sparse:
+            # keep the levelsets in and just around the cortex
+            results['boundaries'] = SparseVolume.from_nifti(
+                                        results['boundaries'],
+                                        mask=(outer_data <= 2) &
+                                             (inner_data >= -2),
+                                        fill=np.nan)
+        elif narrow_band is not None:
+            results['boundaries'] = NarrowBandLevelset.from_nifti(
+                                        results['boundaries'], narrow_band)
+        if save_data:
+            save_volume(os.path.join(output_dir, boundary_file),
+                        results['boundaries'])
+
+    return results
@@ -0,0 +1,75 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import cbstools
+from jvm import attach_current_thread
+
+
+def _run_module(args):
+    func, kwargs = args
+    # the threads of the pool are new to the virtual machine, they must be
+    # attached before the module calls cbstools (modules starting the
+    # virtual machine themselves attach their thread in start_jvm)
+    if cbstools.getVMEnv() is not None:
+        attach_current_thread()
+    return func(**kwargs)
+
+
+def map_module(func, list_of_kwargs, n_workers=None):
+    '''
+    Runs independent calls of a nighres module concurrently, in threads
+    sharing a single Java virtual machine
+
+    Parameters
+    ----------
+    func: function
+        Nighres module to run, e.g. nighres.brain.enhance_region_contrast
+    list_of_kwargs: list of dict
+        Keyword arguments of each call of the module
+    n_workers: int, optional
+        Number of calls running at the same time (default is the number of
+        calls, up to the number of CPUs)
+
+    Returns
+    ----------
+    list
+        Outputs of the module for each call, in the order of list_of_kwargs
+
+    Notes
+    ----------
+    The cbstools modules release the Python interpreter lock while running,
+    so the calls effectively run in parallel, while the data already loaded
+    in the virtual machine (e.g. the atlas or topology look-up tables) and
+    its heap are shared rather than duplicated as with separate processes.
+    Each worker thread is attached to the virtual machine before running
+    the module, or by the module itself if it starts the virtual machine
+    (see :func:`nighres.jvm.start_jvm`). Make sure the calls do
+    not write to the same output files, and that the Java heap is large
+    enough for all of them (see :func:`nighres.jvm.configure_jvm`).
+
+    Example
+    ----------
+    >>> results = map_module(nighres.brain.enhance_region_contrast,
+    ...                      [dict(intensity_image=t1, **common),
+    ...                       dict(intensity_image=flair, **common)],
+    ...                      n_workers=2)
+    '''
+    list_of_kwargs = list(list_of_kwargs)
+    if len(list_of_kwargs) == 0:
+        return []
+
+    if n_workers is None:
+        n_workers = min(len(list_of_kwargs), multiprocessing.cpu_count())
+    if n_workers < 1:
+        raise ValueError("n_workers must be at least 1")
+
+    if n_workers == 1:
+        return [func(**kwargs) for kwargs in list_of_kwargs]
+
+    pool = ThreadPool(n_workers)
+    try:
+        return pool.map(_run_module,
+                        [(func, kwargs) for kwargs in list_of_kwargs],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
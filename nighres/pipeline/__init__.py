@@ -0,0 +1 @@
+from voxel_expr import voxel_expr
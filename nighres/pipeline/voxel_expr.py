@@ -0,0 +1,255 @@
+import os
+import ast
+import numpy as np
+import nibabel as nb
+from ..io import load_volume, save_volume
+from ..utils import _output_dir_4saving, _fname_4saving
+
+# functions reducing an image to a single value, computed with numpy before
+# the voxel-wise part of the expression is evaluated
+_REDUCTIONS = {'max': np.nanmax, 'min': np.nanmin, 'mean': np.nanmean,
+               'sum': np.nansum, 'percentile': np.nanpercentile}
+
+# voxel-wise functions, with the number of arguments they take
+_FUNCTIONS = {'abs': 1, 'sqrt': 1, 'exp': 1, 'log': 1,
+              'maximum': 2, 'minimum': 2, 'where': 3}
+
+_OPERATORS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+              ast.Pow: '**', ast.BitAnd: '&', ast.BitOr: '|',
+              ast.USub: '-', ast.UAdd: '+', ast.Invert: '~',
+              ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+              ast.Eq: '==', ast.NotEq: '!='}
+
+
+def _numexpr():
+    # numexpr evaluates the voxel-wise expression in a single pass over
+    # blocks of the images, without the temporary images numpy creates for
+    # each operation
+    try:
+        import numexpr
+        return numexpr
+    except ImportError:
+        return None
+
+
+class _Compiler(object):
+    # turns the parsed expression into a voxel-wise expression string, in
+    # which the reductions and the volumes of 4D images are replaced by
+    # variables holding their (pre-computed) values
+
+    def __init__(self, images, numexpr):
+        self.images = images
+        self.numexpr = numexpr
+        self.variables = {}
+        self.computed = {}
+
+    def _variable(self, node, compute):
+        # computes the value of a node once, even if it appears several
+        # times in the expression
+        key = ast.dump(node)
+        if key not in self.computed:
+            name = '_v{0}'.format(len(self.computed))
+            self.variables[name] = compute()
+            self.computed[key] = name
+        return self.computed[key]
+
+    def _constant(self, node):
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -self._constant(node.operand)
+        raise ValueError("Expected a number in the expression, found "
+                         "{0}".format(ast.dump(node)))
+
+    def compile(self, node):
+        if isinstance(node, ast.Expression):
+            return self.compile(node.body)
+        if isinstance(node, ast.Num):
+            return repr(float(node.n))
+        if isinstance(node, ast.Name):
+            if node.id == 'nan' and node.id not in self.images:
+                # NaN values are ignored by the reductions
+                self.variables['nan'] = np.float32(np.nan)
+                return 'nan'
+            if node.id not in self.images:
+                raise ValueError("Unknown image {0} in the "
+                                 "expression".format(node.id))
+            if self.images[node.id].ndim > 3:
+                raise ValueError("{0} is a 4D image, use {0}[i] for its i-th "
+                                 "volume".format(node.id))
+            self.variables[node.id] = self.images[node.id]
+            return node.id
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            return '({0} {1} {2})'.format(self.compile(node.left),
+                                          _OPERATORS[type(node.op)],
+                                          self.compile(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+            return '({0}{1})'.format(_OPERATORS[type(node.op)],
+                                     self.compile(node.operand))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and \
+                type(node.ops[0]) in _OPERATORS:
+            return '({0} {1} {2})'.format(self.compile(node.left),
+                                          _OPERATORS[type(node.ops[0])],
+                                          self.compile(node.comparators[0]))
+        if isinstance(node, ast.Subscript):
+            return self._volume(node)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id in _REDUCTIONS:
+                return self._reduction(node)
+            if node.func.id in _FUNCTIONS:
+                return self._function(node)
+        raise ValueError("Unsupported operation in the expression: "
+                         "{0}".format(ast.dump(node)))
+
+    def _volume(self, node):
+        # image[i] is the i-th volume of a 4D image
+        if not isinstance(node.value, ast.Name) or \
+                node.value.id not in self.images:
+            raise ValueError("Only the images can be indexed in the "
+                             "expression")
+        index = node.slice
+        if isinstance(index, ast.Index):
+            index = index.value
+        volume = int(self._constant(index))
+        image = self.images[node.value.id]
+        if image.ndim != 4:
+            raise ValueError("{0} is not a 4D image, it cannot be "
+                             "indexed".format(node.value.id))
+        if volume < 0 or volume >= image.shape[3]:
+            raise ValueError("{0} has {1} volumes, {0}[{2}] does not "
+                             "exist".format(node.value.id, image.shape[3],
+                                            volume))
+        return self._variable(node, lambda: image[..., volume])
+
+    def _reduction(self, node):
+        function = _REDUCTIONS[node.func.id]
+        expected = 2 if node.func.id == 'percentile' else 1
+        if len(node.args) != expected:
+            raise ValueError("{0} takes {1} argument(s)".format(
+                             node.func.id, expected))
+        parameters = [self._constant(arg) for arg in node.args[1:]]
+
+        def compute():
+            values = _Compiler(self.images, self.numexpr).evaluate(
+                                                            node.args[0])
+            return float(function(values, *parameters))
+
+        return self._variable(node, compute)
+
+    def _function(self, node):
+        name = node.func.id
+        if len(node.args) != _FUNCTIONS[name]:
+            raise ValueError("{0} takes {1} argument(s)".format(
+                             name, _FUNCTIONS[name]))
+        args = [self.compile(arg) for arg in node.args]
+        if self.numexpr is not None and name in ('maximum', 'minimum'):
+            # numexpr has no element-wise maximum
+            comparison = '>' if name == 'maximum' else '<'
+            return 'where({0} {1} {2}, {0}, {2})'.format(args[0], comparison,
+                                                         args[1])
+        return '{0}({1})'.format(name, ', '.join(args))
+
+    def evaluate(self, node):
+        expression = self.compile(node)
+        if self.numexpr is not None:
+            return self.numexpr.evaluate(expression,
+                                         local_dict=self.variables)
+        namespace = dict((name, getattr(np, name)) for name in _FUNCTIONS)
+        namespace['__builtins__'] = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return eval(expression, namespace, self.variables)
+
+
+def voxel_expr(expression, images, save_data=False, output_dir=None,
+               file_name=None):
+
+    """ Voxel expression
+
+    Evaluates an arithmetic expression on images in memory, in place of a
+    chain of image calculator steps each writing an intermediate image.
+
+    Parameters
+    ----------
+    expression: str
+        Expression combining the images with +, -, *, /, **, comparisons,
+        & and | (logical and, or), the voxel-wise functions abs, sqrt, exp,
+        log, maximum(a, b), minimum(a, b) and where(condition, a, b), and
+        the functions max, min, mean, sum and percentile(a, q) which reduce
+        an image to a single value, e.g.
+        '(region - intervent + horns) / percentile(region - intervent + horns,
+        98)'. image[i] is the i-th volume of a 4D image, which can only be
+        used through its volumes. nan stands for
+        NaN, which the reductions ignore: percentile(where(a > 0, a, nan),
+        98) is the 98th percentile of the positive voxels of a.
+    images: dict
+        Images (niimg) under the names used in the expression
+    save_data: bool
+        Save output data to file (default is False)
+    output_dir: str, optional
+        Path to desired output directory, will be created if it doesn't exist
+    file_name: str, optional
+        Desired base name for output files with file extension
+        (suffixes will be added)
+
+    Returns
+    ----------
+    niimg
+        Result of the expression, as float32, with the geometry of the first
+        image of the expression (output file suffix _expr)
+
+    Notes
+    ----------
+    The expression is evaluated in a single pass with numexpr when it is
+    installed, with numpy otherwise. Sub-expressions appearing several times
+    in reductions are only computed once, and the images are only loaded if
+    they are used in the expression.
+    """
+
+    print('\nVoxel expression: ' + expression)
+
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("Invalid expression: {0}".format(expression))
+
+    # images used in the expression, the first one giving the geometry
+    names = sorted(set((node.col_offset, node.id) for node in ast.walk(tree)
+                       if isinstance(node, ast.Name) and node.id in images))
+    if len(names) == 0:
+        raise ValueError("The expression must use at least one image")
+    reference = names[0][1]
+
+    # make sure that saving related parameters are correct
+    if save_data:
+        output_dir = _output_dir_4saving(output_dir, images[reference])
+
+        expr_file = _fname_4saving(file_name=file_name,
+                                   rootfile=images[reference],
+                                   suffix='expr')
+
+    # load the data
+    loaded = {}
+    for _, name in names:
+        if name not in loaded:
+            loaded[name] = load_volume(images[name])
+    data = dict((name, np.asarray(img.get_data(), dtype=np.float32))
+                for name, img in loaded.items())
+    shape = data[reference].shape[:3]
+    for name in data:
+        if data[name].shape[:3] != shape:
+            raise ValueError("Image {0} does not have the dimensions of "
+                             "{1}".format(name, reference))
+
+    result = _Compiler(data, _numexpr()).evaluate(tree)
+    result = np.asarray(np.broadcast_to(result, shape), dtype=np.float32)
+
+    hdr = loaded[reference].get_header().copy()
+    hdr.set_data_dtype(np.float32)
+    hdr['cal_min'] = np.nanmin(result)
+    hdr['cal_max'] = np.nanmax(result)
+    expr = nb.Nifti1Image(result, loaded[reference].get_affine(), hdr)
+
+    if save_data:
+        save_volume(os.path.join(output_dir, expr_file), expr)
+
+    return expr
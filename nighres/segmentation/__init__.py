@@ -1,2 +1,3 @@
 from lesion_extraction import lesion_extraction
 from distance_based_probability import distance_based_probability
+from remap_labels import remap_labels
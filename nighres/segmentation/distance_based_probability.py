@@ -5,8 +5,12 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def distance_based_probability(segmentation_image, #probability_image,
                                #bg_dist_mm, bg_proba, dist_ratio,
                                #bg_included, 
@@ -83,10 +87,7 @@ def distance_based_probability(segmentation_image, #probability_image,
         #                           suffix='labels')
 
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(segmentation_image)
     # create extraction instance
     dbp = cbstools.SegmentationDistanceBasedProbability()
 
@@ -110,7 +111,7 @@ def distance_based_probability(segmentation_image, #probability_image,
     dbp.setResolutions(resolution[0], resolution[1], resolution[2])
 
     # input segmentation image
-    dbp.setSegmentationImage(cbstools.JArray('int')((data.flatten('F')).astype(int)))
+    dbp.setSegmentationImage(to_jarray(data, 'int'))
 
     # input prior probability image
     #data = load_volume(probability_image).get_data()
@@ -128,19 +129,19 @@ def distance_based_probability(segmentation_image, #probability_image,
         raise
         return
 
+    report_heap_usage('distance_based_probability')
+
     # reshape output to what nibabel likes
     dimensions4d = [dimensions[0], dimensions[1], dimensions[2], 4]
-    prob_image_data = np.reshape(np.array(dbp.getProbabilityImage(),
-                                   dtype=np.float32), dimensions4d, 'F')
+    prob_image_data = from_jarray(dbp.getProbabilityImage(), dimensions4d)
     
-    max_label_data = np.reshape(np.array(dbp.getMaxLabelImage(),
-                                   dtype=np.int32), dimensions4d, 'F')
+    max_label_data = from_jarray(dbp.getMaxLabelImage(),
+                                 dimensions4d, np.int32)
     
-    bg_mask_data = np.reshape(np.array(dbp.getBackgroundMaskImage(),
-                                    dtype=np.int32), dimensions, 'F')
+    bg_mask_data = from_jarray(dbp.getBackgroundMaskImage(),
+                               dimensions, np.int32)
     
-    mgdm_image_data = np.reshape(np.array(dbp.getMgdmImage(),
-                                    dtype=np.float32), dimensions, 'F')
+    mgdm_image_data = from_jarray(dbp.getMgdmImage(), dimensions)
     
     #label_number_data = dbp.getLabelNumber()
     
@@ -5,15 +5,20 @@ import sys
 import cbstools
 from ..io import load_volume, save_volume
 from ..utils import _output_dir_4saving, _fname_4saving, \
-                    _check_topology_lut_dir, _check_atlas_file
+                    _check_topology_lut_dir, _check_atlas_file, \
+                    _check_outputs
+from .._jbridge import to_jarray, from_jarray
+from ..jvm import start_jvm, report_heap_usage
+from ..cache import cached
 
 
+@cached
 def lesion_extraction(probability_image, segmentation_image,
                       levelset_boundary_image, location_prior_image,
                       atlas_file,
                       gm_boundary_partial_vol_dist, csf_boundary_partial_vol_dist,
                       lesion_clust_dist, prob_min_thresh, prob_max_thresh,
-                      small_lesion_size,
+                      small_lesion_size, outputs=None,
                       save_data=False, output_dir=None,
                       file_name=None):
     
@@ -32,8 +37,9 @@ def lesion_extraction(probability_image, segmentation_image,
 
 	location_prior_image: niimg
 	   
-	atlas_file: str
-	    Path to MGDM brain atlas file (default is stored in DEFAULT_ATLAS)
+	atlas_file: str or Atlas
+	    Path to MGDM brain atlas file (default is stored in DEFAULT_ATLAS),
+	    or a parsed :class:`nighres.io.Atlas`
 
 	gm_boundary_partial_vol_dist: float
 
@@ -47,12 +53,16 @@ def lesion_extraction(probability_image, segmentation_image,
 
 	small_lesion_size: float
 
+    outputs: list of str, optional
+        Outputs to retrieve from the module, among the keys listed below
+        (default is all outputs)
     
     Returns
     ----------
    	dict
         Dictionary collecting outputs under the following keys
-        (suffix of output files in brackets)
+        (suffix of output files in brackets), restricted to the selected
+        outputs
 
         * lesion_prior (niimg): 
         * lesion_size (niimg): 
@@ -72,42 +82,20 @@ def lesion_extraction(probability_image, segmentation_image,
 
     print('\n Lesion Extraction')
 
+    # check which outputs to retrieve
+    outputs = _check_outputs(outputs, ['lesion_prior', 'lesion_size',
+                                       'lesion_proba', 'lesion_pv',
+                                       'lesion_labels', 'lesion_score'])
+
     # check atlas_file and set default if not given
-    #atlas_file = _check_atlas_file(atlas_file)
+    atlas_file = _check_atlas_file(atlas_file)
 
     # make sure that saving related parameters are correct
     if save_data:
         output_dir = _output_dir_4saving(output_dir, probability_image)
 
-        lesion_prior_file = _fname_4saving(file_name=file_name,
-                                  rootfile=probability_image,
-                                  suffix='lesion_prior')
-
-        lesion_size_file = _fname_4saving(file_name=file_name,
-                                  rootfile=probability_image,
-                                  suffix='lesion_size')
-
-        lesion_proba_file = _fname_4saving(file_name=file_name,
-                                   rootfile=probability_image,
-                                   suffix='lesion_proba')
-
-        lesion_pv_file = _fname_4saving(file_name=file_name,
-                                   rootfile=probability_image,
-                                   suffix='lesion_pv')
-
-        lesion_labels_file = _fname_4saving(file_name=file_name,
-                                   rootfile=probability_image,
-                                   suffix='lesion_labels')
-
-        lesion_score_file = _fname_4saving(file_name=file_name,
-                                   rootfile=probability_image,
-                                   suffix='lesion_score')
-
     # start virtual machine, if not already running
-    try:
-        cbstools.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    start_jvm(segmentation_image)
     # create extraction instance
     el = cbstools.SegmentationLesionExtraction()
 
@@ -134,19 +122,19 @@ def lesion_extraction(probability_image, segmentation_image,
     el.setResolutions(resolution[0], resolution[1], resolution[2])
 
     # input segmentation_image
-    el.setSegmentationImage(cbstools.JArray('int')((data.flatten('F')).astype(int)))
+    el.setSegmentationImage(to_jarray(data, 'int'))
 
     # input levelset_boundary_image
     data = load_volume(levelset_boundary_image).get_data()
-    el.setLevelsetBoundaryImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    el.setLevelsetBoundaryImage(to_jarray(data, 'float'))
     
     # input levelset_boundary_image
     data = load_volume(probability_image).get_data()
-    el.setProbaImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    el.setProbaImage(to_jarray(data, 'float'))
     
     # input levelset_boundary_image
     data = load_volume(location_prior_image).get_data()
-    el.setLocationPriorImage(cbstools.JArray('float')((data.flatten('F')).astype(float)))
+    el.setLocationPriorImage(to_jarray(data, 'float'))
     
 
     # execute Extraction
@@ -160,54 +148,33 @@ def lesion_extraction(probability_image, segmentation_image,
         raise
         return
 
-    # reshape output to what nibabel likes
-    lesion_prior_data = np.reshape(np.array(el.getRegionPrior(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    lesion_size_data = np.reshape(np.array(el.getLesionSize(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    lesion_proba_data = np.reshape(np.array(el.getLesionProba(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-    lesion_pv_data = np.reshape(np.array(el.getBoundaryPartialVolume(),
-                                   dtype=np.float32), dimensions, 'F')
-
-    lesion_labels_data = np.reshape(np.array(el.getLesionLabels(),
-                                    dtype=np.int32), dimensions, 'F')
-    
-    lesion_score_data = np.reshape(np.array(el.getLesionScore(),
-                                    dtype=np.float32), dimensions, 'F')
-    
-
-    # adapt header max for each image so that correct max is displayed
-    # and create nifiti objects
-    header['cal_max'] = np.nanmax(lesion_prior_data)
-    lesion_prior = nb.Nifti1Image(lesion_prior_data, affine, header)
-
-    header['cal_max'] = np.nanmax(lesion_size_data)
-    lesion_size = nb.Nifti1Image(lesion_size_data, affine, header)
-
-    header['cal_max'] = np.nanmax(lesion_proba_data)
-    lesion_proba = nb.Nifti1Image(lesion_proba_data, affine, header)
-
-    header['cal_max'] = np.nanmax(lesion_pv_data)
-    lesion_pv = nb.Nifti1Image(lesion_pv_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(lesion_labels_data)
-    lesion_labels = nb.Nifti1Image(lesion_labels_data, affine, header)
-    
-    header['cal_max'] = np.nanmax(lesion_score_data)
-    lesion_score = nb.Nifti1Image(lesion_score_data, affine, header)
-
-    if save_data:
-        save_volume(os.path.join(output_dir, lesion_prior_file), lesion_prior)
-        save_volume(os.path.join(output_dir, lesion_size_file), lesion_size)
-        save_volume(os.path.join(output_dir, lesion_proba_file), lesion_proba)
-        save_volume(os.path.join(output_dir, lesion_pv_file), lesion_pv)
-        save_volume(os.path.join(output_dir, lesion_labels_file), lesion_labels)
-        save_volume(os.path.join(output_dir, lesion_score_file), lesion_score)
-
-    return {'lesion_prior': lesion_prior, 'lesion_size': lesion_size,
-            'lesion_proba': lesion_proba, 'lesion_pv': lesion_pv,
-            'lesion_labels': lesion_labels, 'lesion_score': lesion_score}
+    report_heap_usage('lesion_extraction')
+
+    # Java methods returning each output and its data type (the outputs
+    # are saved with their key as suffix)
+    getters = {'lesion_prior': (el.getRegionPrior, np.float32),
+               'lesion_size': (el.getLesionSize, np.float32),
+               'lesion_proba': (el.getLesionProba, np.float32),
+               'lesion_pv': (el.getBoundaryPartialVolume, np.float32),
+               'lesion_labels': (el.getLesionLabels, np.int32),
+               'lesion_score': (el.getLesionScore, np.float32)}
+
+    results = {}
+    for output in outputs:
+        # reshape output to what nibabel likes
+        getter, dtype = getters[output]
+        data = from_jarray(getter(), dimensions, dtype)
+
+        # adapt header max for each image so that correct max is displayed
+        # and create nifiti objects
+        header['cal_max'] = np.nanmax(data)
+        results[output] = nb.Nifti1Image(data, affine, header)
+
+        if save_data:
+            output_file = _fname_4saving(file_name=file_name,
+                                         rootfile=probability_image,
+                                         suffix=output)
+            save_volume(os.path.join(output_dir, output_file),
+                        results[output])
+
+    return results
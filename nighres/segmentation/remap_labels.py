@@ -0,0 +1,162 @@
+import os
+import numpy as np
+import nibabel as nb
+from ..io import load_volume, save_volume
+from ..utils import _output_dir_4saving, _fname_4saving
+from ..cache import cached
+
+# largest range of labels remapped with a dense look-up table, beyond it the
+# labels present in the image are looked up instead
+_MAX_LUT_SIZE = 1 << 24
+
+
+def _label_dtype(values):
+    # smallest integer type holding all the values
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype(np.uint8)
+    return np.promote_types(np.min_scalar_type(int(values.min())),
+                            np.min_scalar_type(int(values.max())))
+
+
+def _is_integer(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer) or values.size == 0:
+        return True
+    return values.dtype.kind in 'fb' and np.array_equal(np.round(values),
+                                                         values)
+
+
+def _remap_array(labels, sources, targets, default, dtype):
+    # replaces the sources by the targets in an integer array with a single
+    # indexing of a look-up table
+    if labels.size == 0:
+        return np.zeros(labels.shape, dtype=dtype)
+    lowest = int(labels.min())
+    highest = int(labels.max())
+    # index with the labels directly when they are positive, rather than
+    # offsetting them, which needs a wider copy of the image
+    base = 0 if lowest >= 0 and highest < _MAX_LUT_SIZE else lowest
+
+    if highest - base < _MAX_LUT_SIZE:
+        if default is None:
+            lut = np.arange(base, highest + 1).astype(dtype)
+        else:
+            lut = np.empty(highest - base + 1, dtype=dtype)
+            lut.fill(default)
+        inside = (sources >= base) & (sources <= highest)
+        lut[sources[inside] - base] = targets[inside]
+        if base == 0:
+            return lut[labels]
+        return lut[labels.astype(np.intp) - base]
+
+    # labels spread over a very large range: remap the labels present only
+    present, indices = np.unique(labels, return_inverse=True)
+    if default is None:
+        lut = present.astype(dtype)
+    else:
+        lut = np.empty(present.size, dtype=dtype)
+        lut.fill(default)
+    positions = np.searchsorted(present, sources)
+    positions[positions == present.size] = 0
+    found = present[positions] == sources
+    lut[positions[found]] = targets[found]
+    return lut[indices].reshape(labels.shape)
+
+
+@cached
+def remap_labels(label_image, mapping, default=0, dtype=None,
+                 save_data=False, output_dir=None, file_name=None):
+
+    """ Remap labels
+
+    Converts the labels of a segmentation into new labels, e.g. FreeSurfer
+    labels into MGDM labels. Several labels can be merged into one, but a
+    label cannot be split.
+
+    Parameters
+    ----------
+    label_image: niimg
+        Segmentation with integer labels
+    mapping: dict
+        New label of each label of the segmentation
+    default: int, optional
+        Value of the labels missing from the mapping (default is 0, None
+        keeps the original labels)
+    dtype: numpy dtype, optional
+        Data type of the remapped segmentation (default is the smallest
+        integer type holding all the new labels)
+    save_data: bool
+        Save output data to file (default is False)
+    output_dir: str, optional
+        Path to desired output directory, will be created if it doesn't exist
+    file_name: str, optional
+        Desired base name for output files with file extension
+        (suffixes will be added)
+
+    Returns
+    ----------
+    niimg
+        Remapped segmentation (output file suffix _remap)
+
+    Notes
+    ----------
+    The segmentation is remapped with a single indexing of a look-up table
+    covering the range of its labels, so the cost does not depend on the
+    number of labels. Negative labels and labels spread over a very large
+    range are supported.
+    """
+
+    print('\nRemap labels')
+
+    # make sure that saving related parameters are correct
+    if save_data:
+        output_dir = _output_dir_4saving(output_dir, label_image)
+
+        remap_file = _fname_4saving(file_name=file_name,
+                                    rootfile=label_image,
+                                    suffix='remap')
+
+    # load the data
+    label_img = load_volume(label_image)
+    labels = np.asanyarray(label_img.get_data())
+    if not np.issubdtype(labels.dtype, np.integer):
+        # labels stored as floats or with a scaling in the header
+        if not _is_integer(labels):
+            raise ValueError("The segmentation must contain integer labels")
+        labels = labels.astype(_label_dtype(labels))
+
+    keys = sorted(mapping.keys())
+    sources = np.array(keys)
+    targets = np.array([mapping[key] for key in keys])
+    if not (_is_integer(sources) and _is_integer(targets)):
+        raise ValueError("The mapping must contain integer labels")
+    sources = sources.astype(np.int64)
+    targets = targets.astype(np.int64)
+
+    # type of the output, checking that all labels fit in it
+    new_labels = list(targets)
+    if default is not None:
+        new_labels.append(default)
+    elif labels.size > 0:
+        new_labels.extend([labels.min(), labels.max()])
+    if dtype is None:
+        dtype = _label_dtype(new_labels)
+    dtype = np.dtype(dtype)
+    if len(new_labels) > 0 and np.issubdtype(dtype, np.integer) and (
+            min(new_labels) < np.iinfo(dtype).min or
+            max(new_labels) > np.iinfo(dtype).max):
+        raise ValueError("The new labels do not fit in {0}".format(dtype))
+
+    remapped = _remap_array(labels, sources, targets, default, dtype)
+
+    hdr = label_img.get_header().copy()
+    hdr.set_data_dtype(dtype)
+    hdr['cal_min'] = np.min(remapped) if remapped.size else 0
+    hdr['cal_max'] = np.max(remapped) if remapped.size else 0
+    remap = nb.Nifti1Image(remapped, label_img.get_affine(), hdr)
+
+    if save_data:
+        save_volume(os.path.join(output_dir, remap_file), remap)
+
+    return remap
@@ -0,0 +1,54 @@
+import os
+import hashlib
+import numpy as np
+import nibabel as nb
+from nighres import cache
+from nighres.surface import probability_to_levelset
+
+
+# the module itself, as seen by the cache decorator
+_module = probability_to_levelset.__wrapped__
+
+
+def _key(**callargs):
+    return cache._cache_key(_module, callargs)
+
+
+def test_file_parameters_are_hashed_by_identity(tmpdir):
+    image_file = str(tmpdir.join('probability.nii'))
+    data = np.zeros((8, 8, 8), dtype=np.float32)
+    data[2:6, 2:6, 2:6] = 1
+    nb.Nifti1Image(data, np.eye(4)).to_filename(image_file)
+
+    key = _key(probability_image=image_file)
+    image_key = _key(probability_image=nb.load(image_file))
+    assert key == _key(probability_image=image_file)
+    assert image_key == _key(probability_image=nb.load(image_file))
+
+    # rewriting the file changes the keys, also for images read from the
+    # file but not loaded
+    stat = os.stat(image_file)
+    os.utime(image_file, (stat.st_atime, stat.st_mtime + 10))
+    assert key != _key(probability_image=image_file)
+    assert image_key != _key(probability_image=nb.load(image_file))
+
+
+def test_other_strings_are_hashed_as_values(tmpdir):
+    # a string parameter naming a file is not read nor identified as one
+    name = str(tmpdir.join('fast'))
+    with open(name, 'w') as fp:
+        fp.write('1')
+    sha = hashlib.sha1()
+    cache._hash_value(sha, name)
+    expected = hashlib.sha1()
+    expected.update(repr(name))
+    assert sha.hexdigest() == expected.hexdigest()
+
+
+def test_key_depends_on_version_and_source(monkeypatch):
+    key = _key(probability_image=None)
+    monkeypatch.setattr(cache, '__version__', 'other')
+    assert key != _key(probability_image=None)
+    monkeypatch.undo()
+    monkeypatch.setitem(cache._source_hashes, _module, 'edited')
+    assert key != _key(probability_image=None)
@@ -0,0 +1,18 @@
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+from nighres.io.io_mesh import _read_vtk, _write_vtk
+
+
+def test_ascii_vtk_is_read_in_double_precision(tmpdir):
+    vtk_file = str(tmpdir.join('mesh.vtk'))
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1.25]])
+    faces = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+    data = np.array([[0.1], [0.2], [0.3], [0.123456789012]])
+    _write_vtk(vtk_file, vertices, faces, data)
+
+    coords, triangles, values = _read_vtk(vtk_file)
+    assert coords.dtype == np.float64
+    assert values.dtype == np.float64
+    assert_array_equal(coords, vertices)
+    assert_array_equal(triangles, faces)
+    assert_allclose(values, data, rtol=0, atol=1e-15)
@@ -0,0 +1,20 @@
+import numpy as np
+import nibabel as nb
+import pytest
+from numpy.testing import assert_array_equal
+from nighres.io import load_volume
+
+
+@pytest.mark.parametrize('endianness', ['<', '>'])
+@pytest.mark.parametrize('klass', [nb.Nifti1Image, nb.Nifti2Image])
+def test_gzip_readers_load_both_byte_orders(tmpdir, endianness, klass):
+    data = np.arange(60, dtype=np.float32).reshape(3, 4, 5)
+    header = klass(data, np.eye(4)).header.as_byteswapped(endianness)
+    filename = str(tmpdir.join('image.nii.gz'))
+    klass(data, np.eye(4), header).to_filename(filename)
+    assert nb.load(filename).header.endianness == endianness
+
+    image = load_volume(filename, gzip_reader='zlib')
+    assert isinstance(image, klass)
+    assert image.header.endianness == endianness
+    assert_array_equal(image.get_data(), data)
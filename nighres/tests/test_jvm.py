@@ -0,0 +1,11 @@
+import pytest
+from nighres import jvm
+
+
+def test_configure_running_jvm_warns(monkeypatch):
+    monkeypatch.setitem(jvm._running_heap, 'initial_heap', '4000m')
+    monkeypatch.setitem(jvm._running_heap, 'max_heap', '4000m')
+    monkeypatch.setitem(jvm._jvm_settings, 'initial_heap', None)
+    monkeypatch.setitem(jvm._jvm_settings, 'max_heap', None)
+    with pytest.warns(UserWarning, match='already running'):
+        jvm.configure_jvm(max_heap='8g')
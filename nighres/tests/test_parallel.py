@@ -0,0 +1,80 @@
+import sys
+import time
+import threading
+import pytest
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_array_equal
+from nighres.parallel import map_module
+from nighres.surface import probability_to_levelset
+
+
+def _sphere_probabilities(radii, size=24):
+    # soft spheres of different radii, so that the outputs of each call differ
+    distance = np.sqrt(((np.indices((size,) * 3) - size / 2.0) ** 2).sum(0))
+    return [nb.Nifti1Image(np.clip(radius + 0.5 - distance, 0, 1)
+                           .astype(np.float32), np.eye(4))
+            for radius in radii]
+
+
+def test_map_module_matches_serial_runs():
+    list_of_kwargs = [dict(probability_image=image, engine='numpy')
+                      for image in _sphere_probabilities([4, 6.5, 8, 9.3])]
+
+    serial = [probability_to_levelset(**kwargs) for kwargs in list_of_kwargs]
+    parallel = map_module(probability_to_levelset, list_of_kwargs,
+                          n_workers=3)
+
+    assert len(parallel) == len(serial)
+    for levelset, expected in zip(parallel, serial):
+        assert_array_equal(levelset.get_data(), expected.get_data())
+
+
+def test_map_module_without_calls():
+    assert map_module(probability_to_levelset, []) == []
+    with pytest.raises(ValueError):
+        map_module(probability_to_levelset, [dict(probability_image=None)],
+                   n_workers=0)
+
+
+class _FakeEnv(object):
+    def __init__(self):
+        self.attached = set()
+
+    def attachCurrentThread(self):
+        self.attached.add(threading.current_thread().ident)
+
+
+class _FakeCbstools(object):
+    # stands for the JCC module, records the threads attached to the VM
+    def __init__(self):
+        self.env = None
+
+    def initVM(self, initialheap=None, maxheap=None):
+        self.env = _FakeEnv()
+
+    def getVMEnv(self):
+        return self.env
+
+
+def test_map_module_attaches_worker_threads(monkeypatch):
+    fake = _FakeCbstools()
+    for module in ('nighres.jvm', 'nighres.parallel'):
+        monkeypatch.setattr(sys.modules[module], 'cbstools', fake)
+    fake.initVM()
+    main_thread = threading.current_thread().ident
+
+    def module(value):
+        thread = threading.current_thread().ident
+        # let the other workers pick up the next calls
+        time.sleep(0.01)
+        return value, thread, thread in fake.env.attached
+
+    results = map_module(module, [dict(value=v) for v in range(12)],
+                         n_workers=4)
+
+    assert [value for value, _, _ in results] == list(range(12))
+    assert all(attached for _, _, attached in results)
+    workers = set(thread for _, thread, _ in results)
+    assert main_thread not in workers
+    assert len(workers) > 1
@@ -0,0 +1,81 @@
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_allclose
+from nighres.laminar import profile_sampling
+
+# concentric spheres, off the voxel grid, from the inner (first) to the outer
+# (last) surface of the cortex
+_SIZE = 32
+_CENTER = np.array([15.6, 16.2, 15.9])
+_RADII = [6, 8, 10, 12]
+# linear intensity ramp, so that profile errors translate into distances
+_GRADIENT = np.array([0.5, 0.25, 0.1])
+
+
+def _concentric_spheres():
+    grid = np.indices((_SIZE,) * 3).astype(np.float64)
+    distance = np.sqrt(((grid - _CENTER[:, None, None, None]) ** 2).sum(0))
+    surfaces = np.stack([distance - radius for radius in _RADII],
+                        axis=3).astype(np.float32)
+    intensity = (1.0 + np.tensordot(_GRADIENT, grid, axes=1)) \
+        .astype(np.float32)
+    return surfaces, intensity
+
+
+def _masked_linear_interpolation(image, mask, point):
+    # trilinear interpolation from the voxels of mask only, renormalising the
+    # weights, and 0 where none of the 8 neighbours is in the mask
+    corner = np.floor(point).astype(int)
+    if np.any(corner < 0) or np.any(corner > np.array(image.shape) - 2):
+        return 0.0
+    alpha = point - corner
+    value = weights = 0.0
+    for offset in np.ndindex(2, 2, 2):
+        neighbour = tuple(corner + offset)
+        if mask[neighbour]:
+            weight = np.prod(np.where(offset, alpha, 1.0 - alpha))
+            value += weight * image[neighbour]
+            weights += weight
+    return value / weights if weights > 0 else 0.0
+
+
+def test_numpy_engine_samples_along_radial_profiles():
+    surfaces, intensity = _concentric_spheres()
+    profiles = profile_sampling(nb.Nifti1Image(surfaces, np.eye(4)),
+                                nb.Nifti1Image(intensity, np.eye(4)),
+                                engine='numpy').get_data()
+    assert profiles.shape == surfaces.shape
+
+    cortex = (surfaces[..., 0] >= 0) & (surfaces[..., -1] <= 0)
+    assert np.all(profiles[~cortex] == 0)
+
+    # the profile of each cortical voxel crosses the spheres along its
+    # radius, where the intensity is interpolated from the cortex only
+    errors = []
+    for voxel in np.argwhere(cortex):
+        direction = voxel - _CENTER
+        direction /= np.sqrt(np.sum(direction ** 2))
+        expected = [_masked_linear_interpolation(
+                        intensity, cortex, _CENTER + radius * direction)
+                    for radius in _RADII]
+        errors.append(np.abs(profiles[tuple(voxel)] - expected))
+
+    # the trajectories are found by projecting onto trilinearly interpolated
+    # levelsets, so they are only a fraction of a voxel off the exact spheres
+    errors = np.array(errors) / np.sqrt(np.sum(_GRADIENT ** 2))
+    assert np.percentile(errors, 99) < 0.05
+    assert np.max(errors) < 0.25
+
+
+def test_numpy_engine_cropping_gives_the_same_profiles():
+    surfaces, intensity = _concentric_spheres()
+    surface_img = nb.Nifti1Image(surfaces, np.eye(4))
+    intensity_img = nb.Nifti1Image(intensity, np.eye(4))
+
+    full = profile_sampling(surface_img, intensity_img,
+                            engine='numpy').get_data()
+    cropped = profile_sampling(surface_img, intensity_img, crop_margin=2,
+                               engine='numpy').get_data()
+
+    assert cropped.shape == full.shape
+    assert_allclose(cropped, full, rtol=0, atol=1e-4)
@@ -0,0 +1,37 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+from nighres.utils import _crop_box, _uncrop
+
+
+def _sphere_levelset(size=40, radius=8):
+    grid = np.indices((size,) * 3).astype(np.float64)
+    return (np.sqrt(((grid - size / 2.0) ** 2).sum(0)) - radius) \
+        .astype(np.float32)
+
+
+def test_uncrop_levelsets_keep_growing_outside_the_box():
+    levelset = _sphere_levelset()
+    box = _crop_box(levelset <= 0, 3)
+    outside = np.ones(levelset.shape, dtype=bool)
+    outside[box] = False
+
+    uncropped = _uncrop(levelset[box], box, levelset.shape, levelset=True)
+    assert_array_equal(uncropped[box], levelset[box])
+    # never closer to the surface than the true distance, nor than inside
+    # the box
+    assert np.all(uncropped[outside] >= levelset[outside])
+    assert np.all(uncropped[outside] > np.abs(levelset[box]).max())
+
+    # each volume of a 4D image gets its own largest distance
+    levelsets = np.stack([levelset, levelset - 2], axis=3)
+    uncropped = _uncrop(levelsets[box + (slice(None),)], box,
+                        levelset.shape, levelset=True)
+    assert uncropped.shape == levelsets.shape
+    assert np.all(uncropped[outside][:, 0] > uncropped[outside][:, 1])
+
+
+def test_uncrop_copies_other_outputs_from_the_border():
+    mask = np.zeros((10, 10, 10), dtype=np.int32)
+    mask[3:6, 4:7, 2:8] = 1
+    box = _crop_box(mask, 1)
+    assert_array_equal(_uncrop(mask[box], box, mask.shape), mask)
@@ -1,7 +1,46 @@
 import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
 import warnings
+import numpy as np
+import global_settings
 from global_settings import TOPOLOGY_LUT_DIR, ATLAS_DIR, DEFAULT_ATLAS
 
+# per-thread log of the output names and files of the module being run,
+# only active while the result cache records a module call (see cache.py)
+_saving_log = threading.local()
+
+
+# compression of the saved images, overriding global_settings when set with
+# nighres.io.configure_compression
+_compression_settings = {'compression': None, 'level': None}
+
+
+def _compression():
+    compression = _compression_settings['compression'] or \
+        global_settings.COMPRESSION
+    if compression not in ('gzip', 'none'):
+        raise ValueError("The compression must be 'gzip' or 'none', not "
+                         "{0}".format(compression))
+    return compression
+
+
+def _compression_level():
+    level = int(_compression_settings['level'] or
+                global_settings.COMPRESSION_LEVEL)
+    if level < 1 or level > 9:
+        raise ValueError("The compression level must be between 1 and 9")
+    return level
+
+
+def _log_saving(*record):
+    log = getattr(_saving_log, 'records', None)
+    if log is not None:
+        log.append(record)
+
 
 def _output_dir_4saving(output_dir=None, rootfile=None):
     if (output_dir is None or output_dir==''):
@@ -12,9 +51,14 @@ def _output_dir_4saving(output_dir=None, rootfile=None):
             # if rootfile is specified, use it's directory
             output_dir = os.path.dirname(rootfile)
 
-    # create directory recursively if it doesn't exist
+    # create directory recursively if it doesn't exist, it may also be
+    # created at the same time by a module running in another thread
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            if not os.path.isdir(output_dir):
+                raise
 
     # make sure path ends on seperator
     if not(output_dir[-1] == os.path.sep):
@@ -29,6 +73,7 @@ def _output_dir_4saving(output_dir=None, rootfile=None):
                          "working directory otherwise)").format(output_dir)
 
     print("\nOutputs will be saved to {0}").format(output_dir)
+    _log_saving('dir', rootfile, output_dir)
     return output_dir
 
 
@@ -79,12 +124,18 @@ def _fname_4saving(file_name=None, rootfile=None, suffix=None):
         while split_name:
             base += '.'+split_name.pop(0)
 
+    # outputs of the modules are intermediate images for the next steps,
+    # saved uncompressed if so configured
+    if ext.endswith('.gz') and _compression() == 'none':
+        ext = ext[:-len('.gz')]
+
     # insert suffix if given
     if suffix is not None:
         fullname = base + '_' + suffix + '.' + ext
     else:
         fullname = base + '.' + ext
 
+    _log_saving('name', rootfile, suffix, fullname)
     return fullname
 
 
@@ -100,11 +151,67 @@ def _check_topology_lut_dir(topology_lut_dir):
     # make sure there is a  trailing slash
     topology_lut_dir = os.path.join(topology_lut_dir, '')
 
+    # use the uncompressed copies of the look-up tables, if enabled
+    if global_settings.TOPOLOGY_LUT_CACHE_DIR is not None:
+        topology_lut_dir = _uncompressed_topology_lut_dir(
+                                topology_lut_dir,
+                                global_settings.TOPOLOGY_LUT_CACHE_DIR)
+
     return topology_lut_dir
 
 
+# size of the uncompressed topology look-up tables (one byte per pattern of
+# the 26 neighbours of a voxel)
+_TOPOLOGY_LUT_SIZE = 1 << 26
+
+# directories of uncompressed look-up tables already checked in this
+# process, by directory of the compressed tables and cache directory
+_topology_lut_dirs = {}
+_topology_lut_lock = threading.Lock()
+
+
+def _uncompressed_topology_lut_dir(topology_lut_dir, cache_dir):
+    # copies the compressed look-up tables into the cache directory, next to
+    # their uncompressed version, which the Java modules map in memory
+    # rather than decompressing the tables each time they are loaded
+    key = (os.path.abspath(topology_lut_dir), os.path.abspath(cache_dir))
+    with _topology_lut_lock:
+        if key in _topology_lut_dirs:
+            return _topology_lut_dirs[key]
+
+        lut_dir = os.path.join(cache_dir,
+                               hashlib.sha1(key[0]).hexdigest()[:12], '')
+        if not os.path.isdir(lut_dir):
+            os.makedirs(lut_dir)
+        for name in sorted(os.listdir(topology_lut_dir)):
+            if not name.endswith('.raw.gz'):
+                continue
+            source = os.path.join(topology_lut_dir, name)
+            compressed = os.path.join(lut_dir, name)
+            raw = compressed[:-len('.gz')]
+            if os.path.isfile(compressed) and os.path.isfile(raw) and \
+                    os.path.getsize(raw) == _TOPOLOGY_LUT_SIZE and \
+                    os.path.getmtime(raw) >= os.path.getmtime(source):
+                continue
+            print("Decompressing topology look-up table " + name)
+            # write in temporary files renamed once complete, so that other
+            # processes never see a partial table
+            for target, opener in ((compressed, open), (raw, gzip.open)):
+                fd, tmp = tempfile.mkstemp(dir=lut_dir, prefix='.tmp')
+                with os.fdopen(fd, 'wb') as fp, opener(source, 'rb') as src:
+                    shutil.copyfileobj(src, fp, 1 << 20)
+                os.rename(tmp, target)
+
+        _topology_lut_dirs[key] = lut_dir
+        return lut_dir
+
+
 def _check_atlas_file(atlas_file):
 
+    # parsed atlases (see nighres.io.Atlas) are read from their file by the
+    # Java modules
+    atlas_file = getattr(atlas_file, 'path', atlas_file)
+
     if atlas_file is None:
         atlas_file = DEFAULT_ATLAS
     else:
@@ -117,3 +224,70 @@ def _check_atlas_file(atlas_file):
                 atlas_file = os.path.join(ATLAS_DIR, atlas_file)
 
     return atlas_file
+
+
+def _check_outputs(outputs, available):
+
+    # if no outputs are selected, compute all of them
+    if outputs is None:
+        return list(available)
+
+    if isinstance(outputs, basestring):
+        outputs = [outputs]
+
+    unknown = [output for output in outputs if output not in available]
+    if unknown:
+        raise ValueError("Unknown output(s) {0}, please choose from the "
+                         "following outputs: {1}".format(
+                             ", ".join(unknown), ", ".join(available)))
+
+    return list(outputs)
+
+
+def _crop_box(mask, margin):
+
+    # bounding box of the non-zero voxels of mask, grown by margin voxels and
+    # clipped to the image grid, as a tuple of slices
+    mask = np.asarray(mask)
+    box = []
+    for axis in range(mask.ndim):
+        others = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=others))
+        if nonzero.size == 0:
+            # empty region, keep the whole image
+            return tuple(slice(0, n) for n in mask.shape)
+        box.append(slice(max(nonzero[0] - margin, 0),
+                         min(nonzero[-1] + margin + 1, mask.shape[axis])))
+
+    print("\nCropping to {0} voxels ({1:.0f}% of the image)".format(
+          'x'.join(str(b.stop - b.start) for b in box),
+          100.0 * np.prod([b.stop - b.start for b in box]) / mask.size))
+    return tuple(box)
+
+
+def _uncrop(data, box, shape, levelset=False):
+
+    # pastes data computed on a cropped box back into the full image grid,
+    # extending the values at the border of the box to the rest of the image
+    # (extra dimensions of data beyond those of the box are kept as is)
+    pad = [(b.start, n - b.stop) for b, n in zip(box, shape)]
+    pad += [(0, 0)] * (data.ndim - len(box))
+    if not any(before or after for before, after in pad):
+        return data
+    if not levelset:
+        return np.pad(data, pad, mode='edge')
+
+    # levelsets and distances keep growing away from the box, which holds the
+    # whole structure: outside of it, they get the largest absolute value in
+    # the box plus the distance to the box (in voxels)
+    distance = 0
+    for axis, (b, n) in enumerate(zip(box, shape)):
+        index = np.arange(n)
+        gap = np.maximum(b.start - index, 0) + \
+            np.maximum(index - (b.stop - 1), 0)
+        distance = distance + (gap ** 2).reshape(
+                        [n if a == axis else 1 for a in range(data.ndim)])
+    largest = np.nanmax(np.abs(data), axis=tuple(range(len(box))))
+    full = (largest + np.sqrt(distance)).astype(data.dtype)
+    full[box] = data
+    return full
@@ -1,6 +1,7 @@
 from nipype.interfaces.base import BaseInterface, \
-    BaseInterfaceInputSpec, traits, File, TraitedSpec
-from nipype.utils.filemanip import split_filename
+    BaseInterfaceInputSpec, traits, File, TraitedSpec, DynamicTraitedSpec, \
+    isdefined
+from nipype.interfaces.io import add_traits
 
 import nibabel as nb
 import numpy as np
@@ -12,6 +13,19 @@ from .surface.probability_to_levelset import probability_to_levelset
 from .brain.define_multi_region_priors import define_multi_region_priors
 from .filtering.recursive_ridge_diffusion import recursive_ridge_diffusion
 from .segmentation.lesion_extraction import lesion_extraction
+from .pipeline.voxel_expr import voxel_expr
+from .io import save_volume
+from .utils import _fname_4saving
+
+
+def _output_file(output_dir, rootfile, suffix):
+    # path of an image saved by a module, named with the same call as in the
+    # module, so that it matches the written file whatever the extension of
+    # the input and the compression set in the process running the node
+    if not output_dir:
+        output_dir = os.path.dirname(rootfile)
+    return os.path.abspath(os.path.join(output_dir, _fname_4saving(
+                                rootfile=rootfile, suffix=suffix)))
 
 
 class MGDMSegmentationInputSpec(BaseInterfaceInputSpec):
@@ -67,11 +81,10 @@ class MGDMSegmentation(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.contrast_image1
-        path, base, ext = split_filename(fname)
-        outputs["segmentation"] = os.path.abspath(base + '_mgdm_seg.nii.gz')
-        outputs["labels"] = os.path.abspath(base + '_mgdm_lbls.nii.gz')
-        outputs["memberships"] = os.path.abspath(base + '_mgdm_mems.nii.gz')
-        outputs["distance"] = os.path.abspath(base + '_mgdm_dist.nii.gz')
+        outputs["segmentation"] = _output_file(self.inputs.output_dir, fname, 'mgdm_seg')
+        outputs["labels"] = _output_file(self.inputs.output_dir, fname, 'mgdm_lbls')
+        outputs["memberships"] = _output_file(self.inputs.output_dir, fname, 'mgdm_mems')
+        outputs["distance"] = _output_file(self.inputs.output_dir, fname, 'mgdm_dist')
         return outputs
 
 
@@ -119,11 +132,10 @@ class DistanceBasedProbability(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.segmentation_image
-        path, base, ext = split_filename(fname)
-        outputs["prob_image"] = os.path.abspath(base + '_prob_image.nii.gz')
-        outputs["max_label"] = os.path.abspath(base + '_max_label.nii.gz')
-        outputs["mgdm_image"] = os.path.abspath(base + '_mgdm_image.nii.gz')
-        outputs["bg_mask"] = os.path.abspath(base + '_bg_mask.nii.gz')
+        outputs["prob_image"] = _output_file(self.inputs.output_dir, fname, 'prob_image')
+        outputs["max_label"] = _output_file(self.inputs.output_dir, fname, 'max_label')
+        outputs["mgdm_image"] = _output_file(self.inputs.output_dir, fname, 'mgdm_image')
+        outputs["bg_mask"] = _output_file(self.inputs.output_dir, fname, 'bg_mask')
         #outputs["label_number"] = os.path.abspath(base + '_labels.nii.gz')
         return outputs
 
@@ -173,13 +185,12 @@ class EnhanceRegionContrast(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.intensity_image
-        path, base, ext = split_filename(fname)
-        outputs["region_mask"] = os.path.abspath(base + '_emask_'+self.inputs.enhanced_region+'.nii.gz')
-        outputs["background_mask"] = os.path.abspath(base + '_emask_'+self.inputs.contrast_background+'.nii.gz')
-        outputs["region_proba"] = os.path.abspath(base + '_eproba_'+self.inputs.enhanced_region+'.nii.gz')
-        outputs["background_proba"] = os.path.abspath(base + '_eproba_'+self.inputs.contrast_background+'.nii.gz')
-        outputs["region_pv"] = os.path.abspath(base + '_epv_'+self.inputs.enhanced_region+'.nii.gz')
-        outputs["background_pv"] = os.path.abspath(base + '_epv_'+self.inputs.contrast_background+'.nii.gz')
+        outputs["region_mask"] = _output_file(self.inputs.output_dir, fname, 'emask_' + self.inputs.enhanced_region)
+        outputs["background_mask"] = _output_file(self.inputs.output_dir, fname, 'emask_' + self.inputs.contrast_background)
+        outputs["region_proba"] = _output_file(self.inputs.output_dir, fname, 'eproba_' + self.inputs.enhanced_region)
+        outputs["background_proba"] = _output_file(self.inputs.output_dir, fname, 'eproba_' + self.inputs.contrast_background)
+        outputs["region_pv"] = _output_file(self.inputs.output_dir, fname, 'epv_' + self.inputs.enhanced_region)
+        outputs["background_pv"] = _output_file(self.inputs.output_dir, fname, 'epv_' + self.inputs.contrast_background)
         return outputs
 
     
@@ -211,8 +222,7 @@ class ProbabilityToLevelset(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.probability_image
-        path, base, ext = split_filename(fname)
-        outputs["levelset"] = os.path.abspath(base + '_levelset.nii.gz')
+        outputs["levelset"] = _output_file(self.inputs.output_dir, fname, 'levelset')
         return outputs
     
 
@@ -257,10 +267,9 @@ class DefineMultiRegionPriors(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.segmentation_image
-        path, base, ext = split_filename(fname)
-        outputs["inter_ventricular_pv"] = os.path.abspath(base + '_mrp_ivent.nii.gz')
-        outputs["ventricular_horns_pv"] = os.path.abspath(base + '_mrp_vhorns.nii.gz')
-        outputs["internal_capsule_pv"] = os.path.abspath(base + '_mrp_icap.nii.gz')
+        outputs["inter_ventricular_pv"] = _output_file(self.inputs.output_dir, fname, 'mrp_ivent')
+        outputs["ventricular_horns_pv"] = _output_file(self.inputs.output_dir, fname, 'mrp_vhorns')
+        outputs["internal_capsule_pv"] = _output_file(self.inputs.output_dir, fname, 'mrp_icap')
         return outputs
     
     
@@ -326,15 +335,14 @@ class RecursiveRidgeDiffusion(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.input_image
-        path, base, ext = split_filename(fname)
-        outputs["ridge_pv"] = os.path.abspath(base + '_rrd_pv.nii.gz')
-        outputs["filter"] = os.path.abspath(base + '_rrd_filter.nii.gz')
-        outputs["proba"] = os.path.abspath(base + '_rrd_proba.nii.gz')
-        outputs["propagation"] = os.path.abspath(base + '_rrd_propag.nii.gz')
-        outputs["scale"] = os.path.abspath(base + '_rrd_scale.nii.gz')
-        outputs["ridge_direction"] = os.path.abspath(base + '_rrd_dir.nii.gz')
-        outputs["correction"] = os.path.abspath(base + '_rrd_correct.nii.gz')
-        outputs["ridge_size"] = os.path.abspath(base + '_rrd_size.nii.gz')
+        outputs["ridge_pv"] = _output_file(self.inputs.output_dir, fname, 'rrd_pv')
+        outputs["filter"] = _output_file(self.inputs.output_dir, fname, 'rrd_filter')
+        outputs["proba"] = _output_file(self.inputs.output_dir, fname, 'rrd_proba')
+        outputs["propagation"] = _output_file(self.inputs.output_dir, fname, 'rrd_propag')
+        outputs["scale"] = _output_file(self.inputs.output_dir, fname, 'rrd_scale')
+        outputs["ridge_direction"] = _output_file(self.inputs.output_dir, fname, 'rrd_dir')
+        outputs["correction"] = _output_file(self.inputs.output_dir, fname, 'rrd_correct')
+        outputs["ridge_size"] = _output_file(self.inputs.output_dir, fname, 'rrd_size')
         return outputs
     
     
@@ -392,11 +400,53 @@ class LesionExtraction(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         fname = self.inputs.probability_image
-        path, base, ext = split_filename(fname)
-        outputs["lesion_prior"] = os.path.abspath(base + '_lesion_prior.nii.gz')
-        outputs["lesion_size"] = os.path.abspath(base + '_lesion_size.nii.gz')
-        outputs["lesion_proba"] = os.path.abspath(base + '_lesion_proba.nii.gz')
-        outputs["lesion_pv"] = os.path.abspath(base + '_lesion_pv.nii.gz')
-        outputs["lesion_labels"] = os.path.abspath(base + '_lesion_labels.nii.gz')
-        outputs["lesion_score"] = os.path.abspath(base + '_lesion_score.nii.gz')
+        outputs["lesion_prior"] = _output_file(self.inputs.output_dir, fname, 'lesion_prior')
+        outputs["lesion_size"] = _output_file(self.inputs.output_dir, fname, 'lesion_size')
+        outputs["lesion_proba"] = _output_file(self.inputs.output_dir, fname, 'lesion_proba')
+        outputs["lesion_pv"] = _output_file(self.inputs.output_dir, fname, 'lesion_pv')
+        outputs["lesion_labels"] = _output_file(self.inputs.output_dir, fname, 'lesion_labels')
+        outputs["lesion_score"] = _output_file(self.inputs.output_dir, fname, 'lesion_score')
+        return outputs
+
+
+class VoxelExpressionInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+    
+    expression = traits.Str(desc='expression combining the images, see nighres.pipeline.voxel_expr', mandatory=True)
+    out_file = traits.Str('voxel_expr.nii', desc='output file name', usedefault=True)
+
+
+class VoxelExpressionOutputSpec(TraitedSpec):
+    
+    out_file = File(exists=True, desc="Result of the expression")
+
+
+class VoxelExpression(BaseInterface):
+    '''
+    Evaluates an expression on the images given as inputs, named as in the
+    expression, e.g.:
+    
+    >>> calc = Node(VoxelExpression(image_names=['a', 'b']), name='calc')
+    >>> calc.inputs.expression = 'maximum(a, b) / max(maximum(a, b))'
+    '''
+    input_spec = VoxelExpressionInputSpec
+    output_spec = VoxelExpressionOutputSpec
+
+    def __init__(self, image_names=None, **inputs):
+        super(VoxelExpression, self).__init__(**inputs)
+        self._image_names = image_names or []
+        add_traits(self.inputs, self._image_names)
+
+    def _run_interface(self, runtime):
+        
+        images = dict((name, getattr(self.inputs, name)) for name in self._image_names
+                      if isdefined(getattr(self.inputs, name)))
+        result = voxel_expr(expression = self.inputs.expression,
+                            images = images)
+        save_volume(os.path.abspath(self.inputs.out_file), result)
+                      
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
         return outputs